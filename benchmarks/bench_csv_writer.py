@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Compares the block csv writer (export.save_csv) with the previous pandas implementation
+(per-column DataFrames, concat, dropna, round and to_csv) for each layout of the csv file, checks that both
+files are byte-identical and prints the time each one took. Layouts:
+    dark:         raw spectra with the dark spectra and noise columns
+    dark-bright:  raw spectra with the dark and bright spectra and noise columns
+    calculated:   calculated spectra only
+
+Usage, from the repository root (default: 2046 wavelengths x 50,000 frames, about 800 MB per array):
+    python benchmarks/bench_csv_writer.py
+    python benchmarks/bench_csv_writer.py --frames 5000 --layout calculated
+"""
+
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from spectra_compiler.export import ExportJob, save_csv
+
+
+def pandas_save_csv(job: ExportJob, filename):
+    """
+    save_data as it was before the block writer
+    """
+    metadata = pd.DataFrame.from_dict(job.meta_dict, orient='index')
+    wave = pd.DataFrame({"Wavelength (nm)": job.xdata})
+    time_meas_array = np.round(job.time_meas_array, 4)
+    if job.is_show_raw:
+        PLspecR = pd.DataFrame(job.spectra_raw_array.T, columns=time_meas_array)
+        references = {}
+        if job.is_dark_data:
+            references["Dark spectra"] = job.dark_mean
+            references["Dark noise"] = job.dark_noise
+        if job.is_bright_data:
+            references["Bright spectra"] = job.bright_mean
+            references["Bright noise"] = job.bright_noise
+        spectral_data = pd.concat([wave, pd.DataFrame(references), PLspecR], axis=1, join="inner")
+    else:
+        PLspec = pd.DataFrame(job.spectra_meas_array.T, columns=time_meas_array)
+        spectral_data = pd.concat([wave, PLspec], axis=1, join="inner")
+    spectral_data = spectral_data.dropna(axis=1, how="all")
+    spectral_data = spectral_data.round(1)
+    metadata.to_csv(filename, header=False)
+    spectral_data.to_csv(filename, mode="a", index=False)
+
+
+LAYOUTS = ("dark", "dark-bright", "calculated")
+
+
+def make_job(folder, array_size, frames, layout):
+    rng = np.random.default_rng(0)
+    xdata = np.linspace(340, 1015, array_size)
+    dark = rng.normal(1000, 20, array_size)
+    dark_noise = np.abs(rng.normal(20, 2, array_size))
+    bright = 60000 + rng.normal(0, 100, array_size)
+    bright_noise = np.abs(rng.normal(100, 10, array_size))
+    raw = 50000 * np.exp(-(np.arange(array_size) - 900) ** 2 / 2e5) + rng.normal(1000, 50, (frames, array_size))
+    raw[-frames // 10:] = np.nan  # Unmeasured frames, as after pressing STOP
+    time_meas_array = np.arange(frames) * 0.01
+    time_meas_array[-frames // 10:] = np.nan
+    is_bright_data = layout == "dark-bright"
+    meta_dict = {"Date": "12:00:00 - 01.01.2023", "Sample": "bench", "Dark measurement": True,
+                 "Bright measurement": is_bright_data, "Comments": "multi-line,\ncomment"}
+    return ExportJob(folder, "bench", meta_dict, xdata, raw, raw - dark, time_meas_array, dark_mean=dark,
+                     bright_mean=bright if is_bright_data else None, dark_noise=dark_noise,
+                     bright_noise=bright_noise if is_bright_data else None, is_dark_data=True,
+                     is_bright_data=is_bright_data, is_show_raw=layout != "calculated", is_heatplot=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--array-size", type=int, default=2046)
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--layout", choices=LAYOUTS, action="append",
+                        help="csv layout to compare, can be repeated (default: all)")
+    args = parser.parse_args()
+
+    is_identical = True
+    print("{} x {} frames".format(args.array_size, args.frames))
+    for layout in args.layout or LAYOUTS:
+        with tempfile.TemporaryDirectory() as folder:
+            job = make_job(folder + "/", args.array_size, args.frames, layout)
+            reference = os.path.join(folder, "pandas.csv")
+
+            start = time.perf_counter()
+            pandas_save_csv(job, reference)
+            pandas_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            save_csv(job)
+            block_time = time.perf_counter() - start
+
+            identical = filecmp.cmp(reference, job.filename, shallow=False)
+            is_identical &= identical
+            print("{}:".format(layout))
+            print("  pandas:       {:8.2f} s".format(pandas_time))
+            print("  block writer: {:8.2f} s  ({:.1f}x)".format(block_time, pandas_time / block_time))
+            print("  byte-identical:", identical)
+    sys.exit(0 if is_identical else 1)
@@ -0,0 +1,301 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Benchmarks the hot paths of the acquisition pipeline with the simulated spectrometer, without a display
+(offscreen Qt platform):
+    correct     SpectraCorrector (and the former per-frame spectra_math) on dark+bright corrected spectra
+    gather      SpectraGatherer.measure / measure_block, per frame and batched
+    references  DarkBrightGatherer with each spike rejection
+    transport   spectrometer process -> Emitter -> SpectraGatherer, through the pipe and through shared memory
+    export      every file format, and the heatplot preview
+
+Each case records frames/s (or seconds), latency percentiles where they apply, and the peak RSS of the process
+so far (the RSS is a high-water mark, run a single case with --case to measure it alone).
+
+Usage, from the repository root:
+    python benchmarks/bench_pipeline.py --save-baseline baseline.json
+    python benchmarks/bench_pipeline.py --baseline baseline.json          # exit code 1 on regressions
+    python benchmarks/bench_pipeline.py --frames 1000 --case transport --output results.json
+
+No baseline is shipped: timings only compare on the same machine, so record one before changing the code.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from multiprocessing import Queue, Pipe, freeze_support
+import numpy as np
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from PyQt5.QtCore import QCoreApplication
+from spectra_compiler import utils, instrumentation
+from spectra_compiler.export import ExportJob, FORMATS, save, save_heatplot
+from spectra_compiler.generator import SpectroProcess, SpectroCommand, SpectraReading, SpectraBlock, RAW_DTYPE, \
+    MEAS_DTYPE
+from spectra_compiler.instrumentation import LatencyMonitor
+from spectra_compiler.simulator import SimulatedSpectrometer
+from spectra_compiler.workers import Emitter, SpectraGatherer, DarkBrightGatherer
+
+ARRAY_SIZE = 2046
+BATCH = 64  # Readings per block in the batched cases
+#  Metric: True if higher is better
+METRICS = {"frames_per_s": True, "seconds": False, "p50_ms": False, "p99_ms": False, "peak_rss_mb": False}
+
+
+def peak_rss_mb():
+    """
+    @return: peak resident memory of this process in MB, None where it is not available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on macOS, KB on Linux
+
+
+def percentiles(latencies):
+    p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99])
+    return {"p50_ms": float(p50), "p99_ms": float(p99)}
+
+
+def references(rng, array_size=ARRAY_SIZE):
+    dark = rng.normal(1000, 20, array_size)
+    bright = dark + 50000 * np.exp(-(np.arange(array_size) - 900) ** 2 / 2e5) + 1000
+    return dark, bright
+
+
+def readings(rng, n_frames, array_size=ARRAY_SIZE, pool=256):
+    """
+    Yields n_frames synthetic readings, cycling through a pool of spectra so memory stays flat
+    """
+    spectrometer = SimulatedSpectrometer(array_size=array_size, seed=int(rng.integers(1 << 31)), frame_rate=np.inf)
+    spectra = np.stack([spectrometer.intensities() for _ in range(min(pool, n_frames))]).astype(RAW_DTYPE)
+    for counter in range(n_frames):
+        yield SpectraReading(counter * 0.01, spectra[counter % len(spectra)])
+
+
+def bench_correct(n_frames, rng):
+    dark, bright = references(rng)
+    spectra = np.stack([reading.data for reading in readings(rng, min(n_frames, 256))])
+    results = {}
+    start = time.perf_counter()
+    for counter in range(n_frames):
+        utils.spectra_math(spectra[counter % len(spectra)], True, True, dark, bright)
+    results["math_per_frame"] = {"frames_per_s": n_frames / (time.perf_counter() - start)}
+    corrector = utils.SpectraCorrector(True, True, dark, bright)
+    out = np.empty(ARRAY_SIZE, dtype=MEAS_DTYPE)
+    start = time.perf_counter()
+    for counter in range(n_frames):
+        corrector.apply(spectra[counter % len(spectra)], out=out)
+    results["corrector_per_frame"] = {"frames_per_s": n_frames / (time.perf_counter() - start)}
+    blocks = np.resize(spectra, (BATCH, ARRAY_SIZE))
+    out = np.empty(blocks.shape, dtype=MEAS_DTYPE)
+    start = time.perf_counter()
+    for _ in range(0, n_frames, BATCH):
+        corrector.apply(blocks, out=out)
+    results["corrector_block"] = {"frames_per_s": n_frames / (time.perf_counter() - start)}
+    return results
+
+
+def bench_gather(n_frames, rng):
+    dark, bright = references(rng)
+    results = {}
+    gatherer = SpectraGatherer(n_frames, ARRAY_SIZE, 0, True, True, dark, bright)
+    latencies = np.empty(n_frames)
+    start = time.perf_counter()
+    for counter, reading in enumerate(readings(rng, n_frames)):
+        frame_start = time.perf_counter()
+        gatherer.measure(reading)
+        latencies[counter] = time.perf_counter() - frame_start
+    results["per_frame"] = {"frames_per_s": n_frames / (time.perf_counter() - start), **percentiles(latencies)}
+    del gatherer
+    gatherer = SpectraGatherer(n_frames, ARRAY_SIZE, 0, True, True, dark, bright)
+    pending = []
+    latencies = []
+    start = time.perf_counter()
+    for reading in readings(rng, n_frames):
+        pending.append(reading)
+        if len(pending) == BATCH:
+            frame_start = time.perf_counter()
+            gatherer.measure_block(SpectraBlock.from_readings(pending))
+            latencies.append(time.perf_counter() - frame_start)
+            pending = []
+    if pending:
+        gatherer.measure_block(SpectraBlock.from_readings(pending))
+    results["block"] = {"frames_per_s": n_frames / (time.perf_counter() - start), **percentiles(latencies)}
+    return results
+
+
+def bench_references(n_frames, rng):
+    results = {}
+    for rejection in utils.ReferenceAccumulator.REJECTIONS:
+        gatherer = DarkBrightGatherer(n_frames, ARRAY_SIZE, rejection)
+        start = time.perf_counter()
+        for reading in readings(rng, n_frames):
+            gatherer.gathering_counts(reading)
+        gatherer.emit_mean()
+        results[rejection] = {"frames_per_s": n_frames / (time.perf_counter() - start)}
+    return results
+
+
+def run_transport(app, n_frames, use_shared_memory, max_batch):
+    """
+    Streams n_frames from a spectrometer process (simulated, unpaced) into a SpectraGatherer through the Emitter
+    @return: metrics of the run
+    """
+    mother_pipe, child_pipe = Pipe()
+    queue = Queue()
+    process = SpectroProcess(child_pipe, queue, use_shared_memory=use_shared_memory, is_instrumented=True,
+                             simulator=SimulatedSpectrometer(seed=0, frame_rate=np.inf))
+    monitor = LatencyMonitor(window=min(n_frames, 100000))
+    emitter = Emitter(mother_pipe, process.ring, max_batch=max_batch, monitor=monitor)
+    gatherer = SpectraGatherer(n_frames, process.array_size, 0, False, False, None, None, monitor=monitor)
+    gatherer.finished.connect(app.quit)
+    emitter.connect_consumer(gatherer.measure, gatherer.measure_block)
+    process.start()
+    child_pipe.close()  # So the emitter sees the end of the pipe once the process exits
+    emitter.start()
+    start = time.perf_counter()
+    app.exec()
+    seconds = time.perf_counter() - start
+    emitter.disconnect_consumer(gatherer.measure, gatherer.measure_block)
+    queue.put(SpectroCommand(SpectroCommand.SHUTDOWN))
+    process.join(10)
+    if process.is_alive():
+        process.terminate()
+    emitter.wait(10000)
+    app.processEvents()  # Readings emitted after the measurement ended
+    if process.ring is not None:
+        process.ring.close()
+    stats = monitor.stats()
+    #  Latency from the spectrometer process to the emitter thread, and from there to the gatherer (Qt signal)
+    receive, gather = stats[instrumentation.STAGES[instrumentation.RECEIVE]], \
+        stats[instrumentation.STAGES[instrumentation.GATHER]]
+    return {"frames_per_s": n_frames / seconds, "p50_ms": receive["p50_ms"], "p99_ms": receive["p99_ms"],
+            "gather_p99_ms": gather["p99_ms"], "dropped": monitor.dropped}
+
+
+def bench_transport(n_frames, rng, app):
+    return {"pipe": run_transport(app, n_frames, False, 1),
+            "pipe_batched": run_transport(app, n_frames, False, BATCH),
+            "shared_memory": run_transport(app, n_frames, True, 1),
+            "shared_memory_batched": run_transport(app, n_frames, True, BATCH)}
+
+
+def bench_export(n_frames, rng):
+    dark, bright = references(rng)
+    raw = np.empty((n_frames, ARRAY_SIZE), dtype=RAW_DTYPE)
+    for counter, reading in enumerate(readings(rng, n_frames)):
+        raw[counter] = reading.data
+    meas = utils.SpectraCorrector(True, False, dark, bright).apply(raw, out=np.empty(raw.shape, dtype=MEAS_DTYPE))
+    meta_dict = {"Date": "12:00:00 - 01.01.2023", "Sample": "bench", "Dark measurement": True, "Comments": ""}
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for file_format in FORMATS:
+            job = ExportJob(folder + "/", "bench", meta_dict, np.linspace(340, 1015, ARRAY_SIZE), raw, meas,
+                            np.arange(n_frames) * 0.01, dark_mean=dark, is_dark_data=True, is_heatplot=False,
+                            file_format=file_format)
+            start = time.perf_counter()
+            try:
+                save(job)
+            except ImportError as error:  # Optional format library not installed
+                print("  export {}: skipped ({})".format(file_format, error))
+                continue
+            results[file_format] = {"seconds": time.perf_counter() - start,
+                                    "file_mb": os.path.getsize(job.filename) / 2 ** 20}
+            os.remove(job.filename)
+        start = time.perf_counter()
+        save_heatplot(job)
+        results["heatplot"] = {"seconds": time.perf_counter() - start}
+    return results
+
+
+CASES = {"correct": bench_correct, "gather": bench_gather, "references": bench_references,
+         "transport": bench_transport, "export": bench_export}
+
+
+def run(frame_counts, export_frame_counts, cases, seed=0):
+    """
+    @return: {case name: {metric: value}}
+    """
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+    results = {}
+    for case in cases:
+        for n_frames in export_frame_counts if case == "export" else frame_counts:
+            rng = np.random.default_rng(seed)
+            print("{} ({} frames)".format(case, n_frames))
+            arguments = (n_frames, rng, app) if case == "transport" else (n_frames, rng)
+            for variant, metrics in CASES[case](*arguments).items():
+                metrics["peak_rss_mb"] = peak_rss_mb()
+                results["{}/{}/{}".format(case, variant, n_frames)] = metrics
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints every metric next to its baseline value
+    @param tolerance: allowed relative change in the bad direction, e.g. 0.2 for 20 %
+    @return: list of regressed "case metric" entries
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(name, {}).get(metric)
+            if metric not in METRICS or value is None or not reference:
+                continue
+            change = value / reference - 1
+            is_regression = -change > tolerance if METRICS[metric] else change > tolerance
+            print("{:45} {:12} {:12.4g} {:12.4g} {:+7.1%}{}".format(name, metric, value, reference, change,
+                                                                   "  REGRESSION" if is_regression else ""))
+            if is_regression:
+                regressions.append("{} {}".format(name, metric))
+    return regressions
+
+
+def print_results(results):
+    for name, metrics in results.items():
+        print("{:45} ".format(name) + ", ".join(
+            "{} {:.4g}".format(metric, value) for metric, value in metrics.items() if value is not None))
+
+
+if __name__ == "__main__":
+    freeze_support()  # Required when doing multiprocessing on Windows
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--export-frames", type=int, nargs="+", default=[1000, 10000],
+                        help="frames of the measurements saved in the export case")
+    parser.add_argument("--case", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="json file for the results")
+    parser.add_argument("--save-baseline", help="json file to store the results as baseline")
+    parser.add_argument("--baseline", help="json baseline to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    args = parser.parse_args()
+
+    bench_results = run(args.frames, args.export_frames, args.case, args.seed)
+    report = {"machine": {"platform": platform.platform(), "processor": platform.processor(),
+                          "python": platform.python_version(), "numpy": np.__version__,
+                          "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+              "results": bench_results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as file:
+                json.dump(report, file, indent=2)
+    if not args.baseline:
+        print_results(bench_results)
+        sys.exit(0)
+    with open(args.baseline) as file:
+        baseline_report = json.load(file)
+    print("Baseline from {} ({})".format(baseline_report["machine"]["date"], baseline_report["machine"]["platform"]))
+    found = compare(bench_results, baseline_report["results"], args.tolerance)
+    if found:
+        print("{} regression(s) beyond {:.0%}: {}".format(len(found), args.tolerance, ", ".join(found)))
+    sys.exit(1 if found else 0)
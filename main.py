@@ -6,30 +6,102 @@ __author__ = "Edgar Nandayapa (HZB), Ashis Ravindran (DKFZ)"
 __version__ = "20.01.2023"
 __status__ = "Production"
 
+import time
+
+STARTED = time.perf_counter()
 import sys
-from multiprocessing import Queue, Pipe, freeze_support
-from PyQt5 import QtWidgets
-from spectra_compiler.app import MainWindow
+import argparse
 import pathlib
-from spectra_compiler.generator import SpectroProcess
-from spectra_compiler.workers import Emitter
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue, Pipe, freeze_support
+from PyQt5 import QtWidgets, QtGui
+from PyQt5.QtCore import Qt
+from spectra_compiler.generator import SpectroProcess, discover_device
+from spectra_compiler.processing import ProcessingProcess
+from spectra_compiler.simulator import SimulatedSpectrometer
+from spectra_compiler.instrumentation import LatencyMonitor, StartupTimer
 
 if __name__ == "__main__":
     freeze_support()  # Required when doing multiprocessing on Windows
+    startup = StartupTimer(STARTED)
+    parser = argparse.ArgumentParser(description="Spectra Compiler")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="hand spectra over through shared memory instead of a pipe")
+    parser.add_argument("--max-batch", type=int, default=1,
+                        help="emit up to this many spectra at once to the interface (1 disables batching)")
+    parser.add_argument("--max-latency-ms", type=float, default=20,
+                        help="longest wait for more spectra before emitting a batch")
+    parser.add_argument("--instrument", action="store_true",
+                        help="measure per-stage latency, shown in the status bar and saved with each measurement")
+    parser.add_argument("--simulate", action="store_true",
+                        help="use the simulated spectrometer even if a device is connected")
+    parser.add_argument("--frame-rate", type=float, default=None,
+                        help="simulated frames per second (default 1 / integration time, inf for as fast as possible)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the simulated spectrometer")
+    parser.add_argument("--processing-process", action="store_true",
+                        help="correct, average and gather spectra in a separate process, the interface only receives "
+                             "decimated spectra to display")
+    args, qt_args = parser.parse_known_args()
     icon_path = '../resources/rainbow.ico'
     icon_path = pathlib.Path(icon_path)
-    app = QtWidgets.QApplication(sys.argv)
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    pixmap = QtGui.QPixmap(360, 120)
+    pixmap.fill(Qt.white)
+    splash = QtWidgets.QSplashScreen(pixmap)
+    splash.showMessage("Spectra Compiler\nLooking for a spectrometer...", Qt.AlignCenter)
+    splash.show()
+    app.processEvents()
+    startup.mark("Qt")
+
+    simulator = SimulatedSpectrometer(seed=args.seed, frame_rate=args.frame_rate) if args.simulate else None
+    with ThreadPoolExecutor(max_workers=1) as discovery:
+        device = discovery.submit(discover_device, simulator)
+        #  The interface (matplotlib) is imported here, while the device is searched, not at module level:
+        #  on Windows the spectrometer process re-imports this module and does not need it
+        from spectra_compiler.app import MainWindow
+        from spectra_compiler.workers import Emitter
+        startup.mark("imports")
+        device = device.result()
+    startup.mark("device")
 
     mother_pipe, child_pipe = Pipe()
     queue = Queue()
-    emitter = Emitter(mother_pipe)
-    spectro_process = SpectroProcess(child_pipe, queue)
+    spectro_process = SpectroProcess(child_pipe, queue, use_shared_memory=args.shared_memory,
+                                     is_instrumented=args.instrument, simulator=simulator, device=device)
+    processing_process = processing_queue = None
+    if args.processing_process:
+        #  spectrometer -> processing process -> emitter, display frames are few so they are not batched
+        gui_pipe, processing_pipe = Pipe()
+        processing_queue = Queue()
+        processing_process = ProcessingProcess(mother_pipe, processing_pipe, processing_queue, spectro_process.xdata,
+                                               ring=spectro_process.ring)
+        emitter = Emitter(gui_pipe, monitor=LatencyMonitor() if args.instrument else None)
+    else:
+        emitter = Emitter(mother_pipe, spectro_process.ring, max_batch=args.max_batch,
+                          max_latency_ms=args.max_latency_ms, monitor=LatencyMonitor() if args.instrument else None)
 
     w = MainWindow(icon_path, spectro_process.is_spectrometer, emitter, queue, spectro_process.xdata,
-                   spectro_process.array_size)
+                   spectro_process.array_size, spectro_process.serial_number, processing_queue=processing_queue)
+
+    def first_frame(_):
+        emitter.disconnect_consumer(first_frame, first_frame)
+        startup.mark("first frame")
+        print(startup.summary())
+        w.statusBar().showMessage(startup.summary(), 10000)
+
+    emitter.connect_consumer(first_frame, first_frame)
     spectro_process.start()
+    if processing_process is not None:
+        processing_process.start()
 
     w.show()
+    splash.finish(w)
+    startup.mark("window")
     app.exec()
     spectro_process.join()
     spectro_process.terminate()
+    if processing_process is not None:
+        processing_process.join(5)
+        processing_process.terminate()
+    if spectro_process.ring is not None:
+        spectro_process.ring.close()
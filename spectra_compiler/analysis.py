@@ -0,0 +1,155 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import csv
+import numpy as np
+
+
+def parse_rois(text) -> list:
+    """
+    @param text: wavelength ranges in nm, e.g. "500-600, 700-750"
+    @return: list of (low, high) tuples
+    @raise ValueError: if a range cannot be read or is empty
+    """
+    rois = []
+    for entry in text.replace(";", ",").split(","):
+        if not entry.strip():
+            continue
+        low, _, high = entry.strip().partition("-")
+        low, high = float(low.replace(" ", "")), float(high.replace(" ", ""))
+        if not low < high:
+            raise ValueError("Empty wavelength range: " + entry.strip())
+        rois.append((low, high))
+    return rois
+
+
+class PeakTracker:
+    """
+    Peak position, FWHM and integrated intensity in wavelength regions of interest, for every frame.
+    Regions are padded to a common width, so a block of frames is analysed for all regions at once:
+    the position is refined to sub-pixel precision with a parabola through the maximum and its neighbours,
+    the FWHM is measured between the linearly interpolated half-maximum crossings (half way between the
+    maximum and the minimum of the region), and the intensity is the trapezoidal integral over the region.
+    Values are NaN where they cannot be measured (e.g. the peak is cut by the region edge).
+    Results are kept in arrays grown by doubling, a few values per frame
+    """
+    QUANTITIES = ("position", "fwhm", "area")
+    POSITION, FWHM, AREA = range(len(QUANTITIES))
+
+    def __init__(self, xdata, rois, capacity=1024):
+        """
+        @param xdata: wavelengths in nm, increasing
+        @param rois: list of (low, high) wavelength ranges in nm
+        @param capacity: frames preallocated
+        """
+        self.xdata = np.asarray(xdata, dtype=float)
+        self.rois = [tuple(roi) for roi in rois]
+        starts = np.searchsorted(self.xdata, [low for low, _ in self.rois], side="left")
+        stops = np.searchsorted(self.xdata, [high for _, high in self.rois], side="right")
+        widths = np.maximum(stops - starts, 1)
+        columns = np.arange(widths.max())
+        self._start = starts
+        self._width = widths
+        self._index = np.minimum(starts[:, None] + columns, len(self.xdata) - 1)  # (n_rois, width)
+        self._valid = columns < (stops - starts)[:, None]  # Regions outside the spectrum have no valid pixel
+        self._columns = columns
+        x = self.xdata[self._index]
+        self._dx = np.where(self._valid[:, 1:], np.diff(x, axis=1), 0.0)  # Zero past the end of each region
+        self._times = np.empty(capacity)
+        self._values = np.empty((capacity, len(self.rois), len(self.QUANTITIES)))
+        self.n_frames = 0
+
+    def analyse(self, spectra) -> np.ndarray:
+        """
+        @param spectra: (n, array_size) calculated spectra, or a single spectrum
+        @return: (n, n_rois, 3) position (nm), FWHM (nm) and integrated intensity (counts nm)
+        """
+        y = np.asarray(np.atleast_2d(spectra), dtype=float)[:, self._index]  # (n, n_rois, width)
+        valid = self._valid & ~np.isnan(y)
+        peak = np.argmax(np.where(valid, y, -np.inf), axis=2)  # (n, n_rois)
+        last = self._width - 1
+
+        def at(index):
+            return np.take_along_axis(y, index[..., None], axis=2)[..., 0]
+
+        y_peak = at(peak)
+        y_left, y_right = at(np.maximum(peak - 1, 0)), at(np.minimum(peak + 1, last))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            curvature = y_left - 2 * y_peak + y_right
+            shift = np.where((peak > 0) & (peak < last) & (curvature < 0),
+                             np.clip(0.5 * (y_left - y_right) / curvature, -0.5, 0.5), 0.0)
+            half = (y_peak + np.where(valid, y, np.inf).min(axis=2)) / 2
+            below = valid & (y <= half[..., None])
+            columns = self._columns
+            left = np.where(below & (columns < peak[..., None]), columns, -1).max(axis=2)
+            right = np.where(below & (columns > peak[..., None]), columns, len(columns)).min(axis=2)
+            has_left, has_right = left >= 0, right < len(columns)
+            left, right = np.maximum(left, 0), np.minimum(right, last)
+            y_out, y_in = at(left), at(np.minimum(left + 1, last))
+            left_edge = left + (half - y_out) / (y_in - y_out)
+            y_out, y_in = at(right), at(np.maximum(right - 1, 0))
+            right_edge = right - (half - y_out) / (y_in - y_out)
+        pixels = np.arange(len(self.xdata))
+        values = np.empty(y.shape[:2] + (len(self.QUANTITIES),))
+        values[..., self.POSITION] = np.interp(self._start + peak + shift, pixels, self.xdata)
+        fwhm = np.interp(self._start + right_edge, pixels, self.xdata) - \
+            np.interp(self._start + left_edge, pixels, self.xdata)
+        values[..., self.FWHM] = np.where(has_left & has_right, fwhm, np.nan)
+        segments = np.where(valid[..., 1:] & valid[..., :-1], (y[..., 1:] + y[..., :-1]) / 2, 0.0)
+        values[..., self.AREA] = np.sum(segments * self._dx, axis=2)
+        values[~valid.any(axis=2)] = np.nan
+        return values
+
+    def add(self, spectra, timestamps):
+        """
+        Analyses and stores frames
+        @param spectra: (n, array_size) calculated spectra, or a single spectrum
+        @param timestamps: acquisition times of the frames
+        @return: (n, n_rois, 3) values of these frames
+        """
+        values = self.analyse(spectra)
+        self.extend(np.atleast_1d(timestamps), values)
+        return values
+
+    def extend(self, timestamps, values):
+        """
+        Stores frames analysed elsewhere (e.g. by the processing process)
+        """
+        n_frames = self.n_frames + len(timestamps)
+        if n_frames > len(self._times):
+            capacity = max(n_frames, 2 * len(self._times))
+            self._times = np.resize(self._times, capacity)
+            self._values = np.resize(self._values, (capacity,) + self._values.shape[1:])
+        self._times[self.n_frames:n_frames] = timestamps
+        self._values[self.n_frames:n_frames] = values
+        self.n_frames = n_frames
+
+    def since(self, start):
+        """
+        @param start: number of frames already handled
+        @return: (timestamps, (n, n_rois, 3) values) of the frames analysed after them, copied
+        """
+        return self._times[start:self.n_frames].copy(), self._values[start:self.n_frames].copy()
+
+    def series(self):
+        """
+        @return: (timestamps relative to the first frame, (n, n_rois, 3) values) of the frames analysed so far
+        """
+        times = self._times[:self.n_frames]
+        return times - times[0] if self.n_frames else times, self._values[:self.n_frames]
+
+    def columns(self) -> list:
+        return ["Time (s)"] + ["{:g}-{:g} nm {}".format(low, high, name) for low, high in self.rois
+                               for name in ("position (nm)", "FWHM (nm)", "area")]
+
+    def save(self, path):
+        """
+        Writes the time series as csv, one row per frame
+        @param path: csv file
+        """
+        times, values = self.series()
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(self.columns())
+            writer.writerows(np.column_stack([times, values.reshape(len(times), -1)]).round(6).tolist())
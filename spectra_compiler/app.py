@@ -4,10 +4,10 @@
 
 import os
 from PyQt5 import QtWidgets, QtGui
-from PyQt5.QtWidgets import QWidget, QLineEdit, QFormLayout, QHBoxLayout, QSpacerItem, QGridLayout, QApplication
+from PyQt5.QtWidgets import QWidget, QLineEdit, QFormLayout, QHBoxLayout, QSpacerItem, QGridLayout
 from PyQt5.QtWidgets import QFrame, QPushButton, QCheckBox, QLabel, QToolButton, QTextEdit, QScrollBar
-from PyQt5.QtWidgets import QSizePolicy, QMessageBox, QDialog, QVBoxLayout,QTextBrowser
-from PyQt5.QtCore import QThread, pyqtSlot
+from PyQt5.QtWidgets import QSizePolicy, QMessageBox, QDialog, QVBoxLayout,QTextBrowser, QComboBox
+from PyQt5.QtCore import QThread, pyqtSlot, pyqtSignal
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QFont
 import matplotlib
@@ -15,17 +15,32 @@ import matplotlib
 matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
 from matplotlib import rcParams
 
 rcParams.update({'figure.autolayout': True})
-import pandas as pd
 import numpy as np
 from time import time, strftime, localtime
 from datetime import datetime
 from spectra_compiler import utils
 import pathlib
-from spectra_compiler.workers import PlotWorker, SpectraGatherer, DarkBrightGatherer
+from spectra_compiler.workers import PlotWorker, SpectraGatherer, DarkBrightGatherer, ExportWorker, WaterfallWorker, \
+    RemoteGatherer, RemoteReferenceGatherer, PeakPlotWorker
+from spectra_compiler.analysis import PeakTracker, parse_rois
+from spectra_compiler.processing import ProcessingCommand, MeasurementPlan
+from spectra_compiler.export import ExportJob, FORMATS
+from spectra_compiler import journal
+from spectra_compiler.darks import DarkLibrary
+from spectra_compiler.generator import SpectroCommand, RAW_DTYPE, MEAS_DTYPE
+from spectra_compiler.timing import FrameTiming
+from spectra_compiler.trigger import TriggerArm, make_trigger
+
+#  Start conditions offered in the GUI, and the trigger kind they use (None: start right away)
+TRIGGER_CHOICES = {"Start button": None,
+                   "Intensity above": "above",
+                   "Intensity below": "below",
+                   "Change faster than (1/s)": "rate",
+                   "Trigger file created": "file",
+                   "UDP message on port": "udp"}
 
 class InfoDialog(QDialog):
     def __init__(self, parent=None):
@@ -61,11 +76,13 @@ class MplCanvas(FigureCanvasQTAgg):
 
 
 class MainWindow(QtWidgets.QMainWindow):
+    export_requested = pyqtSignal(object)
 
     def __init__(self, icon_path: pathlib.Path, is_spectrometer: bool, emitter, child_process_queue, xdata, array_size,
-                 *args, **kwargs):
+                 serial_number="demo", processing_queue=None, *args, **kwargs):
         '''
         QT main window class handling all user interactive widgets and their actions
+        :param processing_queue: Queue of the ProcessingProcess, if spectra are processed in their own process
         :param args:
         :param kwargs:
         '''
@@ -77,31 +94,65 @@ class MainWindow(QtWidgets.QMainWindow):
         self.is_show_raw = False
         self.is_measuring = False
         self.current_inttime_ms: float = 0
+        self.command_counter = 0
+        self.requested_setting_id = 0  # Last integration time command sent to the spectrometer process
+        self.active_setting_id = 0  # Last integration time command the spectrometer process confirmed
+        self.inttime_callbacks = []  # Actions waiting for the requested integration time to be applied
         self.dark_mean = None
         self.bright_mean = None
+        self.dark_noise = None  # Per-pixel standard deviation of the references
+        self.bright_noise = None
+        self.dark_inttime_ms = None  # Integration time the dark spectra were taken at
+        self.serial_number = serial_number
+        self.dark_library = DarkLibrary()
+        self.dark_library.evict()
         self.setWindowTitle("Spectra Compiler")
         self.setWindowIcon(QtGui.QIcon(str(icon_path)))
         np.seterr(divide='ignore', invalid='ignore')
 
         self.is_spectrometer = is_spectrometer
         self.process_queue = child_process_queue
+        self.processing_queue = processing_queue
         self.xdata = xdata
         self.array_size = array_size
         self.emitter = emitter
+        self.monitor = emitter.monitor  # LatencyMonitor when started with --instrument
         self.emitter.daemon = True
+        self.emitter.command_acknowledged.connect(self.command_acknowledged)
         self.emitter.start()
+        self.inttime_sync_timer = QTimer()
+        self.inttime_sync_timer.setSingleShot(True)
+        self.inttime_sync_timer.timeout.connect(self.inttime_sync_timeout)
 
         self.spec_thread = QThread()
         self.plot_thread = QThread()
         self.brightdark_meas_thread = QThread()
         self.brightdark_meas_worker = None
+        self.export_thread = QThread()
+        self.exports_pending = 0
+        self.is_close_requested = False
+        self.journal_path = None  # Crash recovery journal of the running measurement
+        self.frame_timing = FrameTiming()  # Acquisition timing of the running measurement, saved with it
+        self.peak_tracker = None  # PeakTracker of the running measurement, saved with it
+        self.rois = []  # Wavelength ranges whose peaks are tracked, read from the GUI at start
+        self.trigger = None  # Condition the armed measurement waits for, None to record right away
+        self.pre_trigger = 0  # Seconds before the trigger kept in the measurement
+        self.is_armed = False
 
         self.statusBar().showMessage("Program by Edgar Nandayapa - 2021", 10000)
 
         self.create_widgets()
+        if self.monitor is not None:
+            #  Live pipeline statistics in the status bar
+            self.LAlatency = QLabel(self.monitor.summary())
+            self.statusBar().addPermanentWidget(self.LAlatency)
+            self.latency_timer = QTimer()
+            self.latency_timer.timeout.connect(lambda: self.LAlatency.setText(self.monitor.summary()))
+            self.latency_timer.start(1000)
         self.arr_scrbar = utils.array_for_scrollbar()  # This function makes an array for the scrollbar
         self.set_integration_time()  # This resets the starting integration time value
         self.button_actions()  # Set button actions
+        QTimer.singleShot(0, self.recover_measurements)  # Look for measurements interrupted by a crash
 
     def create_widgets(self):
         '''
@@ -119,11 +170,31 @@ class MainWindow(QtWidgets.QMainWindow):
         self._plot_ref = None
         #  Add a toolbar to control plotting area
         toolbar = NavigationToolbar(self.canvas, self)
+        #  Live waterfall of the running measurement, hidden unless selected
+        self.waterfall_canvas = MplCanvas(self, width=5, height=2, dpi=100)
+        self.waterfall_canvas.setMinimumHeight(200)
+        self.waterfall_canvas.setVisible(False)
+        #  Live peak tracking of the running measurement, shown when regions are given
+        self.peaks_canvas = MplCanvas(self, width=5, height=2, dpi=100)
+        self.peaks_canvas.setMinimumHeight(200)
+        self.peaks_canvas.setVisible(False)
 
         self.Braw = QCheckBox("Show Raw Data")  #  Button to select visualization
         self.Brange = QCheckBox("Fix y-axis")  #  Button to select visualization
         self.BSavePlot = QCheckBox("Create heatplot")
         self.BSavePlot.setChecked(True)
+        self.BStream = QCheckBox("Stream to disk")
+        self.BStream.setToolTip("Write frames to .npy files while measuring, for long runs that do not fit in memory")
+        self.CBformat = QComboBox()
+        self.CBformat.addItems(list(FORMATS))
+        self.CBformat.setToolTip("File format of the saved measurement")
+        self.BCompress = QCheckBox("Compress")
+        self.BCompress.setToolTip("Compress binary files (HDF5, NPZ, Parquet)")
+        self.BJournal = QCheckBox("Crash recovery")
+        self.BJournal.setChecked(True)
+        self.BJournal.setToolTip("Keep a journal of the running measurement, to recover it after a crash")
+        self.BWaterfall = QCheckBox("Live waterfall")
+        self.BWaterfall.setToolTip("Show the last frames of the running measurement as a time vs wavelength image")
         self.info_button = QPushButton("\U0001F6C8")
         self.info_button.setFixedSize(25, 25)
         self.info_button.setStyleSheet("text-align: center; font-size: 18px;")
@@ -131,19 +202,23 @@ class MainWindow(QtWidgets.QMainWindow):
         # # Place all widgets
         #  First in a grid
         LBgrid = QGridLayout()
-        LBgrid.addWidget(QLabel(" "), 0, 0)
-        LBgrid.addWidget(QLabel(" "), 0, 1)
+        LBgrid.addWidget(self.CBformat, 0, 0)
+        LBgrid.addWidget(self.BCompress, 0, 1)
         LBgrid.addWidget(self.Braw, 0, 2)
         LBgrid.addWidget(self.Brange, 0, 3)
         LBgrid.addWidget(self.BSavePlot, 0, 4)
-        LBgrid.addWidget(QLabel(" "), 0, 5)
-        LBgrid.addWidget(self.info_button, 0, 6)
+        LBgrid.addWidget(self.BStream, 0, 5)
+        LBgrid.addWidget(self.BJournal, 0, 6)
+        LBgrid.addWidget(self.BWaterfall, 0, 7)
+        LBgrid.addWidget(self.info_button, 0, 8)
         LBgrid.setAlignment(self.info_button, Qt.AlignRight)
         #  Add to (first) vertical layout
         layV1 = QtWidgets.QVBoxLayout()
         #  Add Widgets to the layout
         layV1.addWidget(toolbar)
         layV1.addWidget(self.canvas)
+        layV1.addWidget(self.waterfall_canvas)
+        layV1.addWidget(self.peaks_canvas)
         layV1.addLayout(LBgrid)
 
         #  Add first vertical layout to the main horizontal one
@@ -184,6 +259,19 @@ class MainWindow(QtWidgets.QMainWindow):
         self.LEdeltime = QLineEdit()
         self.LEmeatime = QLineEdit()
         self.LEskip = QLineEdit()
+        self.LErois = QLineEdit()
+        self.LErois.setPlaceholderText("e.g. 500-600, 700-750")
+        self.LErois.setToolTip("Wavelength ranges whose peak position, FWHM and area are tracked while measuring")
+        self.CBtrigger = QComboBox()
+        self.CBtrigger.addItems(list(TRIGGER_CHOICES))
+        self.CBtrigger.setToolTip("Arm the measurement and start recording when this condition is met")
+        self.LEtrigroi = QLineEdit()
+        self.LEtrigroi.setPlaceholderText("e.g. 500-600")
+        self.LEtrigroi.setToolTip("Wavelength range whose mean intensity is checked")
+        self.LEtrigvalue = QLineEdit()
+        self.LEtrigvalue.setToolTip("Intensity level, rate of change per second, trigger file or UDP port")
+        self.LEpretrig = QLineEdit()
+        self.LEpretrig.setToolTip("Time before the trigger kept in the measurement (added to its length)")
 
         self.Binttime = QToolButton()
         self.Binttime.setText("SET")
@@ -203,18 +291,33 @@ class MainWindow(QtWidgets.QMainWindow):
         LTsetup.addWidget(self.LEmeatime, 4, 1)
         LTsetup.addWidget(QLabel("Skip # measurements"), 5, 0)
         LTsetup.addWidget(self.LEskip, 5, 1)
-        LTsetup.addWidget(QLabel(" "), 6, 0)
+        LTsetup.addWidget(QLabel("Track peaks (nm)"), 6, 0)
+        LTsetup.addWidget(self.LErois, 6, 1)
+        LTsetup.addWidget(QLabel("Start on"), 7, 0)
+        LTsetup.addWidget(self.CBtrigger, 7, 1)
+        LTsetup.addWidget(QLabel("Trigger range (nm)"), 8, 0)
+        LTsetup.addWidget(self.LEtrigroi, 8, 1)
+        LTsetup.addWidget(QLabel("Trigger value"), 9, 0)
+        LTsetup.addWidget(self.LEtrigvalue, 9, 1)
+        LTsetup.addWidget(QLabel("Pre-trigger (s)"), 10, 0)
+        LTsetup.addWidget(self.LEpretrig, 10, 1)
+        LTsetup.addWidget(QLabel(" "), 11, 0)
 
         #  Set defaults
         self.LEinttime.setText("0.2")
         self.LEdeltime.setText("0")
         self.LEmeatime.setText("10")
         self.LEskip.setText("0")
+        self.LEpretrig.setText("1")
+        self.update_trigger_fields()
 
         #  Third set of setup values
         self.LEcurave = QLineEdit()
         self.LEcurave.setText("5")
         # self.LEcurave.setMaximumWidth(160)
+        self.CBrejection = QComboBox()
+        self.CBrejection.addItems(["None", "Sigma clipping", "Median of 5"])
+        self.CBrejection.setToolTip("Reject cosmic ray spikes while averaging dark/bright spectra")
         self.BBrightMeas = QPushButton("(Measure Dark First)")
         self.BBrightMeas.setStyleSheet("color : gray;")
         self.BBrightMeas.setEnabled(False)
@@ -237,7 +340,16 @@ class MainWindow(QtWidgets.QMainWindow):
         Lsetup.addWidget(self.BDarkDel, 2, 2)
         Lsetup.addWidget(QLabel("Curves to average"), 3, 0)
         Lsetup.addWidget(self.LEcurave, 3, 1)
-        Lsetup.addWidget(QLabel(" "), 4, 0)
+        Lsetup.addWidget(QLabel("Spike rejection"), 4, 0)
+        Lsetup.addWidget(self.CBrejection, 4, 1)
+        self.BDarkLibrary = QCheckBox("Reuse saved darks")
+        self.BDarkLibrary.setChecked(True)
+        self.BDarkLibrary.setToolTip("Load the dark saved for this spectrometer and integration time, if any")
+        self.BDarkInterp = QCheckBox("Interpolate")
+        self.BDarkInterp.setToolTip("Interpolate between saved darks of neighbouring integration times")
+        Lsetup.addWidget(self.BDarkLibrary, 5, 0)
+        Lsetup.addWidget(self.BDarkInterp, 5, 1)
+        Lsetup.addWidget(QLabel(" "), 6, 0)
 
         #  Four set of setup values
         LGlabels = QGridLayout()
@@ -373,6 +485,27 @@ class MainWindow(QtWidgets.QMainWindow):
         self.BBrightDel.clicked.connect(self.delete_bright_measurement)
         self.BDarkDel.clicked.connect(self.delete_dark_measurement)
         self.info_button.clicked.connect(self.show_info)
+        self.BWaterfall.stateChanged.connect(self.toggle_waterfall)
+        self.CBtrigger.currentTextChanged.connect(self.update_trigger_fields)
+
+    @pyqtSlot()
+    def toggle_waterfall(self):
+        """
+        Shows or hides the live waterfall panel
+        """
+        self.waterfall_canvas.setVisible(self.BWaterfall.isChecked())
+
+    @pyqtSlot()
+    def update_trigger_fields(self):
+        """
+        Enables the trigger fields the selected start condition uses
+        """
+        kind = TRIGGER_CHOICES[self.CBtrigger.currentText()]
+        self.LEtrigroi.setEnabled(kind in ("above", "below", "rate"))
+        self.LEtrigvalue.setEnabled(kind is not None)
+        self.LEpretrig.setEnabled(kind is not None)
+        self.LEtrigvalue.setPlaceholderText({"above": "intensity", "below": "intensity", "rate": "intensity / s",
+                                             "file": "path of the file", "udp": "port"}.get(kind, ""))
 
     def show_info(self):
         dialog = InfoDialog(self)
@@ -454,6 +587,7 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         self.create_folder(False)
         self.gather_all_metadata()
+        import pandas as pd  # Only needed here, loading it slows down the startup
         metadata = pd.DataFrame.from_dict(self.meta_dict, orient='index')
         metadata.to_csv(self.folder + "metadata.csv", header=False)
         self.statusBar().showMessage("Metadata file saved successfully", 5000)
@@ -465,6 +599,7 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         folder = self.LEfolder.text()
         metafile = QtWidgets.QFileDialog.getOpenFileName(self, "Choose your metadata file", folder)
+        import pandas as pd
         metadata = pd.read_csv(metafile[0], header=None, index_col=0).T
         labels = self.setup_labs + self.exp_labels + self.photoLu_labels + self.spinCo_labels
         objects = self.setup_vals + self.exp_vars + self.photoLu_vars + self.spinCo_vars
@@ -509,6 +644,14 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.meta_dict["Dark measurement"] = self.is_dark_data
         self.meta_dict["Bright measurement"] = self.is_bright_data
+        self.meta_dict["Spike rejection"] = self.CBrejection.currentText()
+        self.meta_dict["Dark source"] = self.BDarkMeas.text() if self.is_dark_data else None
+        self.meta_dict["Peak ROIs (nm)"] = self.LErois.text()
+        self.meta_dict["Start on"] = self.CBtrigger.currentText()
+        if TRIGGER_CHOICES[self.CBtrigger.currentText()] is not None:
+            self.meta_dict["Trigger range (nm)"] = self.LEtrigroi.text()
+            self.meta_dict["Trigger value"] = self.LEtrigvalue.text()
+            self.meta_dict["Pre-trigger (s)"] = self.LEpretrig.text()
 
         self.meta_dict[
             "Comments"] = self.com_labels.toPlainText()  #  This field has a diffferent format than the others
@@ -559,17 +702,71 @@ class MainWindow(QtWidgets.QMainWindow):
             self.LEinttime.setText(str(inttime))
         self.update_number_of_frames()  # Update frames label
         self.current_inttime_ms = inttime * 1000
-        self.process_queue.put(inttime)
+        self.requested_setting_id = self.send_command(SpectroCommand.SET_INTTIME, inttime)
+        if hasattr(self, "plot_worker"):
+            self.plot_worker.set_refresh_interval(self.current_inttime_ms)
 
-    def wait_until_inttime_in_sync(self):
+    def send_command(self, name, value=None) -> int:
         """
-        Delays measurement attempts in case live integration time does not match the chosen one
+        Sends a command to the spectrometer process, which confirms it through the emitter (command_acknowledged)
+        @param name: one of the SpectroCommand names
+        @param value: argument of the command
+        @return: id of the command, also carried by its acknowledgement
         """
-        self.statusBar().showMessage('Waiting for integration times to be in sync.\tDo not click anything.')
-        while not abs(self.current_inttime_ms - self.plot_worker.current_mean_frequency_ms) <= 10:  # 10ms tolerance
-            QApplication.processEvents()
-            pass
-        self.statusBar().showMessage('Integration times are synced.')
+        self.command_counter += 1
+        self.process_queue.put(SpectroCommand(name, value, self.command_counter))
+        return self.command_counter
+
+    @pyqtSlot(object)
+    def command_acknowledged(self, ack):
+        """
+        Keeps track of the integration time applied by the spectrometer process,
+        and runs the actions that were waiting for it
+        @param ack: SpectroAck
+        """
+        if ack.name != SpectroCommand.SET_INTTIME:
+            return
+        self.active_setting_id = ack.command_id
+        if ack.command_id != self.requested_setting_id:
+            return  # Superseded by a newer request
+        if round(ack.value * 1000000) != round(self.current_inttime_ms * 1000):  # Clamped to the spectrometer limits
+            self.statusBar().showMessage("Integration time limited to {:g} s by the spectrometer".format(ack.value),
+                                         5000)
+            self.current_inttime_ms = ack.value * 1000
+            self.LEinttime.setText("{:g}".format(ack.value))
+            self.update_number_of_frames()
+            if hasattr(self, "plot_worker"):
+                self.plot_worker.set_refresh_interval(self.current_inttime_ms)
+        self.load_library_dark()
+        self.inttime_sync_timer.stop()
+        callbacks, self.inttime_callbacks = self.inttime_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def when_inttime_synced(self, callback, timeout_ms=5000):
+        """
+        Runs callback once the spectrometer confirms the requested integration time.
+        Every reading received afterwards carries setting_id == self.active_setting_id
+        @param callback: function without arguments
+        @param timeout_ms: time to wait on top of one integration time before giving up
+        """
+        if self.active_setting_id == self.requested_setting_id:
+            callback()
+            return
+        self.statusBar().showMessage('Waiting for the integration time to be applied')
+        self.inttime_callbacks.append(callback)
+        self.inttime_sync_timer.start(int(timeout_ms + 2 * self.current_inttime_ms))
+
+    @pyqtSlot()
+    def inttime_sync_timeout(self):
+        """
+        The spectrometer did not confirm the integration time in time: drops the waiting actions
+        """
+        self.inttime_callbacks = []
+        self.statusBar().showMessage('Spectrometer did not confirm the integration time, try again', 5000)
+        self.BDarkMeas.setEnabled(True)
+        self.BBrightMeas.setEnabled(self.is_dark_data)  # Bright spectra need a dark one
+        self.BStart.setEnabled(True)
 
     def toggle_widgets(self, status):
         """
@@ -580,7 +777,7 @@ class MainWindow(QtWidgets.QMainWindow):
         wi_dis = [self.LEinttime, self.Binttime, self.SBinttime,  # self.BStart,
                   self.LEsample, self.LEuser, self.LEfolder, self.BBrightMeas,
                   self.BDarkMeas, self.LEdeltime, self.LEmeatime, self.Bfolder,
-                  self.Bpath]
+                  self.Bpath, self.LErois, self.CBtrigger, self.LEtrigroi, self.LEtrigvalue, self.LEpretrig]
         for wd in wi_dis:
             if status:
                 wd.setEnabled(False)
@@ -594,46 +791,100 @@ class MainWindow(QtWidgets.QMainWindow):
     @pyqtSlot(object, object, object)
     def save_data(self, spectra_raw_array, spectra_meas_array, time_meas_array):
         """
-        Collects all relevant data & metadata and saves it into a csv file
+        Collects all relevant data & metadata and hands it to the export thread, which saves it into a csv file
         @param spectra_raw_array: List containing spectra data as measured
         @param spectra_meas_array: List containing spectra data as calculated
         @param time_meas_array:  List containing measurement times
         """
+        if not len(time_meas_array):  # Stopped while armed
+            if self.journal_path is not None:
+                journal.discard(self.journal_path)
+                self.journal_path = None
+            self.peak_tracker = None
+            self.statusBar().showMessage("Not triggered, nothing was recorded", 5000)
+            return
+        job = self.make_export_job(spectra_raw_array, spectra_meas_array, time_meas_array)
+        job.meta_dict.update(self.frame_timing.metadata())
+        if self.journal_path is not None:
+            job.journal_path = self.journal_path
+            self.journal_path = None
+        if self.monitor is not None:
+            for extension in (".json", ".csv"):
+                self.monitor.save(job.folder + job.sample + "_latency" + extension)
+        if self.peak_tracker is not None:
+            self.peak_tracker.save(job.folder + job.sample + "_peaks.csv")
+            self.peak_tracker = None
+        self.request_export(job)
+
+    def make_export_job(self, spectra_raw_array=None, spectra_meas_array=None, time_meas_array=None):
+        """
+        Collects metadata and saving options selected in the GUI
+        @return: ExportJob for the given arrays
+        """
         self.gather_all_metadata()
-        metadata = pd.DataFrame.from_dict(self.meta_dict, orient='index')
-        wave = pd.DataFrame({"Wavelength (nm)": self.xdata})
-
-        time_meas_array = np.round(time_meas_array,4)
-
-        if self.Braw.isChecked():
-            PLspecR = pd.DataFrame(spectra_raw_array.T, columns=time_meas_array)
-            if self.is_dark_data:
-                dark = pd.DataFrame({"Dark spectra": self.dark_mean})
-            if self.is_bright_data:
-                bright = pd.DataFrame({"Bright spectra": self.bright_mean})
-
-            if self.is_dark_data and self.is_bright_data:
-                spectral_data = pd.concat([wave, dark, bright, PLspecR], axis=1, join="inner")
-            elif self.is_dark_data:
-                spectral_data = pd.concat([wave, dark, PLspecR], axis=1, join="inner")
-            elif self.is_bright_data:
-                spectral_data = pd.concat([wave, bright, PLspecR], axis=1, join="inner")
-            else:
-                spectral_data = pd.concat([wave, PLspecR], axis=1, join="inner")
-        else:
-            spectra = spectra_meas_array
-            PLspec = pd.DataFrame(spectra.T, columns=time_meas_array)
-            spectral_data = pd.concat([wave, PLspec], axis=1, join="inner")
-
-        #  Remove all unused columns and simplify
-        spectral_data = spectral_data.dropna(axis=1, how="all")
-        spectral_data = spectral_data.round(1)
-        filename = self.folder + self.sample + "_PL_measurement.csv"
-        metadata.to_csv(filename, header=False)
-        spectral_data.to_csv(filename, mode="a", index=False)
-        if self.BSavePlot.isChecked():
-            self.make_heatplot(spectra_raw_array, spectra_meas_array, time_meas_array)
-        self.statusBar().showMessage("Data saved successfully", 5000)
+        return ExportJob(folder=self.folder,
+                         sample=self.sample,
+                         meta_dict=self.meta_dict,
+                         xdata=self.xdata,
+                         spectra_raw_array=spectra_raw_array,
+                         spectra_meas_array=spectra_meas_array,
+                         time_meas_array=time_meas_array,
+                         dark_mean=self.dark_mean,
+                         bright_mean=self.bright_mean,
+                         dark_noise=self.dark_noise,
+                         bright_noise=self.bright_noise,
+                         is_dark_data=self.is_dark_data,
+                         is_bright_data=self.is_bright_data,
+                         is_show_raw=self.Braw.isChecked(),
+                         is_heatplot=self.BSavePlot.isChecked(),
+                         file_format=self.CBformat.currentText(),
+                         is_compressed=self.BCompress.isChecked())
+
+    def request_export(self, job):
+        """
+        Queues a measurement to be saved by the export thread
+        @param job: ExportJob
+        """
+        self.exports_pending += 1
+        self.export_requested.emit(job)
+
+    @pyqtSlot()
+    def recover_measurements(self):
+        """
+        Offers to save measurements whose journal was left behind by a crash
+        """
+        paths = journal.find_journals()
+        if not paths:
+            return
+        reply = QMessageBox.question(self, 'Recover measurements',
+                                     str(len(paths)) + ' measurement(s) were interrupted before being saved.\n'
+                                     'Recover them now? (Discard deletes them)',
+                                     QMessageBox.Yes | QMessageBox.No | QMessageBox.Discard, QMessageBox.Yes)
+        for path in paths:
+            if reply == QMessageBox.Discard:
+                journal.discard(path)
+            elif reply == QMessageBox.Yes:
+                try:
+                    job = journal.recover(path)
+                except Exception as error:
+                    self.statusBar().showMessage("Journal " + str(path) + " could not be read: " + str(error), 10000)
+                    continue
+                if len(job.time_meas_array) == 0:
+                    journal.discard(path)
+                    continue
+                os.makedirs(job.folder, exist_ok=True)
+                self.request_export(job)
+
+    @pyqtSlot(str)
+    def after_export(self, message):
+        """
+        Displays the outcome of a background export, and closes the app if it was waiting for it
+        @param message: text for the status bar
+        """
+        self.exports_pending -= 1
+        self.statusBar().showMessage(message, 5000)
+        if self.is_close_requested and self.exports_pending == 0:
+            self.close()
 
     @pyqtSlot()
     def dark_measurement(self):
@@ -641,12 +892,17 @@ class MainWindow(QtWidgets.QMainWindow):
         Tasks when measuring a dark spectra
         """
         self.BDarkMeas.setEnabled(False)
-        self.wait_until_inttime_in_sync()
+        self.when_inttime_synced(self.start_dark_measurement)
+
+    def start_dark_measurement(self):
+        """
+        Starts gathering dark spectra, once the integration time is applied
+        """
         self.average_cycles = int(self.LEcurave.text())  #  Read number in GUI
+        self.warn_rejection()
         self.BDarkMeas.setStyleSheet("color : yellow;")
         self.BDarkMeas.setText("Measuring...")
-        self.brightdark_meas_worker = DarkBrightGatherer(self.average_cycles, self.array_size)
-        self.emitter.ui_data_available.connect(self.brightdark_meas_worker.gathering_counts)
+        self.brightdark_meas_worker = self.reference_worker()
         self.brightdark_meas_worker.result.connect(self.after_dark_measurement)
         self.brightdark_meas_worker.moveToThread(self.brightdark_meas_thread)
         self.brightdark_meas_thread.start()
@@ -654,23 +910,107 @@ class MainWindow(QtWidgets.QMainWindow):
         self.BBrightMeas.setText("Measure")
         self.BBrightMeas.setStyleSheet("color : green;")
 
-    @pyqtSlot(object)
-    def after_dark_measurement(self, dark_mean):
+    def reference_worker(self):
         """
-        Exit tasks after dark spectra has been collected
-        @param dark_mean: List containing the dark spectra
+        @return: DarkBrightGatherer fed by the emitter, or its stand-in when the processing process averages
+        """
+        if self.processing_queue is not None:
+            worker = RemoteReferenceGatherer(self.processing_queue, self.average_cycles, self.spike_rejection(),
+                                             self.active_setting_id)
+            self.emitter.processing_message.connect(worker.handle_message)
+            return worker
+        worker = DarkBrightGatherer(self.average_cycles, self.array_size, rejection=self.spike_rejection(),
+                                    setting_id=self.active_setting_id, monitor=self.monitor)
+        self.emitter.connect_consumer(worker.gathering_counts, worker.gathering_block)
+        return worker
+
+    def release_reference_worker(self):
         """
-        self.emitter.ui_data_available.disconnect(self.brightdark_meas_worker.gathering_counts)
+        Disconnects the reference worker from the emitter and stops its thread
+        """
+        if self.processing_queue is not None:
+            self.emitter.processing_message.disconnect(self.brightdark_meas_worker.handle_message)
+        else:
+            self.emitter.disconnect_consumer(self.brightdark_meas_worker.gathering_counts,
+                                             self.brightdark_meas_worker.gathering_block)
         self.brightdark_meas_thread.quit()
         self.brightdark_meas_thread.wait()
+
+    def spike_rejection(self) -> str:
+        """
+        @return: cosmic ray rejection selected in the GUI, as understood by utils.ReferenceAccumulator
+        """
+        return {"None": "none", "Sigma clipping": "sigma", "Median of 5": "median"}[self.CBrejection.currentText()]
+
+    def warn_rejection(self):
+        """
+        Spike rejection compares each curve with the others, which needs a few of them
+        """
+        if self.spike_rejection() != "none" and self.average_cycles < utils.ReferenceAccumulator.MIN_ROBUST_FRAMES:
+            self.statusBar().showMessage("Spike rejection needs at least {} curves to average, none will be rejected"
+                                         .format(utils.ReferenceAccumulator.MIN_ROBUST_FRAMES), 5000)
+
+    def rejection_message(self) -> str:
+        rejected = self.brightdark_meas_worker.rejected
+        return " ({} spike values rejected)".format(rejected) if rejected else ""
+
+    @pyqtSlot(object, object)
+    def after_dark_measurement(self, dark_mean, dark_noise):
+        """
+        Exit tasks after dark spectra has been collected
+        @param dark_mean: List containing the dark spectra
+        @param dark_noise: per-pixel standard deviation of the dark spectra
+        """
+        self.release_reference_worker()
         self.dark_mean = dark_mean
+        self.dark_noise = dark_noise
+        self.dark_inttime_ms = self.current_inttime_ms
         self.is_dark_data = True
         self.BDarkMeas.setStyleSheet("color : green;")
         self.BDarkMeas.setText("Measured")
-        self.statusBar().showMessage('Measurement of dark spectra completed', 5000)
+        self.statusBar().showMessage('Measurement of dark spectra completed' + self.rejection_message(), 5000)
         self.BDarkMeas.setEnabled(True)
+        if self.is_spectrometer:  # Demo spectra would be taken for the dark of the connected spectrometer
+            try:
+                self.dark_library.save(self.serial_number, self.current_inttime_ms / 1000, dark_mean, dark_noise)
+            except OSError as error:
+                self.statusBar().showMessage("Dark spectra could not be saved to the library: " + str(error), 5000)
         self.refresh_plot()
 
+    def load_library_dark(self):
+        """
+        Uses the dark saved for the applied integration time (or interpolated from neighbouring ones), if enabled.
+        Without one, a dark taken at another integration time is dropped
+        """
+        if not self.BDarkLibrary.isChecked() or self.is_measuring:
+            return
+        dark = self.dark_library.lookup(self.serial_number, self.current_inttime_ms / 1000,
+                                        self.BDarkInterp.isChecked())
+        if dark is None or len(dark.mean) != self.array_size:
+            if self.is_dark_data and abs(self.dark_inttime_ms - self.current_inttime_ms) > 1e-3:
+                self.delete_dark_measurement()
+                self.BDarkMeas.setText("Measure (stale)")
+                self.statusBar().showMessage("No dark spectra in the library for this integration time, "
+                                             "measure them again", 5000)
+                if hasattr(self, "plot_worker"):
+                    self.refresh_plot()
+            return
+        self.dark_mean = dark.mean
+        self.dark_noise = dark.noise
+        self.dark_inttime_ms = self.current_inttime_ms
+        self.is_dark_data = True
+        self.BDarkMeas.setStyleSheet("color : green;")
+        self.BDarkMeas.setText("Interpolated" if dark.is_interpolated else "From library")
+        self.BBrightMeas.setEnabled(True)
+        if not self.is_bright_data:
+            self.BBrightMeas.setText("Measure")
+            self.BBrightMeas.setStyleSheet("color : green;")
+        self.statusBar().showMessage("Dark spectra loaded from library ({}, {})".format(
+            strftime("%d.%m.%Y %H:%M", localtime(dark.created)),
+            "interpolated" if dark.is_interpolated else "{:g} s".format(dark.inttime)), 5000)
+        if hasattr(self, "plot_worker"):
+            self.refresh_plot()
+
     @pyqtSlot()
     def delete_dark_measurement(self):
         """
@@ -678,6 +1018,7 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         self.dark_mean = None
         self.dark_mean = np.ones(len(self.xdata))
+        self.dark_noise = None
         self.is_dark_data = False
         self.BDarkMeas.setStyleSheet("color : black;")
         self.BDarkMeas.setText("Measure (deleted)")
@@ -688,32 +1029,37 @@ class MainWindow(QtWidgets.QMainWindow):
         Tasks when measuring a bright spectra
         """
         self.BBrightMeas.setEnabled(False)
-        self.wait_until_inttime_in_sync()
+        self.when_inttime_synced(self.start_bright_measurement)
+
+    def start_bright_measurement(self):
+        """
+        Starts gathering bright spectra, once the integration time is applied
+        """
         self.average_cycles = int(self.LEcurave.text())
+        self.warn_rejection()
         self.BBrightMeas.setStyleSheet("color : yellow;")
         self.BBrightMeas.setText("Measuring...")
-        self.brightdark_meas_worker = DarkBrightGatherer(self.average_cycles, self.array_size)
-        self.emitter.ui_data_available.connect(self.brightdark_meas_worker.gathering_counts)
+        self.brightdark_meas_worker = self.reference_worker()
         self.brightdark_meas_worker.result.connect(self.after_bright_measurement)
         self.brightdark_meas_worker.moveToThread(self.brightdark_meas_thread)
         self.brightdark_meas_thread.start()
         self.Brange.setChecked(True)
 
-    @pyqtSlot(object)
-    def after_bright_measurement(self, bright_mean):
+    @pyqtSlot(object, object)
+    def after_bright_measurement(self, bright_mean, bright_noise):
         """
         Exit tasks after bright spectra has been collected
         @param bright_mean: List containing the bright spectra
+        @param bright_noise: per-pixel standard deviation of the bright spectra
         """
-        self.emitter.ui_data_available.disconnect(self.brightdark_meas_worker.gathering_counts)
-        self.brightdark_meas_thread.quit()
-        self.brightdark_meas_thread.wait()
+        self.release_reference_worker()
         self.bright_mean = bright_mean
+        self.bright_noise = bright_noise
         self.is_bright_data = True
         self.BBrightMeas.setEnabled(True)
         self.BBrightMeas.setStyleSheet("color : green;")
         self.BBrightMeas.setText("Measured")
-        self.statusBar().showMessage('Measurement of bright spectra completed', 5000)
+        self.statusBar().showMessage('Measurement of bright spectra completed' + self.rejection_message(), 5000)
         self.refresh_plot()
 
     @pyqtSlot()
@@ -722,6 +1068,7 @@ class MainWindow(QtWidgets.QMainWindow):
         Action of deleting bright spectra
         """
         self.bright_mean = np.ones(len(self.xdata))
+        self.bright_noise = None
         self.is_bright_data = False
         self.BBrightMeas.setStyleSheet("color : black;")
         self.BBrightMeas.setText("Measure (deleted)")
@@ -733,6 +1080,22 @@ class MainWindow(QtWidgets.QMainWindow):
         Actions to start collecting spectra
         """
         if not self.is_measuring:
+            try:
+                self.rois = parse_rois(self.LErois.text())
+            except ValueError:
+                self.statusBar().showMessage("Peak regions must look like 500-600, 700-750", 5000)
+                return
+            kind = TRIGGER_CHOICES[self.CBtrigger.currentText()]
+            self.trigger = None
+            if kind is not None:
+                try:
+                    trigger_rois = parse_rois(self.LEtrigroi.text())
+                    self.trigger = make_trigger(kind, self.xdata, trigger_rois[0] if trigger_rois else None,
+                                                self.LEtrigvalue.text())
+                    self.pre_trigger = max(float(self.LEpretrig.text()), 0)
+                except ValueError as error:
+                    self.statusBar().showMessage("Invalid trigger settings: {}".format(error), 5000)
+                    return
             self.delay = float(self.LEdeltime.text())
             self.LEskip.setText(utils.LEskip_positive_number(self.LEskip.text()))
             self.timer = QTimer()
@@ -740,12 +1103,16 @@ class MainWindow(QtWidgets.QMainWindow):
             self.timer.setInterval(int(self.timer_interval * 1000))
             self.timer.timeout.connect(self.delayed_start)
             self.timer.start()
+        elif self.processing_queue is not None:
+            self.meas_worker.stop()  # The frames gathered so far arrive through its result, as at the end
         else:
+            self.emitter.disconnect_consumer(self.meas_worker.measure, self.meas_worker.measure_block)
             self.spec_thread.quit()
+            self.spec_thread.wait()  # Let the gatherer finish the frame it is storing
+            self.meas_worker.is_finished = True
             self.is_measuring = False
             self.toggle_widgets(False)
-            self.save_data(self.meas_worker.spectra_raw_array, self.meas_worker.spectra_meas_array,
-                           self.meas_worker.time_meas_array)
+            self.save_data(*self.meas_worker.collected_arrays())
 
     def delayed_start(self):
         """
@@ -754,32 +1121,92 @@ class MainWindow(QtWidgets.QMainWindow):
         self.LAelapse.setStyleSheet("color :red;")
         self.LAelapse.setText("00:{:02.2f}".format(float(round(self.delay, 2))))
         self.delay = self.delay - self.timer_interval
-        skip = int(self.LEskip.text())
         if self.delay <= 0:
             self.timer.stop()
             self.LAelapse.setStyleSheet("color :black;")
             self.LAelapse.setText("00:00")
             self.set_integration_time()
-            self.wait_until_inttime_in_sync()
-            self.start_time = time()
-            self.meas_worker = SpectraGatherer(total_frames=self.total_frames,
+            self.BStart.setEnabled(False)
+            self.when_inttime_synced(self.start_measurement)
+
+    def start_measurement(self):
+        """
+        Starts gathering spectra, once the integration time is applied
+        """
+        self.BStart.setEnabled(True)
+        skip = int(self.LEskip.text())
+        self.start_time = time()
+        if self.monitor is not None:
+            self.monitor.reset()  # Statistics are saved per measurement
+        self.frame_timing.reset(self.current_inttime_ms / 1000)
+        self.create_folder(True)
+        stream_prefix = self.folder + self.sample + "_stream" if self.BStream.isChecked() else None
+        self.peak_tracker = PeakTracker(self.xdata, self.rois) if self.rois else None
+        pre_frames = 0
+        if self.trigger is not None:
+            pre_frames = int(np.ceil(self.pre_trigger / (self.current_inttime_ms / 1000)))
+            self.statusBar().showMessage("Armed, waiting for the trigger")
+        self.frames_to_record = self.total_frames + pre_frames
+        self.is_armed = self.trigger is not None
+        if self.processing_queue is not None:
+            journal_path = journal.new_path(self.sample)
+            plan = MeasurementPlan(total_frames=self.frames_to_record,
+                                   skip=skip,
+                                   is_dark_data=self.is_dark_data,
+                                   is_bright_data=self.is_bright_data,
+                                   dark_mean=self.dark_mean,
+                                   bright_mean=self.bright_mean,
+                                   stream_prefix=stream_prefix,
+                                   journal_job=self.make_export_job() if self.BJournal.isChecked() else None,
+                                   journal_path=str(journal_path),
+                                   setting_id=self.active_setting_id,
+                                   nominal_period=self.current_inttime_ms / 1000,
+                                   is_frame_gathered=self.BWaterfall.isChecked(),
+                                   rois=self.rois,
+                                   trigger=self.trigger,
+                                   pre_frames=pre_frames)
+            self.journal_path = plan.journal_path if self.BJournal.isChecked() else None
+            self.meas_worker = RemoteGatherer(self.processing_queue, plan, timing=self.frame_timing,
+                                              tracker=self.peak_tracker)
+            self.emitter.processing_message.connect(self.meas_worker.handle_message)
+        else:
+            measurement_journal = None
+            if self.BJournal.isChecked():
+                measurement_journal = journal.MeasurementJournal(self.make_export_job(), self.array_size,
+                                                                 raw_dtype=RAW_DTYPE, meas_dtype=MEAS_DTYPE)
+                self.journal_path = str(measurement_journal.path)
+            self.meas_worker = SpectraGatherer(total_frames=self.frames_to_record,
                                                array_size=self.array_size,
                                                skip=skip,
                                                is_dark_data=self.is_dark_data,
                                                is_bright_data=self.is_bright_data,
                                                dark_mean=self.dark_mean,
-                                               bright_mean=self.bright_mean)
-            self.emitter.ui_data_available.connect(self.meas_worker.measure)
-            self.meas_worker.moveToThread(self.spec_thread)
-            self.meas_worker.finished.connect(self.spec_thread.quit)
-            self.meas_worker.finished.connect(self.meas_worker.deleteLater)
-            self.meas_worker.progress.connect(self.during_measurement)
-            self.meas_worker.result.connect(self.save_data)
-            self.spec_thread.finished.connect(self.after_measurement)
-            self.is_measuring = True
-            self.toggle_widgets(True)
-            self.create_folder(True)
-            self.spec_thread.start(QThread.HighPriority)
+                                               bright_mean=self.bright_mean,
+                                               stream_prefix=stream_prefix,
+                                               journal=measurement_journal,
+                                               setting_id=self.active_setting_id,
+                                               monitor=self.monitor,
+                                               timing=self.frame_timing,
+                                               tracker=self.peak_tracker,
+                                               arm=None if self.trigger is None else
+                                               TriggerArm(self.trigger, pre_frames, self.array_size, RAW_DTYPE))
+            self.emitter.connect_consumer(self.meas_worker.measure, self.meas_worker.measure_block)
+        if self.BWaterfall.isChecked():
+            self.waterfall_worker.reset()
+            self.meas_worker.frame_gathered.connect(self.waterfall_worker.add_frame)
+        self.peaks_canvas.setVisible(bool(self.rois))
+        if self.rois:
+            self.peak_plot_worker.reset(self.xdata, self.rois)
+            self.meas_worker.peaks_gathered.connect(self.peak_plot_worker.add_peaks)
+        self.meas_worker.moveToThread(self.spec_thread)
+        self.meas_worker.finished.connect(self.spec_thread.quit)
+        self.meas_worker.finished.connect(self.meas_worker.deleteLater)
+        self.meas_worker.progress.connect(self.during_measurement)
+        self.meas_worker.result.connect(self.save_data)
+        self.spec_thread.finished.connect(self.after_measurement)
+        self.is_measuring = True
+        self.toggle_widgets(True)
+        self.spec_thread.start(QThread.HighPriority)
 
     @pyqtSlot(int)
     def during_measurement(self, counter):
@@ -787,7 +1214,11 @@ class MainWindow(QtWidgets.QMainWindow):
         To update values in GUI
         """
         #  This updates the number of measurements that will be made
-        self.LAframes.setText(str(counter) + "/" + str(self.total_frames))
+        if self.is_armed and counter:
+            self.is_armed = False
+            self.start_time = time()  # Elapsed time counts from the trigger
+            self.statusBar().showMessage("Triggered", 5000)
+        self.LAframes.setText(str(counter) + "/" + str(self.frames_to_record))
         self.elapsed_time = time() - self.start_time
         minute, second = divmod(self.elapsed_time, 60)
         self.LAelapse.setText("{:02}:{:02}".format(int(minute), int(second)))
@@ -799,45 +1230,7 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         self.toggle_widgets(False)
         self.is_measuring = False
-
-    def make_heatplot(self, spectra_raw_array, spectra_meas_array, time_meas_array):
-        """
-        Triggered at the End
-        """
-        matplotlib.use('Agg')
-        plt.ioff()
-        fig = plt.figure(figsize=[8, 6])
-        ax1 = fig.add_subplot(1, 1, 1)
-        if self.Braw.isChecked():
-            time = time_meas_array
-            heatplot = spectra_raw_array.T
-            waveleng = self.xdata
-        else:
-            time = time_meas_array
-            heatplot = spectra_meas_array.T[215:1455]
-            waveleng = self.xdata[215:1455]
-
-        time = time[~np.isnan(time)]
-        waveleng = waveleng[~np.isnan(waveleng)]
-        heatplot = heatplot[:, :time.shape[0]]
-
-        ax1.set_title("PL spectra")
-        ax1.set_xlabel("Time(seconds)")
-        ax1.set_ylabel("Wavelength (nm)")
-
-        waveLen = len(waveleng)
-        PLmin = np.min(waveleng)
-        PLmax = np.max(waveleng)
-
-        #  fix axis ticks so they match the data (else they are array positions)
-        ax1.set_yticks(np.linspace(0, waveLen, 8))
-        ax1.set_yticklabels(np.linspace(PLmin, PLmax, 8).astype(int))
-        ax1.set_xticks(np.linspace(0, len(time), 8))
-        ax1.set_xticklabels(np.around(np.linspace(0, np.max(time), 8), decimals=1))
-        ax1.pcolorfast(heatplot)
-        fig.savefig(
-            self.folder + "0_preview_" + self.sample + "_heatplot.png")
-        plt.close()  # close the figure window
+        self.is_armed = False
 
     def send_to_Qthread(self):
         """
@@ -850,22 +1243,38 @@ class MainWindow(QtWidgets.QMainWindow):
             bright_mean=self.bright_mean,
             canvas=self.canvas,
             xdata=self.xdata,
-            is_spectrometer=self.is_spectrometer
+            is_spectrometer=self.is_spectrometer,
+            refresh_interval_ms=self.current_inttime_ms,
+            monitor=self.monitor
         )
-        self.emitter.ui_data_available.connect(self.plot_worker.plot_spectra)
+        self.emitter.connect_consumer(self.plot_worker.plot_spectra, self.plot_worker.plot_block)
+        if self.processing_queue is not None:
+            self.plot_worker.view_changed.connect(
+                lambda view: self.processing_queue.put(ProcessingCommand(ProcessingCommand.VIEW, view)))
+            self.plot_worker.update_decimation()
         self.plot_worker.moveToThread(self.plot_thread)
         self.plot_thread.start()
 
+        self.waterfall_worker = WaterfallWorker(canvas=self.waterfall_canvas, xdata=self.xdata)
+        self.peak_plot_worker = PeakPlotWorker(canvas=self.peaks_canvas)
+
+        self.export_worker = ExportWorker()
+        self.export_requested.connect(self.export_worker.export)
+        self.export_worker.progress.connect(self.statusBar().showMessage)
+        self.export_worker.finished.connect(self.after_export)
+        self.export_worker.moveToThread(self.export_thread)
+        self.export_thread.start(QThread.LowPriority)
+
     @pyqtSlot()
     def refresh_plot(self):
         """
         Resets status of plot. Mainly to remove legend and frozen curves after desactivating is_show_raw
         """
         self.plot_worker.is_show_raw = self.Braw.isChecked()
-        self.plot_worker.is_dark_data = self.is_dark_data
-        self.plot_worker.is_bright_data = self.is_bright_data
-        self.plot_worker.dark_mean = self.dark_mean
-        self.plot_worker.bright_mean = self.bright_mean
+        self.plot_worker.set_references(self.is_dark_data, self.is_bright_data, self.dark_mean, self.bright_mean)
+        if self.processing_queue is not None:
+            self.processing_queue.put(ProcessingCommand(ProcessingCommand.REFERENCES, (
+                self.is_dark_data, self.is_bright_data, self.dark_mean, self.bright_mean)))
         self.plot_worker.is_fix_y = self.Brange.isChecked()
         self.plot_worker.set_axis_range()
         if not self.Braw.isChecked() and not self.Brange.isChecked():
@@ -883,14 +1292,24 @@ class MainWindow(QtWidgets.QMainWindow):
         Actions when closing the app
         @param event: 
         """
-        reply = QMessageBox.question(self, 'Window Close', 'Are you sure you want to close the window?',
-                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-        if reply == QMessageBox.Yes:
+        if self.is_close_requested:
+            reply = QMessageBox.Yes
+        else:
+            reply = QMessageBox.question(self, 'Window Close', 'Are you sure you want to close the window?',
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply == QMessageBox.Yes and self.exports_pending:
+            #  Close once the export thread has written everything
+            self.is_close_requested = True
+            self.statusBar().showMessage("Closing after " + str(self.exports_pending) + " measurement(s) are saved")
+            event.ignore()
+        elif reply == QMessageBox.Yes:
             self.spec_thread.quit()
             self.spec_thread.wait()
             self.plot_thread.quit()
             self.plot_thread.wait()
+            self.export_thread.quit()
+            self.export_thread.wait()
             event.accept()
-            self.process_queue.put(None)
+            self.send_command(SpectroCommand.SHUTDOWN)
         else:
             event.ignore()
@@ -0,0 +1,163 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import numpy as np
+from spectra_compiler import utils, instrumentation
+from spectra_compiler.generator import SpectraReading, SpectraBlock, RAW_DTYPE, MEAS_DTYPE
+from spectra_compiler.storage import SpectraStore
+
+
+class SpectraCollector:
+    """
+    Gathers the spectra of one measurement: corrects every reading with the dark/bright references and keeps
+    every skip-th frame (in memory, or streamed to .npy files) until total_frames were received.
+    Free of Qt, so it is used both by SpectraGatherer in the GUI and by the headless mode
+    """
+
+    def __init__(self, total_frames, array_size, skip, is_dark_data, is_bright_data, dark_mean, bright_mean,
+                 stream_prefix=None, journal=None, raw_dtype=RAW_DTYPE, meas_dtype=MEAS_DTYPE, setting_id=None,
+                 monitor=None, timing=None, tracker=None, arm=None):
+        """
+        @param total_frames: number of frames of the measurement
+        @param skip: number of frames dropped after each stored one
+        @param stream_prefix: if given, frames are appended to .npy files starting with this path
+                              instead of being kept in memory
+        @param journal: optional MeasurementJournal receiving every stored frame, for crash recovery
+        @param raw_dtype: dtype in which raw spectra are kept
+        @param meas_dtype: dtype in which calculated spectra are kept
+        @param setting_id: if given, readings acquired under another integration time command are ignored
+        @param monitor: optional LatencyMonitor stamping the gather and correct stages
+        @param timing: optional FrameTiming receiving the timestamp of every frame of the measurement
+        @param tracker: optional analysis.PeakTracker analysing every stored frame
+        @param arm: optional trigger.TriggerArm. Frames are then only gathered once its trigger fires, starting with
+                    the pre-trigger frames it kept (which count towards total_frames)
+        """
+        self.total_frames = total_frames
+        self.array_size = array_size
+        self.skip = skip + 1
+        self.setting_id = setting_id
+        self.monitor = monitor
+        self.timing = timing
+        self.tracker = tracker
+        self.arm = arm
+        self.corrector = utils.SpectraCorrector(is_dark_data, is_bright_data, dark_mean, bright_mean)
+        self._yarray = np.empty(self.array_size, dtype=meas_dtype)  # Reused buffers for calculated spectra
+        self._yblock = np.empty((0, self.array_size), dtype=meas_dtype)
+        self.store = None
+        self.journal = journal
+        if stream_prefix is None:
+            self.spectra_meas_array = np.full((self.total_frames, self.array_size), np.nan, dtype=meas_dtype)
+            self.spectra_raw_array = np.zeros((self.total_frames, self.array_size), dtype=raw_dtype)
+            self.time_meas_array = np.full(self.total_frames, np.nan)
+        else:
+            self.store = SpectraStore(stream_prefix, self.array_size, raw_dtype=raw_dtype, meas_dtype=meas_dtype)
+        self.spectra_counter = 0  # Frames received
+        self.array_count = 0  # Frames stored
+
+    @property
+    def is_complete(self) -> bool:
+        return self.spectra_counter >= self.total_frames
+
+    @property
+    def is_armed(self) -> bool:
+        """
+        Waiting for the trigger
+        """
+        return self.arm is not None and not self.arm.is_triggered
+
+    def add(self, reading: SpectraReading):
+        """
+        Corrects a reading and stores it if it is not skipped
+        @param reading:
+        @return: calculated spectrum if the frame was stored (a reused buffer), else None
+        """
+        if self.is_complete or (self.setting_id is not None and reading.setting_id != self.setting_id):
+            return None
+        if self.is_armed:
+            yarray = self.add_block(SpectraBlock.from_readings([reading]))
+            return yarray[-1] if len(yarray) else None
+        if self.monitor is not None:
+            self.monitor.stamp(reading.stamps, instrumentation.GATHER)
+        yarray = self.corrector.apply(reading.data, out=self._yarray)
+        if self.monitor is not None:
+            self.monitor.stamp(reading.stamps, instrumentation.CORRECT)
+        if self.timing is not None:
+            self.timing.update(reading.timestamp)
+        is_stored = self.spectra_counter == 0 or (self.spectra_counter % self.skip) == 0
+        if is_stored:
+            self._store(reading.data, yarray, reading.timestamp)
+            if self.tracker is not None:
+                self.tracker.add(yarray, reading.timestamp)
+        self.spectra_counter += 1
+        return yarray if is_stored else None
+
+    def add_block(self, block: SpectraBlock):
+        """
+        Same as add for a batch of readings, with the math done on the whole block at once
+        @param block:
+        @return: (n, array_size) calculated spectra of the stored frames (may be empty)
+        """
+        if self.setting_id is not None:
+            block = block.select(block.setting_ids == self.setting_id)
+        if self.is_armed and len(block):
+            block = self.arm.feed(block, self.corrector.apply(block.data))
+            if block is None:
+                return self._yblock[:0]
+            if self.timing is not None:
+                self.timing.trigger_offset = self.arm.trigger_time - block.timestamps[0]
+        block = block.select(slice(0, max(self.total_frames - self.spectra_counter, 0)))
+        if not len(block):
+            return self._yblock[:0]
+        if self.monitor is not None:
+            self.monitor.stamp_block(block.stamps, instrumentation.GATHER)
+        if len(self._yblock) < len(block):
+            self._yblock = np.empty((len(block), self.array_size), dtype=self._yblock.dtype)
+        yarray = self.corrector.apply(block.data, out=self._yblock[:len(block)])
+        if self.monitor is not None:
+            self.monitor.stamp_block(block.stamps, instrumentation.CORRECT)
+        if self.timing is not None:
+            self.timing.update_many(block.timestamps)
+        counters = self.spectra_counter + np.arange(len(block))
+        selected = np.flatnonzero((counters == 0) | (counters % self.skip == 0))
+        if len(selected):
+            if self.store is None:
+                stored = slice(self.array_count, self.array_count + len(selected))
+                self.spectra_raw_array[stored] = block.data[selected]
+                self.spectra_meas_array[stored] = yarray[selected]
+                self.time_meas_array[stored] = block.timestamps[selected]
+                if self.journal is not None:
+                    for row in selected:
+                        self.journal.append(block.data[row], yarray[row], block.timestamps[row])
+                self.array_count += len(selected)
+            else:
+                for row in selected:
+                    self._store(block.data[row], yarray[row], block.timestamps[row])
+            if self.tracker is not None:
+                self.tracker.add(yarray[selected], block.timestamps[selected])
+        self.spectra_counter += len(block)
+        return yarray[selected]
+
+    def _store(self, ydata, yarray, timestamp):
+        if self.store is None:
+            self.spectra_raw_array[self.array_count] = ydata
+            self.spectra_meas_array[self.array_count] = yarray
+            self.time_meas_array[self.array_count] = timestamp
+        else:
+            self.store.append(ydata, yarray, timestamp)
+        if self.journal is not None:
+            self.journal.append(ydata, yarray, timestamp)
+        self.array_count += 1
+
+    def collected_arrays(self):
+        """
+        Spectra gathered so far, without the preallocated frames that were not measured.
+        When streaming, the files are closed and returned as read-only memory maps
+        @return: (raw spectra, calculated spectra, timestamps)
+        """
+        if self.journal is not None:
+            self.journal.close()
+        if self.store is None:
+            return (self.spectra_raw_array[:self.array_count], self.spectra_meas_array[:self.array_count],
+                    self.time_meas_array[:self.array_count])
+        return self.store.open_arrays()
@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import pathlib
+import time
+import numpy as np
+
+DARK_FOLDER = pathlib.Path.home() / ".spectra_compiler" / "darks"
+DARK_MAX_AGE_DAYS = 7  # Older darks are removed, detector dark current drifts with temperature and age
+
+
+class DarkReference:
+    def __init__(self, serial, inttime, mean, noise=None, created=None, is_interpolated=False):
+        self.serial: str = serial
+        self.inttime: float = inttime  # seconds
+        self.mean: np.ndarray = mean
+        self.noise: np.ndarray = noise
+        self.created: float = time.time() if created is None else created
+        self.is_interpolated: bool = is_interpolated
+
+
+class DarkLibrary:
+    """
+    On-disk cache of dark spectra, one .npz file per spectrometer serial number and integration time,
+    so a dark measured once can be reused after changing the integration time back or restarting the app
+    """
+
+    def __init__(self, folder=DARK_FOLDER, max_age_days=DARK_MAX_AGE_DAYS):
+        """
+        @param folder: where darks are kept
+        @param max_age_days: darks older than this are ignored and removed by evict()
+        """
+        self.folder = pathlib.Path(folder)
+        self.max_age_days = max_age_days
+
+    def _path(self, serial, inttime) -> pathlib.Path:
+        return self.folder / "{}_{}us.npz".format(serial, int(round(inttime * 1000000)))
+
+    def _is_fresh(self, created) -> bool:
+        return time.time() - created <= self.max_age_days * 86400
+
+    def save(self, serial, inttime, mean, noise=None):
+        """
+        Stores a dark, replacing the one with the same serial number and integration time
+        @param serial: spectrometer serial number
+        @param inttime: integration time in seconds
+        @param mean: dark spectrum
+        @param noise: per-pixel standard deviation of the dark spectrum
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        arrays = {"mean": np.asarray(mean)}
+        if noise is not None:
+            arrays["noise"] = np.asarray(noise)
+        np.savez(self._path(serial, inttime), inttime=inttime, created=time.time(), **arrays)
+
+    def load(self, path) -> DarkReference:
+        """
+        @param path: .npz file of the library
+        @return: the stored dark
+        """
+        path = pathlib.Path(path)
+        with np.load(path) as npz:
+            return DarkReference(serial=path.stem.rsplit("_", 1)[0],
+                                 inttime=float(npz["inttime"]),
+                                 mean=npz["mean"],
+                                 noise=npz["noise"] if "noise" in npz.files else None,
+                                 created=float(npz["created"]))
+
+    def entries(self, serial) -> list:
+        """
+        @param serial: spectrometer serial number
+        @return: fresh darks of that spectrometer, sorted by integration time
+        """
+        if not self.folder.exists():
+            return []
+        darks = []
+        for path in self.folder.glob("{}_*us.npz".format(serial)):
+            try:
+                dark = self.load(path)
+            except (OSError, ValueError, KeyError):
+                continue  # Unreadable (e.g. partially written) file
+            if dark.serial == serial and self._is_fresh(dark.created):
+                darks.append(dark)
+        return sorted(darks, key=lambda dark: dark.inttime)
+
+    def lookup(self, serial, inttime, is_interpolated=False):
+        """
+        Finds the dark for an integration time. Optionally, when there is none, interpolates linearly between the
+        darks with the closest shorter and longer integration times (dark signal grows linearly with exposure)
+        @param serial: spectrometer serial number
+        @param inttime: integration time in seconds
+        @param is_interpolated: allow interpolation
+        @return: DarkReference, or None if no suitable dark is stored
+        """
+        micros = int(round(inttime * 1000000))
+        darks = self.entries(serial)
+        for dark in darks:
+            if int(round(dark.inttime * 1000000)) == micros:
+                return dark
+        if not is_interpolated:
+            return None
+        lower = [dark for dark in darks if dark.inttime < inttime]
+        upper = [dark for dark in darks if dark.inttime > inttime]
+        if not lower or not upper or len(lower[-1].mean) != len(upper[0].mean):
+            return None  # No extrapolation
+        low, high = lower[-1], upper[0]
+        weight = (inttime - low.inttime) / (high.inttime - low.inttime)
+        noise = None
+        if low.noise is not None and high.noise is not None:
+            noise = (1 - weight) * low.noise + weight * high.noise
+        return DarkReference(serial, inttime, (1 - weight) * low.mean + weight * high.mean, noise,
+                             created=min(low.created, high.created), is_interpolated=True)
+
+    def evict(self) -> int:
+        """
+        Removes darks older than max_age_days
+        @return: number of removed darks
+        """
+        if not self.folder.exists():
+            return 0
+        removed = 0
+        for path in self.folder.glob("*.npz"):
+            try:
+                created = self.load(path).created
+            except (OSError, ValueError, KeyError):
+                continue
+            if not self._is_fresh(created):
+                path.unlink()
+                removed += 1
+        return removed
@@ -0,0 +1,312 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import csv
+import json
+import os
+import numpy as np
+from spectra_compiler import utils
+
+FORMATS = {"CSV": ".csv", "HDF5": ".h5", "NPZ": ".npz", "Parquet": ".parquet"}
+CSV_READ_VALUES = 2 ** 24  # Values read from the spectra matrix at once by save_csv (128 MB of float64)
+CSV_FORMAT_VALUES = 2 ** 18  # Values converted to text at once by save_csv
+
+
+class ExportJob:
+    """
+    Everything needed to write one measurement to disk.
+    The job owns its arrays, so it can be written while the next measurement is already running.
+    """
+
+    def __init__(self, folder, sample, meta_dict, xdata, spectra_raw_array, spectra_meas_array, time_meas_array,
+                 dark_mean=None, bright_mean=None, is_dark_data=False, is_bright_data=False, is_show_raw=False,
+                 is_heatplot=True, file_format="CSV", is_compressed=False, journal_path=None, dark_noise=None,
+                 bright_noise=None):
+        self.folder = folder
+        self.sample = sample
+        self.meta_dict = meta_dict
+        self.xdata = xdata
+        self.spectra_raw_array = spectra_raw_array
+        self.spectra_meas_array = spectra_meas_array
+        self.time_meas_array = time_meas_array
+        self.dark_mean = dark_mean
+        self.bright_mean = bright_mean
+        self.dark_noise = dark_noise  # Per-pixel standard deviation of the references, if known
+        self.bright_noise = bright_noise
+        self.is_dark_data = is_dark_data
+        self.is_bright_data = is_bright_data
+        self.is_show_raw = is_show_raw
+        self.is_heatplot = is_heatplot
+        self.file_format = file_format
+        self.is_compressed = is_compressed
+        self.journal_path = journal_path  # Crash recovery journal to remove once saved
+
+    @property
+    def filename(self) -> str:
+        return self.folder + self.sample + "_PL_measurement" + FORMATS[self.file_format]
+
+    @property
+    def heatplot_filename(self) -> str:
+        return self.folder + "0_preview_" + self.sample + "_heatplot.png"
+
+
+def save(job: ExportJob, progress=None):
+    """
+    Writes the measurement in the format selected in the job
+    @param job: measurement to save
+    @param progress: optional callable receiving the written fraction (0 to 1), used by the csv writer
+    """
+    if job.file_format == "CSV":
+        save_csv(job, progress)
+    else:
+        {"HDF5": save_hdf5, "NPZ": save_npz, "Parquet": save_parquet}[job.file_format](job)
+
+
+def valid_frames(job: ExportJob):
+    """
+    Drops the preallocated frames that were never measured (e.g. after pressing STOP)
+    @param job: measurement
+    @return: raw spectra, calculated spectra and timestamps of measured frames only
+    """
+    time_meas_array = np.asarray(job.time_meas_array)
+    valid = ~np.isnan(time_meas_array)
+    if valid.all():
+        return job.spectra_raw_array, job.spectra_meas_array, time_meas_array
+    return job.spectra_raw_array[valid], job.spectra_meas_array[valid], time_meas_array[valid]
+
+
+def references(job: ExportJob) -> dict:
+    """
+    @param job: measurement
+    @return: dark and bright reference spectra that were used, and their noise maps, by name
+    """
+    refs = {}
+    if job.is_dark_data:
+        refs["dark"] = np.asarray(job.dark_mean)
+        if job.dark_noise is not None:
+            refs["dark_noise"] = np.asarray(job.dark_noise)
+    if job.is_bright_data:
+        refs["bright"] = np.asarray(job.bright_mean)
+        if job.bright_noise is not None:
+            refs["bright_noise"] = np.asarray(job.bright_noise)
+    return refs
+
+
+def save_npz(job: ExportJob):
+    """
+    Saves typed arrays into a numpy .npz archive. The metadata is stored as a json string
+    @param job: measurement to save
+    """
+    raw, processed, time_meas_array = valid_frames(job)
+    savez = np.savez_compressed if job.is_compressed else np.savez
+    savez(job.filename, wavelength=np.asarray(job.xdata), time=time_meas_array, raw=raw, processed=processed,
+          metadata=np.array(json.dumps(job.meta_dict, default=str)), **references(job))
+
+
+def save_hdf5(job: ExportJob):
+    """
+    Saves typed, chunked arrays into a HDF5 file. The metadata is stored as attributes of the file
+    @param job: measurement to save
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is needed to save HDF5 files (pip install h5py)")
+
+    raw, processed, time_meas_array = valid_frames(job)
+    compression = "gzip" if job.is_compressed else None
+    chunks = (max(1, min(len(time_meas_array), 256)), len(job.xdata))
+    with h5py.File(job.filename, "w") as h5:
+        for key, value in job.meta_dict.items():
+            h5.attrs[key] = value if isinstance(value, (bool, int, float)) else str(value)
+        h5.create_dataset("wavelength", data=np.asarray(job.xdata))
+        h5.create_dataset("time", data=time_meas_array)
+        for name, spectra in (("raw", raw), ("processed", processed)):
+            h5.create_dataset(name, data=spectra, chunks=chunks if len(time_meas_array) else None,
+                              compression=compression)
+        for name, spectrum in references(job).items():
+            h5.create_dataset(name, data=spectrum)
+
+
+def save_parquet(job: ExportJob):
+    """
+    Saves one row per frame (time, raw and calculated spectrum) into a parquet file.
+    Wavelengths, references and metadata are stored as json in the file's key-value metadata
+    @param job: measurement to save
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("pyarrow is needed to save parquet files (pip install pyarrow)")
+
+    raw, processed, time_meas_array = valid_frames(job)
+    array_size = len(job.xdata)
+    columns = {"time": pa.array(time_meas_array)}
+    for name, spectra in (("raw", raw), ("processed", processed)):
+        columns[name] = pa.FixedSizeListArray.from_arrays(pa.array(np.ravel(spectra)), array_size)
+    file_metadata = {"metadata": json.dumps(job.meta_dict, default=str),
+                     "wavelength": json.dumps(np.asarray(job.xdata).tolist())}
+    for name, spectrum in references(job).items():
+        file_metadata[name] = json.dumps(spectrum.tolist())
+    table = pa.table(columns).replace_schema_metadata(file_metadata)
+    pq.write_table(table, job.filename, compression="zstd" if job.is_compressed else "none")
+
+
+def save_csv(job: ExportJob, progress=None):
+    """
+    Saves metadata and spectra into a csv file, wavelengths as rows and timestamps as columns.
+    The (wavelength, frames) table is formatted in blocks of rows straight from the arrays, producing the same file
+    as building it with pandas (concat, dropna, round(1), to_csv) without holding copies of the whole matrix
+    @param job: measurement to save
+    @param progress: optional callable receiving the written fraction (0 to 1)
+    """
+    if job.is_show_raw:
+        spectra = job.spectra_raw_array
+        columns = [("Wavelength (nm)", job.xdata)]
+        if job.is_dark_data:
+            columns.append(("Dark spectra", job.dark_mean))
+            if job.dark_noise is not None:
+                columns.append(("Dark noise", job.dark_noise))
+        if job.is_bright_data:
+            columns.append(("Bright spectra", job.bright_mean))
+            if job.bright_noise is not None:
+                columns.append(("Bright noise", job.bright_noise))
+    else:
+        spectra = job.spectra_meas_array
+        columns = [("Wavelength (nm)", job.xdata)]
+    columns = [(label, np.asarray(values, dtype=np.float64)) for label, values in columns]
+    columns = [(label, values) for label, values in columns if not np.isnan(values).all()]
+    frames = np.flatnonzero(_measured_frames(spectra))
+    time_labels = np.round(np.asarray(job.time_meas_array, dtype=np.float64)[frames], 4).astype(str)
+
+    n_rows = len(job.xdata)
+    n_cols = len(columns) + len(frames)
+    rows_per_read = max(1, CSV_READ_VALUES // max(n_cols, 1))
+    rows_per_format = max(1, CSV_FORMAT_VALUES // max(n_cols, 1))
+    with open(job.filename, "w", newline="") as file:
+        writer = csv.writer(file, lineterminator=os.linesep)
+        for key, value in job.meta_dict.items():
+            writer.writerow([key, "" if value is None else value])
+        writer.writerow([label for label, _ in columns] + time_labels.tolist())
+        for start in range(0, n_rows, rows_per_read):
+            stop = min(start + rows_per_read, n_rows)
+            block = np.empty((stop - start, n_cols))
+            for cc, (_, values) in enumerate(columns):
+                block[:, cc] = values[start:stop]
+            block[:, len(columns):] = np.asarray(spectra[frames, start:stop], dtype=np.float64).T
+            for row in range(0, len(block), rows_per_format):
+                file.write(_format_csv_block(block[row:row + rows_per_format]))
+            if progress is not None:
+                progress(stop / n_rows)
+
+
+def _measured_frames(spectra, chunk_frames=4096) -> np.ndarray:
+    """
+    @param spectra: (frames, array_size) matrix
+    @return: boolean array, False for frames that are entirely NaN (never measured)
+    """
+    measured = np.empty(len(spectra), dtype=bool)
+    for start in range(0, len(spectra), chunk_frames):
+        chunk = np.asarray(spectra[start:start + chunk_frames], dtype=np.float64)
+        measured[start:start + chunk_frames] = ~np.isnan(chunk).all(axis=1)
+    return measured
+
+
+def _format_csv_block(block: np.ndarray) -> str:
+    """
+    Formats rows of values the way pandas writes floats: rounded to 1 decimal, shortest repr, NaN as empty field.
+    Rounded to tenths, the shortest repr of a value is its integer part, a dot and one digit, so the text is built
+    from the count of tenths with array operations, a digit position at a time, instead of one string per value
+    @param block: 2D float array
+    @return: csv text of the block, each row ended by the platform line terminator
+    """
+    tenths = np.rint(block * 10)  # As np.round(block, 1) does
+    is_nan = np.isnan(tenths).ravel()
+    magnitude = np.abs(np.where(np.isnan(tenths), 0.0, tenths)).ravel()
+    if not magnitude.size or not magnitude.max() < _EXACT_TENTHS:  # Also catches inf
+        return _format_csv_block_repr(block)
+    magnitude = magnitude.astype(np.int64)
+    is_negative = np.signbit(tenths).ravel() & ~is_nan
+    units = magnitude // 10
+    n_digits = 1 + np.searchsorted(_POWERS_OF_TEN, units, side="right")
+    widths = np.where(is_nan, 0, is_negative + n_digits + 2).reshape(block.shape)
+    widths[:, :-1] += 1  # Separating comma
+    widths[:, -1] += len(os.linesep)
+    ends = np.cumsum(widths.ravel())
+    starts = ends - widths.ravel()
+    text = np.full(ends[-1], ord(","), dtype=np.uint8)
+    row_ends = ends[block.shape[1] - 1::block.shape[1]]
+    for cc, char in enumerate(os.linesep.encode()):
+        text[row_ends - len(os.linesep) + cc] = char
+    measured = ~is_nan
+    starts, is_negative, units, n_digits = starts[measured], is_negative[measured], units[measured], n_digits[measured]
+    text[starts[is_negative]] = ord("-")
+    point = starts + is_negative + n_digits
+    text[point] = ord(".")
+    text[point + 1] = ord("0") + magnitude[measured] % 10
+    for digit in range(int(n_digits.max(initial=0))):
+        has_digit = n_digits > digit
+        text[point[has_digit] - 1 - digit] = ord("0") + units[has_digit] % 10
+        units //= 10
+    return text.tobytes().decode("ascii")
+
+
+_EXACT_TENTHS = 2.0 ** 53  # Counts of tenths held exactly by float64, whose repr is then the plain decimal
+_POWERS_OF_TEN = 10 ** np.arange(1, 19, dtype=np.int64)
+
+
+def _format_csv_block_repr(block: np.ndarray) -> str:
+    """
+    Same as _format_csv_block through one repr per value, for blocks holding infinite or huge values
+    """
+    block = np.round(block, 1)
+    text = block.astype(str)
+    text[np.isnan(block)] = ""
+    return "".join(",".join(row) + os.linesep for row in text.tolist())
+
+
+def save_heatplot(job: ExportJob):
+    """
+    Saves a time vs wavelength preview image of the measurement.
+    Uses the object oriented matplotlib API, so it is safe to call outside of the GUI thread
+    @param job: measurement to plot
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=[8, 6])
+    FigureCanvasAgg(fig)
+    ax1 = fig.add_subplot(1, 1, 1)
+    if job.is_show_raw:
+        time = job.time_meas_array
+        heatplot = job.spectra_raw_array.T
+        waveleng = job.xdata
+    else:
+        time = job.time_meas_array
+        heatplot = job.spectra_meas_array.T[215:1455]
+        waveleng = job.xdata[215:1455]
+
+    time = time[~np.isnan(time)]
+    waveleng = waveleng[~np.isnan(waveleng)]
+    heatplot = heatplot[:, :time.shape[0]]
+    #  Reduce to the maximum per pixel, so drawing does not depend on the length of the measurement
+    heatplot = utils.max_decimate(heatplot, utils.decimation_edges(heatplot.shape[1], int(ax1.bbox.width)), axis=1)
+    heatplot = utils.max_decimate(heatplot, utils.decimation_edges(heatplot.shape[0], int(ax1.bbox.height)), axis=0)
+
+    ax1.set_title("PL spectra")
+    ax1.set_xlabel("Time(seconds)")
+    ax1.set_ylabel("Wavelength (nm)")
+
+    waveLen = heatplot.shape[0]
+    PLmin = np.min(waveleng)
+    PLmax = np.max(waveleng)
+
+    #  fix axis ticks so they match the data (else they are array positions)
+    ax1.set_yticks(np.linspace(0, waveLen, 8))
+    ax1.set_yticklabels(np.linspace(PLmin, PLmax, 8).astype(int))
+    ax1.set_xticks(np.linspace(0, heatplot.shape[1], 8))
+    ax1.set_xticklabels(np.around(np.linspace(0, np.max(time), 8), decimals=1))
+    ax1.pcolorfast(heatplot)
+    fig.savefig(job.heatplot_filename)
@@ -2,88 +2,263 @@
 #
 # SPDX-License-Identifier: MIT
 
+import pathlib
 from queue import Empty
 import numpy as np
 import time
-import seabreeze.spectrometers as sp
 from multiprocessing import Process, Queue, Pipe
+from spectra_compiler import instrumentation
+from spectra_compiler.simulator import SimulatedSpectrometer
+
+RAW_DTYPE = np.uint16  # Detector counts (16 bit ADC)
+MEAS_DTYPE = np.float32  # Calculated spectra
+CALIBRATION_FOLDER = pathlib.Path.home() / ".spectra_compiler" / "calibration"
+MODEL_NAME = "FLMS12200"
+FIRST_PIXEL = 2  # The first pixels of the detector are not used
+
+
+def to_counts(ydata, dtype=RAW_DTYPE) -> np.ndarray:
+    """
+    Converts a spectrum to the compact raw dtype, rounding and clipping to its range
+    @param ydata: spectrum as returned by the spectrometer
+    @param dtype: integer or float dtype used for raw data
+    @return: spectrum with the given dtype
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(ydata), info.min, info.max).astype(dtype)
+    return np.asarray(ydata, dtype=dtype)
 
 
 class SpectraReading:
-    def __init__(self, timestamp, data):
+    def __init__(self, timestamp, data, setting_id=0, stamps=None):
         self.timestamp: float = timestamp
         self.data: np.ndarray = data
+        self.setting_id: int = setting_id  # command_id of the integration time this spectrum was acquired with
+        self.stamps: np.ndarray = stamps  # Pipeline stage times (see instrumentation), None if not instrumented
+
+
+class SpectraBlock:
+    """
+    Several consecutive readings stacked together, emitted at once to cut per-frame signal overhead
+    """
+    def __init__(self, timestamps, data, setting_ids=None, stamps=None):
+        self.timestamps: np.ndarray = timestamps
+        self.data: np.ndarray = data  # (n, array_size)
+        self.setting_ids: np.ndarray = np.zeros(len(timestamps), dtype=int) if setting_ids is None else setting_ids
+        self.stamps: np.ndarray = stamps  # (n, len(instrumentation.STAGES)), None if not instrumented
+
+    @classmethod
+    def from_readings(cls, readings: list):
+        stamps = None
+        if readings[0].stamps is not None:
+            stamps = np.stack([reading.stamps for reading in readings])
+        return cls(np.array([reading.timestamp for reading in readings]),
+                   np.stack([reading.data for reading in readings]),
+                   np.array([reading.setting_id for reading in readings]),
+                   stamps)
+
+    def select(self, rows):
+        """
+        @param rows: boolean mask or indices
+        @return: block with only the given readings
+        """
+        return SpectraBlock(self.timestamps[rows], self.data[rows], self.setting_ids[rows],
+                            None if self.stamps is None else self.stamps[rows])
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class SpectroCommand:
+    """
+    Instruction from the GUI (or a script) to the spectrometer process, sent through its Queue.
+    Every command is confirmed with a SpectroAck sent through the Pipe, in order with the spectra
+    """
+    SET_INTTIME = "set_inttime"  # value: integration time in seconds
+    PAUSE = "pause"
+    RESUME = "resume"
+    SHUTDOWN = "shutdown"
+
+    def __init__(self, name, value=None, command_id=0):
+        self.name: str = name
+        self.value = value
+        self.command_id: int = command_id
+
+
+class SpectroAck:
+    """
+    Confirmation of a SpectroCommand. For SET_INTTIME, value is the integration time actually applied (seconds)
+    and every following SpectraReading carries setting_id == command_id
+    """
+    def __init__(self, command_id, name, value=None, sequence=None):
+        self.command_id: int = command_id
+        self.name: str = name
+        self.value = value
+        self.sequence: int = sequence  # With a shared memory ring, frames written before this acknowledgement
+
+
+class DeviceInfo:
+    """
+    What the mother process needs to know about the spectrometer before it starts acquiring
+    """
+    def __init__(self, serial_number, xdata, is_spectrometer, is_model_verified=False):
+        self.serial_number: str = serial_number
+        self.xdata: np.ndarray = xdata  # Wavelengths in nm, without the unused first pixels
+        self.is_spectrometer: bool = is_spectrometer  # False for the simulated spectrometer
+        self.is_model_verified: bool = is_model_verified
+
+    @property
+    def array_size(self) -> int:
+        return len(self.xdata)
+
+
+def discover_device(simulator=None, calibration_folder=CALIBRATION_FOLDER) -> DeviceInfo:
+    """
+    Looks for a connected spectrometer without keeping it open (it is opened once, by the spectrometer process).
+    Its wavelength calibration is cached per serial number, so the device is only opened here the first time.
+    seabreeze is imported here rather than at module level, since loading its backends is slow
+    @param simulator: SimulatedSpectrometer to use instead of looking for a device
+    @param calibration_folder: where wavelength calibrations are cached
+    @return: description of the connected spectrometer, or of the simulated one if none is found
+    """
+    if simulator is None:
+        import seabreeze.spectrometers as sp
+        devices = sp.list_devices()
+        if devices:
+            serial_number = devices[0].serial_number
+            path = pathlib.Path(calibration_folder) / "{}.npy".format(serial_number)
+            try:
+                wavelengths = np.load(path)
+            except (OSError, ValueError):
+                spec = sp.Spectrometer(devices[0])
+                wavelengths = spec.wavelengths()
+                spec.close()
+                path.parent.mkdir(parents=True, exist_ok=True)
+                np.save(path, wavelengths)
+            return DeviceInfo(serial_number, wavelengths[FIRST_PIXEL:], True, MODEL_NAME in serial_number)
+        simulator = SimulatedSpectrometer()
+    return DeviceInfo(simulator.serial_number, simulator.wavelengths(), False)
 
 
 class SpectroProcess(Process):
-    MODEL_NAME = "FLMS12200"
+    MODEL_NAME = MODEL_NAME
 
-    def __init__(self, to_emitter: Pipe, from_mother: Queue, daemon=True):
+    def __init__(self, to_emitter: Pipe, from_mother: Queue, daemon=True, use_shared_memory=False,
+                 raw_dtype=RAW_DTYPE, is_instrumented=False, simulator=None, device=None):
+        """
+        @param simulator: SimulatedSpectrometer used instead of a connected spectrometer.
+                          When None, a default one is used only if no spectrometer is found
+        @param device: DeviceInfo from discover_device (e.g. run in the background at startup), None to discover now
+        """
         super().__init__()
         self.daemon = daemon
         self.to_emitter = to_emitter
         self.data_from_mother = from_mother
-        self.is_spectrometer = bool(len(sp.list_devices()))
-        if self.is_spectrometer:
-            _spec = sp.Spectrometer.from_first_available()
-            self.xdata = _spec.wavelengths()[2:]
-            self.array_size = len(self.xdata)
-            self.is_model_verified = (self.MODEL_NAME in _spec.serial_number)
+        self.raw_dtype = np.dtype(raw_dtype)
+        self.ring = None
+        self.setting_id = 0
+        self.inttime = 0.2  # seconds
+        self.is_instrumented = is_instrumented
+        device = discover_device(simulator) if device is None else device
+        self.is_spectrometer = device.is_spectrometer
+        self.xdata = device.xdata
+        self.array_size = device.array_size
+        self.is_model_verified = device.is_model_verified
+        self.serial_number = device.serial_number
+        if not self.is_spectrometer:
+            self.spec = SimulatedSpectrometer() if simulator is None else simulator
+        if use_shared_memory:
+            from spectra_compiler.transport import SpectraRing
+            self.ring = SpectraRing(self.array_size, dtype=self.raw_dtype)
+
+    def send_reading(self, timestamp, ydata, stamps=None):
+        """
+        Hands a spectrum over to the emitter, either pickled through the Pipe or through the shared memory ring
+        (which never blocks)
+        @param timestamp: acquisition time
+        @param ydata: spectrum
+        @param stamps: pipeline stage times of the frame, when instrumented
+        """
+        ydata = to_counts(ydata, self.raw_dtype)
+        if stamps is not None:
+            stamps[instrumentation.SEND] = time.perf_counter()
+        if self.ring is None:
+            self.to_emitter.send(SpectraReading(timestamp, ydata, self.setting_id, stamps))
         else:
-            self.array_size = 2046
-            self.xdata = np.linspace(340, 1015, self.array_size)
+            seq = self.ring.push(timestamp, ydata, self.setting_id, stamps)
+            if self.ring.take_notification():  # At most one wake-up queued, so the Pipe never fills up
+                self.to_emitter.send(seq)
+
+    def handle_commands(self) -> bool:
+        """
+        Applies every command waiting in the queue. While paused, waits (without polling) for the next command
+        @return: False once the process has to stop
+        """
+        is_paused = False
+        while True:
+            try:
+                command = self.data_from_mother.get() if is_paused else self.data_from_mother.get_nowait()
+            except Empty:
+                return True
+            if not isinstance(command, SpectroCommand):  # Bare integration time (or None to stop)
+                command = SpectroCommand(SpectroCommand.SET_INTTIME, command) if command else \
+                    SpectroCommand(SpectroCommand.SHUTDOWN)
+            value = None
+            if command.name == SpectroCommand.SET_INTTIME:
+                value = self.set_integration_time(command.value)
+                self.setting_id = command.command_id
+            elif command.name == SpectroCommand.PAUSE:
+                is_paused = True
+            elif command.name == SpectroCommand.RESUME:
+                is_paused = False
+            self.to_emitter.send(SpectroAck(command.command_id, command.name, value,
+                                            None if self.ring is None else self.ring.write_sequence))
+            if command.name == SpectroCommand.SHUTDOWN:
+                self.spec.close()
+                return False
+            if not is_paused and self.data_from_mother.empty():
+                return True
+
+    def set_integration_time(self, inttime) -> float:
+        """
+        Sets the integration time, limited to what the spectrometer supports
+        @param inttime: requested integration time in seconds
+        @return: integration time applied, in seconds
+        """
+        low, high = self.spec.integration_time_micros_limits
+        micros = int(round(min(max(inttime * 1000000, low), high)))
+        self.spec.integration_time_micros(micros)
+        self.inttime = micros / 1000000
+        return self.inttime
 
     def reinit_spectrometer_generator(self):
         """
-        Look for a spectrometer connected to the computer
+        Opens the spectrometer found by discover_device
         """
+        import seabreeze.spectrometers as sp
         try:
-            self.spec = sp.Spectrometer.from_first_available()
-            self.spec.integration_time_micros(200000)
+            self.spec = sp.Spectrometer.from_serial_number(self.serial_number)
+            self.spec.integration_time_micros(int(round(self.inttime * 1000000)))
         except Exception:
             print("Spectrometer couldn't be initialized.")
 
     def run(self):
         """
         Initial spectrometer setup.
-        If not found, make some random data with a gaussian shape
+        If not found, spectra come from the simulated spectrometer
         """
-        def accurate_delay(delay):
-            _ = time.perf_counter() + delay / 1000
-            while time.perf_counter() < _:
-                pass
-
         if self.is_spectrometer:
             self.reinit_spectrometer_generator()
-            _DP = 1420  # dead pixel on spectrometer @831.5nm
-            while True:
-                ydata = self.spec.intensities()[2:]
-                if self.is_model_verified:
-                    ydata[_DP] = np.mean(ydata[_DP - 2:_DP + 2])
-                reading = SpectraReading(time.time(), ydata)
-                self.to_emitter.send(reading)
-                try:
-                    inttime = self.data_from_mother.get_nowait()
-                    if inttime:
-                        self.spec.integration_time_micros(int(inttime * 1000000))
-                    else:
-                        self.spec.close()
-                        break
-                except Empty:
-                    pass
-        else:
-            xx = np.arange(self.array_size)
-            inttime = 0.2
-            while True:
-                accurate_delay(inttime)
-                ydata = 50000 * np.exp(-(xx - 900) ** 2 / (2 * 100000)) + np.random.randint(0, 10001)
-                reading = SpectraReading(time.time(), ydata)
-                self.to_emitter.send(reading)
-                try:
-                    inttime = self.data_from_mother.get_nowait()
-                    if inttime:
-                        inttime *= 1000  # convert to ms
-                    else:
-                        break
-                except Empty:
-                    pass
+        _DP = 1420  # dead pixel on spectrometer @831.5nm
+        while True:
+            ydata = self.spec.intensities()
+            stamps = instrumentation.new_stamps() if self.is_instrumented else None
+            if self.is_spectrometer:
+                ydata = ydata[FIRST_PIXEL:]
+            if self.is_model_verified:
+                ydata[_DP] = np.mean(ydata[_DP - 2:_DP + 2])
+            self.send_reading(time.time(), ydata, stamps)
+            if not self.handle_commands():
+                break
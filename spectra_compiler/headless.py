@@ -0,0 +1,497 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Headless acquisition: drives the spectrometer process and a SpectraCollector straight from the command line
+(or a json config file), without Qt or matplotlib, and saves the same files as the GUI.
+
+Usage, from the repository root:
+    python -m spectra_compiler.headless --sample S1 --folder data/ --inttime 0.1 --duration 600
+    python -m spectra_compiler.headless --config overnight.json --sample S2
+
+Settings in the config file use the long option names (e.g. {"inttime": 0.1, "dark": true, "average": 20}),
+options given on the command line take precedence. Press Ctrl+C to stop early and save what was measured.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Queue, Pipe, freeze_support
+import numpy as np
+from spectra_compiler import utils, journal
+from spectra_compiler.analysis import PeakTracker, parse_rois
+from spectra_compiler.collector import SpectraCollector
+from spectra_compiler.darks import DarkLibrary
+from spectra_compiler.export import ExportJob, FORMATS, save
+from spectra_compiler.generator import SpectroProcess, SpectroCommand, SpectroAck, SpectraReading, RAW_DTYPE, \
+    MEAS_DTYPE
+from spectra_compiler.simulator import SimulatedSpectrometer
+from spectra_compiler.timing import FrameTiming
+from spectra_compiler.trigger import TRIGGERS, TriggerArm, make_trigger
+from spectra_compiler.transport import SpectraReceiver
+
+
+class HeadlessAcquisition:
+    """
+    Runs the spectrometer process and receives its spectra in the calling thread.
+    Use as a context manager, so the process is always shut down
+    """
+
+    def __init__(self, use_shared_memory=False, simulator=None):
+        """
+        @param simulator: SimulatedSpectrometer to use instead of a connected spectrometer
+        """
+        mother_pipe, child_pipe = Pipe()
+        self.queue = Queue()
+        self.process = SpectroProcess(child_pipe, self.queue, use_shared_memory=use_shared_memory,
+                                      simulator=simulator)
+        self.receiver = SpectraReceiver(mother_pipe, self.process.ring)
+        self.command_counter = 0
+        self.setting_id = 0  # Integration time command the spectrometer confirmed last
+        self.inttime = None  # Integration time applied, in seconds
+        self.not_before = None  # Readings acquired before this time are discarded (see discard_pending)
+        self.process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def serial_number(self) -> str:
+        return self.process.serial_number
+
+    def send_command(self, name, value=None) -> int:
+        """
+        @param name: one of the SpectroCommand names
+        @param value: argument of the command
+        @return: id of the command, also carried by its acknowledgement
+        """
+        self.command_counter += 1
+        self.queue.put(SpectroCommand(name, value, self.command_counter))
+        return self.command_counter
+
+    def wait_for_ack(self, command_id, timeout=10.0) -> SpectroAck:
+        """
+        Waits for the acknowledgement of a command, dropping the readings received meanwhile
+        @raise TimeoutError: if it did not arrive in time
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            item = self.receiver.receive(max(deadline - time.monotonic(), 0))
+            if isinstance(item, SpectroAck) and item.command_id == command_id:
+                return item
+        raise TimeoutError("Spectrometer did not confirm the command in {:g} s".format(timeout))
+
+    def set_integration_time(self, inttime) -> float:
+        """
+        @param inttime: requested integration time in seconds
+        @return: integration time applied by the spectrometer, in seconds
+        """
+        ack = self.wait_for_ack(self.send_command(SpectroCommand.SET_INTTIME, inttime), timeout=10.0 + 2 * inttime)
+        self.setting_id = ack.command_id
+        self.inttime = ack.value
+        return ack.value
+
+    def next_reading(self) -> SpectraReading:
+        """
+        @return: next spectrum acquired with the current integration time
+        @raise TimeoutError: if the spectrometer stopped sending spectra
+        """
+        timeout = max(2.0, 5 * self.inttime)
+        deadline = time.monotonic() + timeout
+        while True:
+            item = self.receiver.receive(max(deadline - time.monotonic(), 0))
+            if item is None:
+                if time.monotonic() < deadline:
+                    continue
+                raise TimeoutError("No spectra received from the spectrometer for {:g} s".format(timeout))
+            if not isinstance(item, SpectraReading):
+                continue
+            deadline = time.monotonic() + timeout  # The spectrometer is alive, even if this reading is discarded
+            if item.setting_id == self.setting_id and (self.not_before is None or item.timestamp >= self.not_before):
+                return item
+
+    def discard_pending(self):
+        """
+        Drops the spectra acquired until now (and the one being integrated), e.g. those queued while waiting for
+        the user to switch the light, so the next readings reflect the new conditions
+        """
+        self.not_before = time.time() + (self.inttime or 0)
+
+    def skip_for(self, seconds):
+        """
+        Lets the spectrometer run for a while, discarding its spectra
+        """
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.receiver.receive(max(deadline - time.monotonic(), 0))
+
+    def close(self):
+        """
+        Shuts the spectrometer process down and releases the shared memory
+        """
+        if self.process.is_alive():
+            try:
+                self.wait_for_ack(self.send_command(SpectroCommand.SHUTDOWN), timeout=5.0)
+            except (TimeoutError, EOFError, OSError):
+                pass
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+        if self.process.ring is not None:
+            self.process.ring.close()
+
+
+def measure_reference(acquisition: HeadlessAcquisition, frames, rejection="none"):
+    """
+    Averages spectra into a dark or bright reference
+    @param frames: number of spectra to average
+    @param rejection: cosmic ray rejection, one of utils.ReferenceAccumulator.REJECTIONS
+    @return: (mean, per-pixel noise)
+    """
+    accumulator = utils.ReferenceAccumulator(acquisition.process.array_size, rejection, expected_frames=frames)
+    for _ in range(frames):
+        accumulator.add(acquisition.next_reading().data)
+    accumulator.finish()
+    return accumulator.mean, accumulator.noise
+
+
+def measure(acquisition: HeadlessAcquisition, total_frames, skip=0, dark=None, bright=None, stream_prefix=None,
+            journal=None, timing=None, progress=None, tracker=None, arm=None):
+    """
+    Collects one measurement with the current integration time. Ctrl+C ends it early, keeping the measured frames
+    @param total_frames: number of frames to receive
+    @param skip: number of frames dropped after each stored one
+    @param dark: dark reference, or None
+    @param bright: bright reference, or None
+    @param stream_prefix: if given, frames are streamed to .npy files starting with this path
+    @param journal: optional MeasurementJournal for crash recovery
+    @param timing: optional FrameTiming receiving every frame
+    @param progress: optional callable receiving (frames received, total_frames)
+    @param tracker: optional PeakTracker analysing every stored frame
+    @param arm: optional TriggerArm, recording then starts when its trigger fires (with its pre-trigger frames)
+    @return: (raw spectra, calculated spectra, timestamps relative to the first frame)
+    """
+    collector = SpectraCollector(total_frames, acquisition.process.array_size, skip, dark is not None,
+                                 bright is not None, dark, bright, stream_prefix=stream_prefix, journal=journal,
+                                 raw_dtype=RAW_DTYPE, meas_dtype=MEAS_DTYPE, setting_id=acquisition.setting_id,
+                                 timing=timing, tracker=tracker, arm=arm)
+    try:
+        while not collector.is_complete:
+            collector.add(acquisition.next_reading())
+            if progress is not None:
+                progress(collector.spectra_counter, total_frames)
+    except KeyboardInterrupt:
+        pass
+    spectra_raw_array, spectra_meas_array, time_meas_array = collector.collected_arrays()
+    if len(time_meas_array):
+        time_meas_array = time_meas_array - time_meas_array[0]
+    return spectra_raw_array, spectra_meas_array, time_meas_array
+
+
+def sample_folder(folder, sample) -> str:
+    """
+    Creates <folder>/<sample>/, or <folder>/<sample>-d#/ if it already exists (same as the GUI)
+    @return: path of the created folder, ending with "/"
+    """
+    folder = folder if folder.endswith("/") else folder + "/"
+    path = folder + sample + "/"
+    retry = 1
+    while os.path.exists(path):
+        path = folder + sample + "-d" + str(retry) + "/"
+        retry += 1
+    os.makedirs(path)
+    return path
+
+
+def metadata(args, serial_number, inttime, start_time, dark_source=None, is_bright_data=False) -> dict:
+    """
+    @return: metadata with the same keys as the GUI's, plus the --meta entries
+    """
+    meta_dict = {"Date": time.strftime("%H:%M:%S - %d.%m.%Y", time.localtime(start_time)),
+                 "Location": utils.get_host_name(),
+                 "Device": serial_number,
+                 "Sample": args.sample,
+                 "User": args.user,
+                 "Folder": args.folder,
+                 "Integration Time (s)": inttime,
+                 "Delay time (s)": args.delay,
+                 "Measurement length (s)": args.duration,
+                 "Averaged Curves": args.average,
+                 "Dark measurement": dark_source is not None,
+                 "Bright measurement": is_bright_data,
+                 "Spike rejection": args.rejection,
+                 "Dark source": dark_source}
+    for entry in args.meta:
+        key, _, value = entry.partition("=")
+        meta_dict[key] = value
+    meta_dict["Comments"] = args.comments
+    return meta_dict
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", help="json file with default values for the options below")
+    parser.add_argument("--sample", help="sample name, used for the folder and file names")
+    parser.add_argument("--folder", default="./", help="parent folder of the sample folder")
+    parser.add_argument("--user", default="")
+    parser.add_argument("--comments", default="")
+    parser.add_argument("--meta", action="append", default=[], metavar="KEY=VALUE",
+                        help="additional metadata entry, can be repeated")
+    parser.add_argument("--inttime", type=float, default=0.2, help="integration time in seconds")
+    parser.add_argument("--duration", type=float, default=10, help="measurement length in seconds")
+    parser.add_argument("--delay", type=float, default=0, help="wait before measuring, in seconds")
+    parser.add_argument("--skip", type=int, default=0, help="frames dropped after each stored one")
+    parser.add_argument("--average", type=int, default=5, help="spectra averaged for dark/bright references")
+    parser.add_argument("--dark", action="store_true", help="measure a dark reference before the measurement")
+    parser.add_argument("--bright", action="store_true", help="measure a bright reference before the measurement")
+    parser.add_argument("--pause", action="store_true",
+                        help="wait for Enter before dark and bright references (to switch the light)")
+    parser.add_argument("--dark-library", action="store_true",
+                        help="use the saved dark for this integration time instead of measuring one if available")
+    parser.add_argument("--interpolate", action="store_true", help="interpolate darks from the library")
+    parser.add_argument("--rejection", choices=utils.ReferenceAccumulator.REJECTIONS, default="none",
+                        help="cosmic ray rejection while averaging references")
+    parser.add_argument("--format", choices=list(FORMATS), default="CSV")
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--raw", action="store_true", help="save raw spectra (csv) instead of calculated ones")
+    parser.add_argument("--stream", action="store_true", help="stream spectra to disk while measuring")
+    parser.add_argument("--rois", default="", metavar="RANGES",
+                        help="wavelength ranges in nm whose peaks are tracked, e.g. \"500-600, 700-750\" "
+                             "(saved as <sample>_peaks.csv)")
+    parser.add_argument("--trigger", choices=TRIGGERS, default=None,
+                        help="wait for a condition before recording: mean intensity in --trigger-roi above or below "
+                             "--trigger-value, changing faster than --trigger-value per second, creation of the file "
+                             "--trigger-value, or a UDP datagram on port --trigger-value")
+    parser.add_argument("--trigger-roi", default="", metavar="RANGE", help="wavelength range in nm, e.g. 500-600")
+    parser.add_argument("--trigger-value", default=None, help="level, rate, file or port, depending on --trigger")
+    parser.add_argument("--pre-trigger", type=float, default=0,
+                        help="seconds before the trigger kept in the measurement (added to --duration)")
+    parser.add_argument("--no-journal", dest="journal", action="store_false",
+                        help="do not keep a crash recovery journal")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="hand spectra over through shared memory instead of a pipe")
+    parser.add_argument("--simulate", action="store_true",
+                        help="use the simulated spectrometer even if a device is connected")
+    parser.add_argument("--frame-rate", type=float, default=None,
+                        help="simulated frames per second (default 1 / inttime, inf for as fast as possible)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the simulated spectrometer")
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="probability of a simulated frame being lost")
+    return parser
+
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+        unknown = set(config) - option_names(parser)
+        if unknown:
+            parser.error("unknown settings in {}: {}".format(args.config, ", ".join(sorted(unknown))))
+        parser.set_defaults(**config)
+        args = parser.parse_args(argv)  # Command line values override the config file
+    if not args.sample:
+        parser.error("--sample is required")
+    try:
+        parse_rois(args.rois)
+    except ValueError:
+        parser.error("--rois must look like \"500-600, 700-750\"")
+    if args.trigger is not None:
+        if args.trigger_value is None:
+            parser.error("--trigger needs --trigger-value")
+        try:
+            is_roi_missing = args.trigger in ("above", "below", "rate") and not parse_rois(args.trigger_roi)
+        except ValueError:
+            is_roi_missing = True
+        if is_roi_missing:
+            parser.error("--trigger {} needs --trigger-roi, e.g. 500-600".format(args.trigger))
+        if args.trigger == "udp":
+            try:
+                make_trigger(args.trigger, None, value=args.trigger_value)
+            except ValueError as error:
+                parser.error("--trigger-value: {}".format(error))
+    return args
+
+
+def option_names(parser=None) -> set:
+    """
+    @return: names of the settings (long options with "_" instead of "-")
+    """
+    parser = build_parser() if parser is None else parser
+    return {action.dest for action in parser._actions} - {"help", "config"}
+
+
+def settings(**overrides) -> argparse.Namespace:
+    """
+    @param overrides: settings by option name
+    @return: default settings updated with the given ones, as parse_args would return them
+    @raise ValueError: for unknown setting names
+    """
+    unknown = set(overrides) - option_names()
+    if unknown:
+        raise ValueError("Unknown settings: " + ", ".join(sorted(unknown)))
+    args = build_parser().parse_args([])
+    vars(args).update(overrides)
+    return args
+
+
+def print_progress(counter, total_frames):
+    sys.stderr.write("\r{}/{} frames".format(counter, total_frames))
+    if counter == total_frames:
+        sys.stderr.write("\n")
+
+
+def reference(acquisition, name, frames, rejection, is_pause):
+    if is_pause:
+        input("Prepare the {} measurement and press Enter".format(name))
+        acquisition.discard_pending()  # Spectra kept coming while waiting
+    print("Measuring {} reference ({} spectra)".format(name, frames))
+    return measure_reference(acquisition, frames, rejection)
+
+
+class References:
+    """
+    Dark and bright references in use, for the integration time they were taken with
+    """
+    def __init__(self):
+        self.dark_mean = self.dark_noise = self.bright_mean = self.bright_noise = None
+        self.dark_source = None
+        self.inttime = None
+
+    def update(self, acquisition: HeadlessAcquisition, args, library: DarkLibrary):
+        """
+        Looks up or measures the references requested in args (--dark-library, --dark, --bright)
+        """
+        if self.inttime != acquisition.inttime:
+            self.__init__()  # Taken with another integration time
+        self.inttime = acquisition.inttime
+        dark = None
+        if args.dark_library:
+            dark = library.lookup(acquisition.serial_number, acquisition.inttime, args.interpolate)
+            if dark is not None:
+                self.dark_mean, self.dark_noise = dark.mean, dark.noise
+                self.dark_source = "Interpolated" if dark.is_interpolated else "From library"
+        if args.dark and dark is None:
+            self.dark_mean, self.dark_noise = reference(acquisition, "dark", args.average, args.rejection, args.pause)
+            self.dark_source = "Measured"
+            if acquisition.process.is_spectrometer:  # Demo spectra would be taken for the dark of the spectrometer
+                try:
+                    library.save(acquisition.serial_number, acquisition.inttime, self.dark_mean, self.dark_noise)
+                except OSError as error:
+                    print("Dark spectra could not be saved to the library: " + str(error))
+        if args.bright:
+            self.bright_mean, self.bright_noise = reference(acquisition, "bright", args.average, args.rejection,
+                                                            args.pause)
+
+
+def acquire(acquisition: HeadlessAcquisition, args, refs: References) -> ExportJob:
+    """
+    Measures one sample with the current integration time and references
+    @param args: settings (sample, folder, duration, skip, delay, saving options and metadata)
+    @return: export job holding the measurement, not saved yet
+    """
+    folder = sample_folder(args.folder, args.sample)
+    acquisition.skip_for(args.delay)
+    start_time = time.time()
+    meta_dict = metadata(args, acquisition.serial_number, acquisition.inttime, start_time, refs.dark_source,
+                         refs.bright_mean is not None)
+    job = ExportJob(folder, args.sample, meta_dict, acquisition.process.xdata, None, None, None,
+                    dark_mean=refs.dark_mean, bright_mean=refs.bright_mean, dark_noise=refs.dark_noise,
+                    bright_noise=refs.bright_noise, is_dark_data=refs.dark_mean is not None,
+                    is_bright_data=refs.bright_mean is not None, is_show_raw=args.raw, is_heatplot=False,
+                    file_format=args.format, is_compressed=args.compress)
+    measurement_journal = None
+    if args.journal:
+        measurement_journal = journal.MeasurementJournal(job, acquisition.process.array_size,
+                                                         raw_dtype=RAW_DTYPE, meas_dtype=MEAS_DTYPE)
+        job.journal_path = str(measurement_journal.path)
+    timing = FrameTiming(acquisition.inttime)
+    rois = parse_rois(args.rois)
+    tracker = PeakTracker(acquisition.process.xdata, rois) if rois else None
+    total_frames = max(int(np.ceil(args.duration / acquisition.inttime)), 1)
+    arm = None
+    if args.trigger is not None:
+        pre_frames = int(np.ceil(args.pre_trigger / acquisition.inttime))
+        arm = TriggerArm(trigger_from_settings(args, acquisition.process.xdata), pre_frames,
+                         acquisition.process.array_size, RAW_DTYPE)
+        total_frames += pre_frames
+        print("Armed, waiting for the {} trigger (Ctrl+C to give up)".format(args.trigger))
+    print("Measuring {} frames of {:g} s into {}".format(total_frames, acquisition.inttime, folder))
+    job.spectra_raw_array, job.spectra_meas_array, job.time_meas_array = measure(
+        acquisition, total_frames, args.skip, refs.dark_mean, refs.bright_mean,
+        stream_prefix=folder + args.sample + "_stream" if args.stream else None,
+        journal=measurement_journal, timing=timing, progress=print_progress, tracker=tracker, arm=arm)
+    job.meta_dict.update(timing.metadata())
+    if tracker is not None:
+        job.meta_dict["Peak ROIs (nm)"] = args.rois
+        tracker.save(folder + args.sample + "_peaks.csv")
+    return job
+
+
+def save_job(job: ExportJob, progress=None) -> str:
+    """
+    Saves a measurement and removes its journal
+    @param progress: optional callable receiving the written fraction (0 to 1)
+    @return: path of the saved file
+    """
+    save(job, progress)
+    if job.journal_path is not None:
+        journal.discard(job.journal_path)
+    return job.filename
+
+
+def trigger_from_settings(args, xdata):
+    """
+    @return: trigger described by the --trigger options
+    @raise ValueError: for invalid settings
+    """
+    rois = parse_rois(args.trigger_roi)
+    return make_trigger(args.trigger, xdata, rois[0] if rois else None, args.trigger_value)
+
+
+def simulator(args):
+    """
+    @return: SimulatedSpectrometer configured by the --simulate options, or None to use a connected spectrometer
+    """
+    if not args.simulate:
+        return None
+    return SimulatedSpectrometer(seed=args.seed, frame_rate=args.frame_rate, drop_rate=args.drop_rate)
+
+
+def set_integration_time(acquisition: HeadlessAcquisition, inttime) -> float:
+    applied = acquisition.set_integration_time(inttime)
+    if round(applied * 1000000) != round(inttime * 1000000):
+        print("Integration time limited to {:g} s by the spectrometer".format(applied))
+    return applied
+
+
+def run(args) -> str:
+    """
+    Runs one measurement as described by the command line arguments
+    @return: path of the saved file
+    """
+    with HeadlessAcquisition(args.shared_memory, simulator(args)) as acquisition:
+        set_integration_time(acquisition, args.inttime)
+        refs = References()
+        refs.update(acquisition, args, DarkLibrary())
+        job = acquire(acquisition, args, refs)
+    if not len(job.time_meas_array):
+        if job.journal_path is not None:
+            journal.discard(job.journal_path)
+        print("\nNot triggered, nothing was saved")
+        return None
+    filename = save_job(job, lambda fraction: sys.stderr.write("\rSaving {:.0%}".format(fraction)))
+    print("\nSaved " + filename)
+    return filename
+
+
+if __name__ == "__main__":
+    freeze_support()  # Required when doing multiprocessing on Windows
+    run(parse_args())
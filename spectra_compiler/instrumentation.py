@@ -0,0 +1,182 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import csv
+import json
+import time
+import numpy as np
+
+#  Points in the life of a frame, in order. Each reading can carry one time.perf_counter() stamp per stage
+#  (perf_counter is a system-wide monotonic clock, so stamps taken in the spectrometer process compare with ours)
+STAGES = ("acquire", "send", "receive", "emit", "gather", "correct", "render")
+ACQUIRE, SEND, RECEIVE, EMIT, GATHER, CORRECT, RENDER = range(len(STAGES))
+#  Stage each latency is measured from. Gathering and rendering are separate branches after the emitter
+PREVIOUS = {SEND: ACQUIRE, RECEIVE: SEND, EMIT: RECEIVE, GATHER: EMIT, CORRECT: GATHER, RENDER: EMIT}
+TOTAL = "total"  # acquire to render
+
+
+def new_stamps() -> np.ndarray:
+    """
+    @return: stamps of a new frame, with the acquire stage set to now
+    """
+    stamps = np.full(len(STAGES), np.nan)
+    stamps[ACQUIRE] = time.perf_counter()
+    return stamps
+
+
+class LatencyMonitor:
+    """
+    Rolling per-stage latency statistics of the acquisition pipeline.
+    Every stage keeps its last `window` latencies (time since the PREVIOUS stage of the same frame) in a
+    fixed ring, so recording a frame costs a few array writes. Percentiles are only computed when asked for.
+    Each stage is stamped by a single thread, so rings are written without locking
+    """
+
+    def __init__(self, window=1024):
+        """
+        @param window: number of recent frames the statistics are computed over
+        """
+        self.window = window
+        self.dropped_source = None  # Optional callable returning the number of frames lost in transport
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all statistics, e.g. when a new measurement starts
+        """
+        names = STAGES[1:] + (TOTAL,)
+        self._latencies = {name: np.full(self.window, np.nan) for name in names}
+        self._counts = dict.fromkeys(names, 0)
+        self._arrivals = np.full(self.window, np.nan)
+        self._n_frames = 0
+        self._dropped_at_reset = self._dropped()
+        self.start_time = time.perf_counter()
+
+    def _dropped(self) -> int:
+        return 0 if self.dropped_source is None else int(self.dropped_source())
+
+    def _record(self, name, latency):
+        self._latencies[name][self._counts[name] % self.window] = latency
+        self._counts[name] += 1
+
+    def stamp(self, stamps, stage):
+        """
+        Stamps a frame at a stage and records the time it spent since its previous stage (if that was stamped)
+        @param stamps: stamps of the frame (modified in place), None if the frame is not instrumented
+        @param stage: index in STAGES
+        """
+        if stamps is None:
+            return
+        now = time.perf_counter()
+        stamps[stage] = now
+        if stage in PREVIOUS and not np.isnan(stamps[PREVIOUS[stage]]):
+            self._record(STAGES[stage], now - stamps[PREVIOUS[stage]])
+        if stage == RECEIVE:
+            self._arrivals[self._n_frames % self.window] = now
+            self._n_frames += 1
+        elif stage == RENDER and not np.isnan(stamps[ACQUIRE]):
+            self._record(TOTAL, now - stamps[ACQUIRE])
+
+    def stamp_block(self, stamps, stage):
+        """
+        Same as stamp for a (n, len(STAGES)) block of frames handled together
+        """
+        if stamps is None:
+            return
+        for row in stamps:
+            self.stamp(row, stage)
+
+    @property
+    def frames_per_second(self) -> float:
+        """
+        Rate at which frames arrived from the spectrometer process, over the window
+        """
+        arrivals = self._arrivals[~np.isnan(self._arrivals)]
+        if len(arrivals) < 2:
+            return 0.0
+        return (len(arrivals) - 1) / (arrivals.max() - arrivals.min())
+
+    @property
+    def dropped(self) -> int:
+        """
+        Frames lost in transport since the last reset
+        """
+        return self._dropped() - self._dropped_at_reset
+
+    def stats(self) -> dict:
+        """
+        @return: per stage: number of frames, mean, p50, p99 and max latency in ms over the window
+        """
+        stats = {}
+        for name, latencies in self._latencies.items():
+            latencies = latencies[~np.isnan(latencies)] * 1000
+            if len(latencies):
+                p50, p99 = np.percentile(latencies, [50, 99])
+                stats[name] = {"frames": self._counts[name], "mean_ms": float(latencies.mean()),
+                               "p50_ms": float(p50), "p99_ms": float(p99), "max_ms": float(latencies.max())}
+        return stats
+
+    def summary(self) -> str:
+        """
+        @return: one line for the status bar
+        """
+        text = "{:.1f} fps".format(self.frames_per_second)
+        total = self.stats().get(TOTAL)
+        if total is not None:
+            text += " | latency p50 {:.1f} ms, p99 {:.1f} ms".format(total["p50_ms"], total["p99_ms"])
+        return text + " | dropped {}".format(self.dropped)
+
+    def save(self, path):
+        """
+        Writes the statistics of the run, as json or as a csv table depending on the file extension
+        @param path: .json or .csv file
+        """
+        stats = self.stats()
+        path = str(path)
+        if path.endswith(".json"):
+            with open(path, "w") as file:
+                json.dump({"duration_s": time.perf_counter() - self.start_time,
+                           "frames_per_second": self.frames_per_second,
+                           "dropped": self.dropped, "stages": stats}, file, indent=2)
+            return
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["stage", "frames", "mean_ms", "p50_ms", "p99_ms", "max_ms"])
+            for name, values in stats.items():
+                writer.writerow([name, values["frames"], values["mean_ms"], values["p50_ms"], values["p99_ms"],
+                                 values["max_ms"]])
+
+
+class StartupTimer:
+    """
+    Durations of the startup phases (imports, device discovery, window, first frame), to see where a cold start
+    spends its time. For a per-module breakdown of the imports, run python -X importtime main.py
+    """
+
+    def __init__(self, start=None):
+        """
+        @param start: time.perf_counter() at program start, now if None
+        """
+        self.start = time.perf_counter() if start is None else start
+        self._last = self.start
+        self.phases = {}  # name: seconds since the previous phase ended
+
+    def mark(self, name):
+        """
+        Ends a startup phase
+        """
+        now = time.perf_counter()
+        self.phases[name] = now - self._last
+        self._last = now
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Seconds from program start to the end of the last phase
+        """
+        return self._last - self.start
+
+    def summary(self) -> str:
+        return "Startup {:.2f} s ({})".format(
+            self.elapsed, ", ".join("{} {:.2f} s".format(name, seconds) for name, seconds in self.phases.items()))
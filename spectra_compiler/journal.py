@@ -0,0 +1,163 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import json
+import os
+import pathlib
+import time
+import numpy as np
+from spectra_compiler.export import ExportJob
+
+JOURNAL_FOLDER = pathlib.Path.home() / ".spectra_compiler" / "journals"
+JOURNAL_SUFFIX = ".journal"
+
+
+class MeasurementJournal:
+    """
+    Append-only file holding a measurement while it is running, so it can be recovered after a crash.
+    The first line is a json header with everything needed to save the measurement (see ExportJob),
+    followed by fixed-size binary records: timestamp, raw spectrum, calculated spectrum.
+    Records are buffered and written to disk (flushed and synced) every checkpoint_frames frames
+    or checkpoint_seconds seconds, whichever comes first.
+    The journal is removed once the measurement has been saved.
+    """
+
+    def __init__(self, job: ExportJob, array_size, checkpoint_frames=100, checkpoint_seconds=10.0,
+                 folder=JOURNAL_FOLDER, raw_dtype=np.float64, meas_dtype=np.float64, path=None):
+        """
+        @param job: export settings of the measurement, its arrays are not used
+        @param array_size: number of values per spectrum
+        @param checkpoint_frames: maximum number of frames kept only in memory
+        @param checkpoint_seconds: maximum time between writes to disk
+        @param folder: where journals are kept
+        @param path: journal file, from new_path() in folder if None
+        """
+        self.path = new_path(job.sample, folder) if path is None else pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.record_dtype = record_dtype(array_size, raw_dtype, meas_dtype)
+        self.checkpoint_frames = checkpoint_frames
+        self.checkpoint_seconds = checkpoint_seconds
+        self._buffer = np.empty(checkpoint_frames, dtype=self.record_dtype)
+        self._fill = 0
+        self._last_checkpoint = time.monotonic()
+        header = {"folder": job.folder, "sample": job.sample, "meta_dict": job.meta_dict,
+                  "xdata": np.asarray(job.xdata).tolist(),
+                  "dark_mean": None if job.dark_mean is None else np.asarray(job.dark_mean).tolist(),
+                  "bright_mean": None if job.bright_mean is None else np.asarray(job.bright_mean).tolist(),
+                  "dark_noise": None if job.dark_noise is None else np.asarray(job.dark_noise).tolist(),
+                  "bright_noise": None if job.bright_noise is None else np.asarray(job.bright_noise).tolist(),
+                  "is_dark_data": job.is_dark_data, "is_bright_data": job.is_bright_data,
+                  "is_show_raw": job.is_show_raw, "is_heatplot": job.is_heatplot,
+                  "file_format": job.file_format, "is_compressed": job.is_compressed,
+                  "array_size": array_size, "raw_dtype": np.dtype(raw_dtype).str,
+                  "meas_dtype": np.dtype(meas_dtype).str}
+        self._file = open(self.path, "wb")
+        self._file.write(json.dumps(header, default=str).encode() + b"\n")
+        self._sync()
+
+    def append(self, ydata, yarray, timestamp):
+        """
+        Adds one frame, writing a checkpoint when due
+        @param ydata: raw spectrum
+        @param yarray: calculated spectrum
+        @param timestamp: acquisition time
+        """
+        record = self._buffer[self._fill]
+        record["time"] = timestamp
+        record["raw"] = ydata
+        record["meas"] = yarray
+        self._fill += 1
+        if self._fill == self.checkpoint_frames or \
+                time.monotonic() - self._last_checkpoint >= self.checkpoint_seconds:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Writes buffered frames and makes sure they reached the disk
+        """
+        if self._fill:
+            self._file.write(self._buffer[:self._fill].tobytes())
+            self._fill = 0
+        self._sync()
+        self._last_checkpoint = time.monotonic()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Writes the last frames. The file stays on disk until discard() is called
+        """
+        if not self._file.closed:
+            self.checkpoint()
+            self._file.close()
+
+
+def new_path(sample, folder=JOURNAL_FOLDER) -> pathlib.Path:
+    """
+    @return: path for the journal of a measurement starting now
+    """
+    return pathlib.Path(folder) / (time.strftime("%Y%m%d-%H%M%S_") + sample + JOURNAL_SUFFIX)
+
+
+def record_dtype(array_size, raw_dtype=np.float64, meas_dtype=np.float64) -> np.dtype:
+    return np.dtype([("time", "<f8"), ("raw", raw_dtype, (array_size,)), ("meas", meas_dtype, (array_size,))])
+
+
+def find_journals(folder=JOURNAL_FOLDER) -> list:
+    """
+    @param folder: where journals are kept
+    @return: paths of journals left behind by measurements that were never saved
+    """
+    folder = pathlib.Path(folder)
+    if not folder.exists():
+        return []
+    return sorted(folder.glob("*" + JOURNAL_SUFFIX))
+
+
+def recover(path) -> ExportJob:
+    """
+    Rebuilds a measurement from a journal. An incomplete last record (crash while writing) is ignored
+    @param path: journal file
+    @return: export job with the recovered frames, saved under the original folder and sample name
+    """
+    with open(path, "rb") as file:
+        header = json.loads(file.readline())
+        dtype = record_dtype(header["array_size"], header["raw_dtype"], header["meas_dtype"])
+        records = np.frombuffer(file.read(), dtype=np.uint8)
+    n_frames = len(records) // dtype.itemsize
+    records = records[:n_frames * dtype.itemsize].view(dtype)
+    time_meas_array = records["time"] - records["time"][0] if n_frames else records["time"]
+    header["meta_dict"]["Recovered from"] = str(path)
+    job = ExportJob(folder=header["folder"],
+                    sample=header["sample"],
+                    meta_dict=header["meta_dict"],
+                    xdata=np.array(header["xdata"]),
+                    spectra_raw_array=records["raw"],
+                    spectra_meas_array=records["meas"],
+                    time_meas_array=time_meas_array,
+                    dark_mean=None if header["dark_mean"] is None else np.array(header["dark_mean"]),
+                    bright_mean=None if header["bright_mean"] is None else np.array(header["bright_mean"]),
+                    dark_noise=None if header.get("dark_noise") is None else np.array(header["dark_noise"]),
+                    bright_noise=None if header.get("bright_noise") is None else np.array(header["bright_noise"]),
+                    is_dark_data=header["is_dark_data"],
+                    is_bright_data=header["is_bright_data"],
+                    is_show_raw=header["is_show_raw"],
+                    is_heatplot=header["is_heatplot"],
+                    file_format=header["file_format"],
+                    is_compressed=header["is_compressed"],
+                    journal_path=str(path))
+    return job
+
+
+def discard(path):
+    """
+    Removes a journal once its measurement is safely saved
+    @param path: journal file
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
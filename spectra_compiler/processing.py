@@ -0,0 +1,302 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import Process, Queue, Pipe
+from queue import Empty
+import numpy as np
+from spectra_compiler import utils, journal
+from spectra_compiler.analysis import PeakTracker
+from spectra_compiler.collector import SpectraCollector
+from spectra_compiler.generator import SpectroAck, SpectroCommand, RAW_DTYPE, MEAS_DTYPE
+from spectra_compiler.timing import FrameTiming
+from spectra_compiler.trigger import TriggerArm
+from spectra_compiler.transport import SpectraReceiver
+
+
+class ProcessingCommand:
+    """
+    Instruction from the GUI to the processing process, sent through its Queue
+    """
+    MEASURE = "measure"  # value: MeasurementPlan
+    STOP = "stop"  # Ends the running measurement early, keeping the frames gathered
+    AVERAGE = "average"  # value: ReferencePlan, dark or bright reference
+    REFERENCES = "references"  # value: (is_dark_data, is_bright_data, dark_mean, bright_mean) for the live view
+    VIEW = "view"  # value: (start, stop, n_pixels), pixels of the spectrum shown and the plot width
+    SHUTDOWN = "shutdown"
+
+    def __init__(self, name, value=None):
+        self.name: str = name
+        self.value = value
+
+
+class MeasurementPlan:
+    """
+    Everything the processing process needs to gather a measurement (see SpectraCollector)
+    """
+    def __init__(self, total_frames, skip, is_dark_data, is_bright_data, dark_mean, bright_mean, stream_prefix=None,
+                 journal_job=None, journal_path=None, setting_id=None, nominal_period=None,
+                 is_frame_gathered=False, raw_dtype=RAW_DTYPE, meas_dtype=MEAS_DTYPE, rois=None, trigger=None,
+                 pre_frames=0):
+        """
+        @param stream_prefix: files the measurement is streamed to (see SpectraStore), None for temporary ones
+        @param journal_job: ExportJob (without arrays) for the crash recovery journal, None for no journal
+        @param journal_path: journal file, see journal.new_path
+        @param nominal_period: integration time in seconds, for the timing metadata
+        @param is_frame_gathered: send the calculated spectra of the stored frames back (live waterfall)
+        @param rois: wavelength ranges (nm) whose peaks are tracked in every stored frame, None for no tracking
+        @param trigger: trigger (see trigger.make_trigger) the recording waits for, None to start immediately
+        @param pre_frames: frames before the trigger kept in the measurement (included in total_frames)
+        """
+        self.total_frames = total_frames
+        self.skip = skip
+        self.is_dark_data = is_dark_data
+        self.is_bright_data = is_bright_data
+        self.dark_mean = dark_mean
+        self.bright_mean = bright_mean
+        self.stream_prefix = stream_prefix
+        self.journal_job = journal_job
+        self.journal_path = journal_path
+        self.setting_id = setting_id
+        self.nominal_period = nominal_period
+        self.is_frame_gathered = is_frame_gathered
+        self.raw_dtype = raw_dtype
+        self.meas_dtype = meas_dtype
+        self.rois = rois
+        self.trigger = trigger
+        self.pre_frames = pre_frames
+
+
+class ReferencePlan:
+    def __init__(self, frames, rejection="none", setting_id=None):
+        self.frames: int = frames  # Spectra to average
+        self.rejection: str = rejection  # One of utils.ReferenceAccumulator.REJECTIONS
+        self.setting_id: int = setting_id  # Readings acquired under another integration time are ignored
+
+
+class DisplayFrame:
+    """
+    Newest spectrum, corrected and min/max decimated to the plot width, sent at most once per display interval
+    """
+    def __init__(self, timestamp, setting_id, x, raw, processed, stamps=None):
+        self.timestamp: float = timestamp
+        self.setting_id: int = setting_id
+        self.x: np.ndarray = x  # Decimated wavelengths
+        self.raw: np.ndarray = raw  # Decimated raw spectrum
+        self.processed: np.ndarray = processed  # Decimated calculated spectrum
+        self.stamps: np.ndarray = stamps
+
+
+class MeasurementUpdate:
+    def __init__(self, counter, frames=None, peaks=None):
+        self.counter: int = counter  # Frames received so far
+        self.frames: np.ndarray = frames  # (n, array_size) calculated spectra stored since the last update, or None
+        self.peaks: tuple = peaks  # (timestamps, values) tracked since the last update (see PeakTracker), or None
+
+
+class MeasurementDone:
+    def __init__(self, stream_prefix, journal_path, timing):
+        self.stream_prefix: str = stream_prefix  # Files to map the arrays from (see open_streamed_arrays)
+        self.journal_path: str = journal_path
+        self.timing: FrameTiming = timing
+
+
+class ReferenceDone:
+    def __init__(self, mean, noise, rejected):
+        self.mean: np.ndarray = mean
+        self.noise: np.ndarray = noise
+        self.rejected: int = rejected  # Spike values replaced
+
+
+MESSAGES = (MeasurementUpdate, MeasurementDone, ReferenceDone)  # Sent to the GUI besides DisplayFrame and SpectroAck
+
+
+def open_streamed_arrays(prefix):
+    """
+    @return: (raw, calculated, timestamps) memory maps of a measurement streamed by SpectraStore
+    """
+    return tuple(np.load(prefix + suffix, mmap_mode="r") for suffix in ("_raw.npy", "_processed.npy", "_time.npy"))
+
+
+class ProcessingProcess(Process):
+    """
+    Sits between the spectrometer process and the GUI, so corrections, averaging and gathering run on their own
+    core instead of sharing the GUI's interpreter lock with Qt and matplotlib.
+    Receives every raw frame, gathers measurements and references, and sends the GUI only display frames
+    (at most one per display_interval), progress, and the results. Command acknowledgements are forwarded.
+    Measurements are always streamed to .npy files (to a temporary folder unless the plan names them), so only
+    their file names go through the Pipe
+    """
+
+    def __init__(self, from_spectrometer: Pipe, to_gui: Pipe, from_mother: Queue, xdata, ring=None, daemon=True,
+                 display_interval=0.02):
+        """
+        @param from_spectrometer: receiving end of the spectrometer process' Pipe
+        @param to_gui: sending end of the Pipe read by the Emitter
+        @param from_mother: Queue of ProcessingCommand
+        @param ring: shared memory ring of the spectrometer process, if it uses one
+        @param display_interval: shortest time between display frames, in seconds
+        """
+        super().__init__()
+        self.daemon = daemon
+        self.from_spectrometer = from_spectrometer
+        self.to_gui = to_gui
+        self.data_from_mother = from_mother
+        self.xdata = np.asarray(xdata)
+        self.array_size = len(self.xdata)
+        self.ring = ring
+        self.display_interval = display_interval
+
+    def handle_commands(self) -> bool:
+        """
+        Applies every command waiting in the queue
+        @return: False once the process has to stop
+        """
+        while True:
+            try:
+                command = self.data_from_mother.get_nowait()
+            except Empty:
+                return True
+            if command.name == ProcessingCommand.MEASURE:
+                self.start_measurement(command.value)
+            elif command.name == ProcessingCommand.STOP:
+                if self.collector is not None:
+                    self.finish_measurement()
+            elif command.name == ProcessingCommand.AVERAGE:
+                self.reference_plan = command.value
+                self.accumulator = utils.ReferenceAccumulator(self.array_size, command.value.rejection,
+                                                              expected_frames=command.value.frames)
+                self.reference_counter = 0
+            elif command.name == ProcessingCommand.REFERENCES:
+                self.corrector = utils.SpectraCorrector(*command.value)
+            elif command.name == ProcessingCommand.VIEW:
+                self.set_view(*command.value)
+            elif command.name == ProcessingCommand.SHUTDOWN:
+                return False
+
+    def set_view(self, start, stop, n_pixels):
+        """
+        @param start: first pixel shown
+        @param stop: last pixel shown + 1
+        @param n_pixels: plot width, one min/max bin per pixel
+        """
+        self._view = slice(start, stop)
+        self._edges = utils.decimation_edges(stop - start, n_pixels)
+        self._x_display = utils.minmax_decimate(self.xdata[self._view], self._edges)
+
+    def start_measurement(self, plan: MeasurementPlan):
+        measurement_journal = None
+        if plan.journal_job is not None:
+            measurement_journal = journal.MeasurementJournal(plan.journal_job, self.array_size,
+                                                             raw_dtype=plan.raw_dtype, meas_dtype=plan.meas_dtype,
+                                                             path=plan.journal_path)
+        self.plan = plan
+        self.stream_prefix = plan.stream_prefix
+        if self.stream_prefix is None:
+            self._n_scratch += 1  # Previous measurements may still be mapped by the GUI
+            self.stream_prefix = os.path.join(self._scratch, "measurement_{}".format(self._n_scratch))
+        self.timing = FrameTiming(plan.nominal_period)
+        self.tracker = None if not plan.rois else PeakTracker(self.xdata, plan.rois)
+        self._peaks_sent = 0
+        arm = None
+        if plan.trigger is not None:
+            arm = TriggerArm(plan.trigger, plan.pre_frames, self.array_size, plan.raw_dtype)
+        self.collector = SpectraCollector(plan.total_frames, self.array_size, plan.skip, plan.is_dark_data,
+                                          plan.is_bright_data, plan.dark_mean, plan.bright_mean,
+                                          stream_prefix=self.stream_prefix, journal=measurement_journal,
+                                          raw_dtype=plan.raw_dtype, meas_dtype=plan.meas_dtype,
+                                          setting_id=plan.setting_id, timing=self.timing, tracker=self.tracker,
+                                          arm=arm)
+        self._gathered = []
+
+    def send_update(self):
+        frames = np.stack(self._gathered) if self._gathered else None
+        self._gathered = []
+        peaks = None
+        if self.tracker is not None:
+            peaks = self.tracker.since(self._peaks_sent)
+            self._peaks_sent = self.tracker.n_frames
+        self.to_gui.send(MeasurementUpdate(self.collector.spectra_counter, frames, peaks))
+
+    def finish_measurement(self):
+        """
+        Hands the gathered spectra over as the names of the files they were streamed to
+        """
+        self.send_update()
+        self.collector.collected_arrays()  # Closes the files
+        journal_path = None if self.plan.journal_job is None else str(self.collector.journal.path)
+        self.to_gui.send(MeasurementDone(self.stream_prefix, journal_path, self.timing))
+        self.collector = None
+
+    def process_reading(self, reading):
+        """
+        Gathers a raw frame into the running measurement and reference, and displays it when due
+        """
+        if self.collector is not None:
+            yarray = self.collector.add(reading)
+            if yarray is not None and self.plan.is_frame_gathered:
+                self._gathered.append(np.array(yarray))  # yarray is a reused buffer
+            if self.collector.is_complete:
+                self.finish_measurement()
+        if self.accumulator is not None and (self.reference_plan.setting_id is None or
+                                             reading.setting_id == self.reference_plan.setting_id):
+            self.accumulator.add(reading.data)
+            self.reference_counter += 1
+            if self.reference_counter == self.reference_plan.frames:
+                self.accumulator.finish()
+                self.to_gui.send(ReferenceDone(self.accumulator.mean, self.accumulator.noise,
+                                               int(self.accumulator.rejected.sum())))
+                self.accumulator = None
+        self._latest = reading
+        now = time.perf_counter()
+        if now >= self._next_display:
+            self._next_display = now + self.display_interval
+            self.send_display()
+            if self.collector is not None:
+                self.send_update()
+
+    def send_display(self):
+        reading = self._latest
+        raw = reading.data[self._view]
+        processed = self.corrector.apply(reading.data, out=self._yarray)[self._view]
+        self.to_gui.send(DisplayFrame(reading.timestamp, reading.setting_id, self._x_display,
+                                      utils.minmax_decimate(raw, self._edges),
+                                      utils.minmax_decimate(processed, self._edges), reading.stamps))
+
+    def run(self):
+        receiver = SpectraReceiver(self.from_spectrometer, self.ring)
+        self.collector = None
+        self.plan = None
+        self.stream_prefix = None
+        self._scratch = tempfile.mkdtemp(prefix="spectra_compiler_")
+        self._n_scratch = 0
+        self.timing = None
+        self.accumulator = None
+        self.reference_plan = None
+        self.reference_counter = 0
+        self.corrector = utils.SpectraCorrector(False, False, None, None)
+        self._yarray = np.empty(self.array_size)
+        self._latest = None
+        self._next_display = 0.0
+        self._gathered = []
+        self.set_view(0, self.array_size, 1000)
+        while self.handle_commands():
+            try:
+                item = receiver.receive(0.1)
+            except EOFError:
+                break
+            if item is None:
+                continue
+            if isinstance(item, SpectroAck):
+                self.to_gui.send(item)
+                if item.name == SpectroCommand.SHUTDOWN:
+                    break
+                continue
+            self.process_reading(item)
+        if self.collector is not None:
+            self.collector.collected_arrays()  # Closes the journal, which is kept to recover the measurement
+        shutil.rmtree(self._scratch, ignore_errors=True)  # Files still mapped by the GUI stay readable on POSIX
@@ -0,0 +1,177 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Runs a list of measurement steps back to back in headless mode, with the spectrometer running the whole time.
+Each measurement is saved in a background thread while the next step is already running, and a timing report
+of every step is printed and saved at the end (sequence_report_<date>.json and .csv in the folder).
+
+Usage, from the repository root:
+    python -m spectra_compiler.sequence sequence.json
+
+Sequence file:
+    {"settings": {"folder": "data/", "user": "EN", "format": "HDF5", "average": 20},
+     "steps": [{"action": "inttime", "inttime": 0.1},
+               {"action": "prompt", "message": "Switch the light off"},
+               {"action": "dark"},
+               {"action": "prompt", "message": "Switch the light on"},
+               {"action": "bright"},
+               {"action": "acquire", "sample": "S1", "duration": 60},
+               {"action": "wait", "seconds": 30},
+               {"action": "acquire", "sample": "S2", "duration": 600, "skip": 4}]}
+
+"settings" and the steps accept the headless options (long names with "_", see headless --help).
+References are kept until the integration time changes.
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import freeze_support
+from spectra_compiler import headless, journal
+from spectra_compiler.darks import DarkLibrary
+
+ACTIONS = ("inttime", "dark", "bright", "wait", "prompt", "acquire")
+
+
+def check_steps(steps, common):
+    """
+    Validates a sequence before anything is measured
+    @raise ValueError: for unknown actions or settings, or acquire steps without sample name
+    """
+    headless.settings(**common)
+    for number, step in enumerate(steps, 1):
+        step = dict(step)
+        action = step.pop("action", None)
+        if action not in ACTIONS:
+            raise ValueError("Step {}: unknown action {!r}, use one of {}".format(number, action, ", ".join(ACTIONS)))
+        step.pop("seconds" if action == "wait" else "message" if action == "prompt" else None, None)
+        headless.settings(**step)
+        if action == "acquire" and not {**common, **step}.get("sample"):
+            raise ValueError("Step {}: acquire needs a sample name".format(number))
+
+
+def timed_save(job):
+    start = time.perf_counter()
+    filename = headless.save_job(job)
+    return filename, time.perf_counter() - start
+
+
+def run_sequence(steps, common=None, use_shared_memory=False) -> list:
+    """
+    Executes the steps in order
+    @param steps: list of step dictionaries (see module docstring)
+    @param common: settings shared by all steps
+    @param use_shared_memory: hand spectra over through shared memory
+    @return: report, one dictionary per step
+    """
+    common = {} if common is None else common
+    check_steps(steps, common)
+    report = []
+    exports = []  # (report entry, future)
+    library = DarkLibrary()
+    refs = headless.References()
+    defaults = headless.settings(**common)
+    with ThreadPoolExecutor(max_workers=1) as exporter, \
+            headless.HeadlessAcquisition(use_shared_memory, headless.simulator(defaults)) as acquisition:
+        headless.set_integration_time(acquisition, defaults.inttime)
+        for number, step in enumerate(steps, 1):
+            step = dict(step)
+            action = step.pop("action")
+            seconds = step.pop("seconds", 0) if action == "wait" else 0
+            message = step.pop("message", "Press Enter to continue") if action == "prompt" else None
+            args = headless.settings(**{**common, **step})
+            entry = {"step": number, "action": action, "sample": args.sample if action == "acquire" else "",
+                     "start": time.strftime("%H:%M:%S - %d.%m.%Y"), "duration_s": None, "frames": None,
+                     "export_s": None, "file": "", "status": "ok"}
+            report.append(entry)
+            print("Step {}/{}: {}".format(number, len(steps), action))
+            start = time.perf_counter()
+            try:
+                if "inttime" in step or action == "inttime":
+                    headless.set_integration_time(acquisition, args.inttime)
+                if action == "dark":
+                    args.dark, args.bright, args.dark_library = True, False, False  # Always measure a new dark
+                    refs.update(acquisition, args, library)
+                elif action == "bright":
+                    args.dark, args.bright, args.dark_library = False, True, False
+                    refs.update(acquisition, args, library)
+                elif action == "wait":
+                    acquisition.skip_for(seconds)
+                elif action == "prompt":
+                    input(message)
+                    acquisition.discard_pending()  # Spectra taken before the change are not used by the next step
+                elif action == "acquire":
+                    args.dark = args.bright = False  # Only use (or look up) references, measure them in their steps
+                    refs.update(acquisition, args, library)
+                    job = headless.acquire(acquisition, args, refs)
+                    entry["frames"] = len(job.time_meas_array)
+                    if not entry["frames"]:
+                        entry["status"] = "not triggered"
+                        if job.journal_path is not None:
+                            journal.discard(job.journal_path)
+                        continue
+                    entry["file"] = job.filename
+                    exports.append((entry, exporter.submit(timed_save, job)))
+            except Exception as error:
+                entry["status"] = "failed: " + str(error)
+                print("Step {} failed, stopping the sequence: {}".format(number, error))
+                break
+            finally:
+                entry["duration_s"] = round(time.perf_counter() - start, 3)
+        print("Waiting for {} export(s)".format(sum(not future.done() for _, future in exports)))
+        for entry, future in exports:
+            try:
+                entry["file"], export_time = future.result()
+                entry["export_s"] = round(export_time, 3)
+            except Exception as error:
+                entry["status"] = "saving failed: " + str(error)
+    return report
+
+
+def print_report(report):
+    print("{:>4}  {:<8} {:<20} {:>10} {:>8} {:>10}  {}".format("step", "action", "sample", "duration_s", "frames",
+                                                               "export_s", "status"))
+    for entry in report:
+        print("{:>4}  {:<8} {:<20} {:>10} {:>8} {:>10}  {}".format(
+            entry["step"], entry["action"], entry["sample"], entry["duration_s"], "" if entry["frames"] is None
+            else entry["frames"], "" if entry["export_s"] is None else entry["export_s"], entry["status"]))
+
+
+def save_report(report, folder):
+    """
+    Writes the report as json and csv into the folder
+    @return: path of the json file
+    """
+    folder = folder if folder.endswith("/") else folder + "/"
+    path = folder + time.strftime("sequence_report_%Y%m%d-%H%M%S")
+    with open(path + ".json", "w") as file:
+        json.dump(report, file, indent=2)
+    with open(path + ".csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(report[0]))
+        writer.writeheader()
+        writer.writerows(report)
+    return path + ".json"
+
+
+if __name__ == "__main__":
+    freeze_support()  # Required when doing multiprocessing on Windows
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sequence", help="json file with the steps")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="hand spectra over through shared memory instead of a pipe")
+    cli_args = parser.parse_args()
+    with open(cli_args.sequence) as sequence_file:
+        sequence = json.load(sequence_file)
+    try:
+        sequence_report = run_sequence(sequence["steps"], sequence.get("settings"), cli_args.shared_memory)
+    except ValueError as error:
+        sys.exit(str(error))
+    print_report(sequence_report)
+    if sequence_report:
+        print("Report saved as " + save_report(sequence_report, headless.settings(**sequence.get("settings", {}))
+                                               .folder))
@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import math
+import time
+import numpy as np
+
+
+class SimulatedPeak:
+    def __init__(self, center, width, rate, drift=0.0):
+        self.center: float = center  # nm
+        self.width: float = width  # nm, standard deviation of the gaussian
+        self.rate: float = rate  # counts per second at the maximum
+        self.drift: float = drift  # nm per second of acquisition
+
+
+class SimulatedSpectrometer:
+    """
+    Stand-in for a seabreeze Spectrometer, used when no device is connected and for load tests.
+    Spectra are reproducible for a given seed: peaks drifting with the acquisition time, dark current and bias,
+    shot noise (Poisson) and read noise (gaussian), clipped at the saturation level.
+    Frames are paced by sleeping until the next frame is due (no busy wait), at 1 / integration time or at
+    frame_rate. With frame_rate=math.inf they are generated as fast as possible
+    """
+    SATURATION = 65535  # 16 bit ADC
+
+    def __init__(self, array_size=2046, wavelength_range=(340, 1015), peaks=None, seed=0, frame_rate=None,
+                 bias=1000, dark_rate=2000, read_noise=10, drop_rate=0.0, serial_number="demo",
+                 integration_time_micros_limits=(1000, 65000000)):
+        """
+        @param array_size: number of pixels
+        @param wavelength_range: (first, last) wavelength in nm
+        @param peaks: list of SimulatedPeak, by default one broad peak like the former demo signal
+        @param seed: seed of the random generator, the same seed gives the same spectra
+        @param frame_rate: frames per second, None to follow the integration time, math.inf for no pacing
+        @param bias: constant offset in counts
+        @param dark_rate: dark current in counts per second
+        @param read_noise: standard deviation of the read noise in counts
+        @param drop_rate: probability of losing a frame (the next one comes one period later)
+        @param serial_number: reported serial number, used e.g. by the dark library
+        @param integration_time_micros_limits: (shortest, longest) integration time accepted, in microseconds
+        """
+        self._wavelengths = np.linspace(wavelength_range[0], wavelength_range[1], array_size)
+        if peaks is None:
+            peaks = [SimulatedPeak(center=self._wavelengths[900], width=104, rate=250000, drift=0.01)]
+        self.peaks = peaks
+        self.seed = seed
+        self.frame_rate = frame_rate
+        self.bias = bias
+        self.dark_rate = dark_rate
+        self.read_noise = read_noise
+        self.drop_rate = drop_rate
+        self.serial_number = serial_number
+        self.integration_time_micros_limits = integration_time_micros_limits
+        self.inttime = 0.2  # seconds
+        self.rng = np.random.default_rng(seed)
+        self.elapsed = 0.0  # Acquisition time simulated so far, in seconds, drives the peak drift
+        self.frames = 0
+        self.dropped = 0
+        self._next_frame = None
+
+    def wavelengths(self) -> np.ndarray:
+        return self._wavelengths.copy()
+
+    def integration_time_micros(self, micros):
+        low, high = self.integration_time_micros_limits
+        if not low <= micros <= high:
+            raise ValueError("Integration time of {} us out of range {}-{} us".format(micros, low, high))
+        self.inttime = micros / 1000000
+        self._next_frame = None  # Restart the pacing with the new period
+
+    @property
+    def period(self) -> float:
+        """
+        Time between frames in seconds (0 when not paced)
+        """
+        if self.frame_rate is None:
+            return self.inttime
+        return 0.0 if math.isinf(self.frame_rate) else 1 / self.frame_rate
+
+    def spectrum(self) -> np.ndarray:
+        """
+        Noiseless expected counts of the next frame
+        """
+        rate = np.full(len(self._wavelengths), float(self.dark_rate))
+        for peak in self.peaks:
+            center = peak.center + peak.drift * self.elapsed
+            rate += peak.rate * np.exp(-(self._wavelengths - center) ** 2 / (2 * peak.width ** 2))
+        return rate * self.inttime
+
+    def intensities(self) -> np.ndarray:
+        """
+        Waits for the next frame and returns it, like Spectrometer.intensities()
+        """
+        while self.drop_rate and self.rng.random() < self.drop_rate:
+            self.dropped += 1
+            self._advance()
+        self._wait()
+        signal = self.rng.poisson(self.spectrum()).astype(float)
+        signal += self.bias + self.rng.normal(0, self.read_noise, len(signal))
+        self._advance()
+        self.frames += 1
+        return np.clip(signal, 0, self.SATURATION)
+
+    def _advance(self):
+        self.elapsed += self.inttime
+        if self._next_frame is not None:
+            self._next_frame += self.period
+
+    def _wait(self):
+        period = self.period
+        if not period:
+            return
+        now = time.perf_counter()
+        if self._next_frame is None or now - self._next_frame > period:
+            self._next_frame = now + period  # First frame, or fell behind: do not try to catch up
+        delay = self._next_frame - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def close(self):
+        pass
@@ -0,0 +1,107 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import struct
+import numpy as np
+
+
+class NpyStreamWriter:
+    """
+    Appends rows to a .npy file in fixed-size chunks, so memory use does not grow with the number of frames.
+    The header is written with a fixed length and rewritten with the final shape on close,
+    after which the file can be opened with np.load(path, mmap_mode="r").
+    """
+    HEADER_SIZE = 128  # Bytes, multiple of 64 as required by the npy format
+
+    def __init__(self, path, row_shape=(), dtype=np.float64, chunk_frames=64):
+        """
+        @param path: .npy file to create
+        @param row_shape: shape of each appended row, () for scalars such as timestamps
+        @param dtype: dtype stored on disk
+        @param chunk_frames: number of rows kept in memory before they are written
+        """
+        self.path = str(path)
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.n_frames = 0
+        self._chunk = np.empty((chunk_frames,) + self.row_shape, dtype=self.dtype)
+        self._fill = 0
+        self._file = open(self.path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        descr = np.lib.format.dtype_to_descr(self.dtype)
+        shape = (self.n_frames,) + self.row_shape
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (descr, shape)
+        header = header.ljust(self.HEADER_SIZE - 10 - 1) + "\n"
+        self._file.seek(0)
+        self._file.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+    def append(self, row):
+        """
+        Stores one row, writing the chunk to disk once it is full
+        @param row: array with row_shape (or a scalar)
+        """
+        self._chunk[self._fill] = row
+        self._fill += 1
+        self.n_frames += 1
+        if self._fill == len(self._chunk):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the rows held in memory to disk
+        """
+        if self._fill:
+            self._file.write(self._chunk[:self._fill].tobytes())
+            self._fill = 0
+        self._file.flush()
+
+    def close(self):
+        """
+        Writes pending rows and the final shape into the header
+        """
+        if self._file.closed:
+            return
+        self.flush()
+        self._write_header()
+        self._file.close()
+
+    def open_array(self) -> np.ndarray:
+        """
+        @return: read-only memory map of everything written so far
+        """
+        self.close()
+        if self.n_frames == 0:
+            return np.empty((0,) + self.row_shape, dtype=self.dtype)
+        return np.load(self.path, mmap_mode="r")
+
+
+class SpectraStore:
+    """
+    On-disk store for a measurement: raw spectra, processed spectra and timestamps,
+    saved as <prefix>_raw.npy, <prefix>_processed.npy and <prefix>_time.npy
+    """
+
+    def __init__(self, prefix, array_size, chunk_frames=64, raw_dtype=np.float64, meas_dtype=np.float64):
+        self.prefix = str(prefix)
+        self.raw = NpyStreamWriter(self.prefix + "_raw.npy", (array_size,), raw_dtype, chunk_frames)
+        self.processed = NpyStreamWriter(self.prefix + "_processed.npy", (array_size,), meas_dtype, chunk_frames)
+        self.time = NpyStreamWriter(self.prefix + "_time.npy", chunk_frames=chunk_frames)
+
+    def append(self, raw, processed, timestamp):
+        self.raw.append(raw)
+        self.processed.append(processed)
+        self.time.append(timestamp)
+
+    @property
+    def n_frames(self) -> int:
+        return self.time.n_frames
+
+    def open_arrays(self):
+        """
+        Closes the files and maps them back
+        @return: (raw, processed, time) arrays, each with n_frames rows
+        """
+        return self.raw.open_array(), self.processed.open_array(), self.time.open_array()
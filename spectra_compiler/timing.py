@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import numpy as np
+
+
+class FrameTiming:
+    """
+    Streaming estimate of the acquisition timing, from the timestamps taken by the spectrometer process.
+    Mean period and jitter (standard deviation of the period) are accumulated over the whole run (Welford),
+    the last `window` intervals (gaps included) are kept in a fixed ring for a recent median.
+    Intervals longer than GAP_FACTOR times that median are counted as gaps (frames missed), not as jitter:
+    real frame intervals are the integration time plus readout overhead, so the requested integration time
+    only bounds the reference until WARMUP intervals were seen.
+    Timestamps that do not advance are counted as duplicates
+    """
+    GAP_FACTOR = 1.5
+    WARMUP = 8
+
+    def __init__(self, nominal_period=None, window=256):
+        """
+        @param nominal_period: requested integration time in seconds, None if unknown
+        @param window: number of recent intervals kept for recent_period
+        """
+        self._intervals = np.full(window, np.nan)
+        self.reset(nominal_period)
+
+    def reset(self, nominal_period=None):
+        """
+        Starts a new estimate, e.g. for a new measurement or integration time
+        @param nominal_period: requested integration time in seconds, None if unknown
+        """
+        self.nominal_period = nominal_period
+        self._intervals[:] = np.nan
+        self._n_recent = 0  # Intervals written to the ring
+        self._n_intervals = 0  # Intervals in the mean (gaps excluded)
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._last = None
+        self.n_frames = 0
+        self.gaps = 0
+        self.missing_frames = 0
+        self.duplicates = 0
+        self.trigger_offset = None  # Time of the recording trigger after the first frame, in seconds
+
+    def update(self, timestamp):
+        """
+        Adds the acquisition time of one frame
+        @param timestamp: seconds
+        """
+        if self._last is None:
+            self._last = timestamp
+            self.n_frames = 1
+            return
+        interval = timestamp - self._last
+        if interval <= 0:
+            self.duplicates += 1
+            return
+        self._last = timestamp
+        self.n_frames += 1
+        reference = self.recent_period
+        if reference is not None and self._n_recent < self.WARMUP and self.nominal_period:
+            reference = max(reference, self.nominal_period)
+        self._intervals[self._n_recent % len(self._intervals)] = interval
+        self._n_recent += 1
+        if reference and interval > self.GAP_FACTOR * reference:
+            self.gaps += 1
+            self.missing_frames += max(int(round(interval / reference)) - 1, 1)
+            return
+        self._n_intervals += 1
+        delta = interval - self._mean
+        self._mean += delta / self._n_intervals
+        self._m2 += delta * (interval - self._mean)
+
+    def update_from(self, other):
+        """
+        Takes over the estimate of another FrameTiming, e.g. one computed in the processing process
+        """
+        self._intervals = other._intervals.copy()
+        for name in ("nominal_period", "_n_recent", "_n_intervals", "_mean", "_m2", "_last", "n_frames", "gaps",
+                     "missing_frames", "duplicates", "trigger_offset"):
+            setattr(self, name, getattr(other, name))
+
+    def update_many(self, timestamps):
+        """
+        Same as update for several frames
+        @param timestamps: seconds, in acquisition order
+        """
+        for timestamp in timestamps:
+            self.update(float(timestamp))
+
+    @property
+    def period(self):
+        """
+        Mean time between frames in seconds (gaps excluded), None before two frames arrived
+        """
+        return self._mean if self._n_intervals else None
+
+    @property
+    def jitter(self):
+        """
+        Standard deviation of the time between frames in seconds
+        """
+        return float(np.sqrt(self._m2 / (self._n_intervals - 1))) if self._n_intervals > 1 else None
+
+    @property
+    def recent_period(self):
+        """
+        Median time between the last frames in seconds
+        """
+        return float(np.nanmedian(self._intervals)) if self._n_recent else None
+
+    @property
+    def drift(self):
+        """
+        Mean period minus the requested integration time, in seconds
+        """
+        if self.period is None or not self.nominal_period:
+            return None
+        return self.period - self.nominal_period
+
+    def metadata(self) -> dict:
+        """
+        @return: timing of the run, in ms, to be saved with the data
+        """
+        def ms(value):
+            return None if value is None else round(value * 1000, 4)
+
+        meta_dict = {"Frame period (ms)": ms(self.period),
+                     "Frame jitter (ms)": ms(self.jitter),
+                     "Frame period drift (ms)": ms(self.drift),
+                     "Frames received": self.n_frames,
+                     "Frame gaps": self.gaps,
+                     "Frames missed": self.missing_frames,
+                     "Duplicate frames": self.duplicates}
+        if self.trigger_offset is not None:
+            meta_dict["Trigger time (ms)"] = ms(self.trigger_offset)
+        return meta_dict
@@ -0,0 +1,224 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from spectra_compiler.generator import SpectraReading, SpectroAck
+from spectra_compiler import instrumentation
+
+
+class SpectraRing:
+    """
+    Fixed-slot ring of spectra living in shared memory.
+    The acquisition process writes frames into the ring and publishes them by advancing write_seq,
+    the GUI process copies the frames back out of their slots. The Pipe only carries a wake-up, sent when the
+    consumer has taken the previous one (see take_notification), so at most one is ever queued and the producer
+    never waits for the consumer: when it laps the reader, the old frame is overwritten and the overrun is counted.
+
+    Memory layout (all little endian, 8 byte aligned):
+        header      int64[5]                   write_seq, read_seq, producer overruns, consumer overruns,
+                                               wake-up pending
+        sequences   int64[n_slots]             sequence number stored in each slot (-1 while being written)
+        timestamps  float64[n_slots]
+        settings    int64[n_slots]             setting_id (integration time command) of each frame
+        stamps      float64[n_slots, n_stages] pipeline stage times (NaN when not instrumented)
+        data        dtype[n_slots, array_size]
+    """
+    _HEADER = 5
+    _WRITE, _READ, _PRODUCER_OVERRUNS, _CONSUMER_OVERRUNS, _NOTIFIED = range(_HEADER)
+
+    def __init__(self, array_size: int, n_slots: int = 64, dtype=np.float64, name: str = None):
+        self.array_size = array_size
+        self.n_slots = n_slots
+        self.dtype = np.dtype(dtype)
+        self._is_owner = name is None
+        size = 8 * (self._HEADER + (3 + len(instrumentation.STAGES)) * n_slots) + self.dtype.itemsize * n_slots * array_size
+        if self._is_owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._map_arrays()
+        if self._is_owner:
+            self._header[:] = 0
+            self._sequences[:] = -1
+
+    def _map_arrays(self):
+        buf = self._shm.buf
+        offset = 0
+        self._header = np.ndarray(self._HEADER, dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self._HEADER
+        self._sequences = np.ndarray(self.n_slots, dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self.n_slots
+        self._timestamps = np.ndarray(self.n_slots, dtype=np.float64, buffer=buf, offset=offset)
+        offset += 8 * self.n_slots
+        self._settings = np.ndarray(self.n_slots, dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self.n_slots
+        self._stamps = np.ndarray((self.n_slots, len(instrumentation.STAGES)), dtype=np.float64, buffer=buf,
+                                  offset=offset)
+        offset += 8 * self.n_slots * len(instrumentation.STAGES)
+        self._data = np.ndarray((self.n_slots, self.array_size), dtype=self.dtype, buffer=buf, offset=offset)
+
+    def __getstate__(self):
+        """
+        Only the segment name travels to the child process, which attaches to the existing block
+        """
+        return {"array_size": self.array_size, "n_slots": self.n_slots, "dtype": self.dtype.str,
+                "name": self._shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["array_size"], state["n_slots"], state["dtype"], state["name"])
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def overruns(self) -> int:
+        """
+        Slots the producer overwrote before the consumer had read them
+        """
+        return int(self._header[self._PRODUCER_OVERRUNS])
+
+    @property
+    def dropped(self) -> int:
+        """
+        Reads that found their slot overwritten while copying (already included in overruns)
+        """
+        return int(self._header[self._CONSUMER_OVERRUNS])
+
+    @property
+    def write_sequence(self) -> int:
+        """
+        Sequence number of the next frame to be written: frames below it are published
+        """
+        return int(self._header[self._WRITE])
+
+    def take_notification(self) -> bool:
+        """
+        Producer side, after push: whether the consumer has to be woken up through the Pipe,
+        i.e. it took the previous wake-up and may be waiting for one
+        """
+        if self._header[self._NOTIFIED]:
+            return False
+        self._header[self._NOTIFIED] = 1
+        return True
+
+    def clear_notification(self):
+        """
+        Consumer side, on receiving a wake-up, before reading the frames published so far
+        """
+        self._header[self._NOTIFIED] = 0
+
+    def push(self, timestamp: float, data: np.ndarray, setting_id: int = 0, stamps: np.ndarray = None) -> int:
+        """
+        Copies one spectrum into the next slot (producer side)
+        @param timestamp: acquisition time of the spectrum
+        @param data: spectrum with array_size values
+        @param setting_id: command_id of the integration time the spectrum was acquired with
+        @param stamps: pipeline stage times, when instrumented
+        @return: sequence number of the written frame
+        """
+        seq = int(self._header[self._WRITE])
+        if seq - self._header[self._READ] >= self.n_slots:
+            self._header[self._PRODUCER_OVERRUNS] += 1
+        slot = seq % self.n_slots
+        self._sequences[slot] = -1  # Mark slot as being written
+        self._timestamps[slot] = timestamp
+        self._settings[slot] = setting_id
+        self._stamps[slot] = np.nan if stamps is None else stamps
+        self._data[slot] = data
+        self._sequences[slot] = seq
+        self._header[self._WRITE] = seq + 1
+        return seq
+
+    def read(self, seq: int):
+        """
+        Copies the frame with the given sequence number out of the ring (consumer side)
+        @param seq: sequence number received through the Pipe
+        @return: SpectraReading, or None if the slot was already overwritten
+        """
+        slot = seq % self.n_slots
+        if self._sequences[slot] != seq:
+            self._header[self._CONSUMER_OVERRUNS] += 1
+            return None
+        timestamp = float(self._timestamps[slot])
+        setting_id = int(self._settings[slot])
+        stamps = None if np.isnan(self._stamps[slot, instrumentation.ACQUIRE]) else self._stamps[slot].copy()
+        data = self._data[slot].copy()
+        if self._sequences[slot] != seq:  # Overwritten while copying
+            self._header[self._CONSUMER_OVERRUNS] += 1
+            return None
+        self._header[self._READ] = seq + 1
+        return SpectraReading(timestamp, data, setting_id, stamps)
+
+    def close(self):
+        """
+        Detaches from the shared block, and removes it if this is the creating side
+        """
+        self._header = self._sequences = self._timestamps = self._settings = self._stamps = self._data = None
+        self._shm.close()
+        if self._is_owner:
+            self._shm.unlink()
+
+
+class SpectraReceiver:
+    """
+    Receiving end of the spectrometer process: readings and command acknowledgements arrive in order.
+    With a shared memory ring, readings are read from the ring in sequence and the Pipe only carries wake-ups
+    and acknowledgements; an acknowledgement is held back until the frames written before it were read
+    """
+    POLL_INTERVAL = 0.05  # Longest wait before looking at the ring again, in case a wake-up was missed
+
+    def __init__(self, from_process, ring: SpectraRing = None):
+        self.data_from_process = from_process
+        self.ring = ring
+        self._cursor = 0  # Next sequence number to read from the ring
+        self._ack = None  # Acknowledgement waiting for the frames written before it
+
+    def receive(self, timeout=None):
+        """
+        @param timeout: seconds to wait, None waits forever
+        @return: SpectraReading or SpectroAck (or a message of the processing process), None if nothing arrived
+                 in time. Frames overwritten before they could be read are skipped (counted by the ring)
+        @raise EOFError: the spectrometer process closed the Pipe
+        """
+        if self.ring is None:
+            if timeout is not None and not self.data_from_process.poll(timeout):
+                return None
+            return self.data_from_process.recv()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._ack is not None and self._cursor >= self._ack.sequence:
+                item, self._ack = self._ack, None
+                return item
+            if self._cursor < self.ring.write_sequence:
+                reading = self._read_next()
+                if reading is not None:
+                    return reading
+                continue
+            wait = self.POLL_INTERVAL if deadline is None else \
+                min(max(deadline - time.monotonic(), 0), self.POLL_INTERVAL)
+            if not self.data_from_process.poll(wait):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                continue
+            item = self.data_from_process.recv()
+            if isinstance(item, int):
+                self.ring.clear_notification()
+            elif isinstance(item, SpectroAck) and item.sequence is not None:
+                self._ack = item
+            else:
+                return item
+
+    def _read_next(self):
+        """
+        @return: next frame of the ring, None if it was overwritten while copying
+        """
+        write = self.ring.write_sequence
+        if write - self._cursor > self.ring.n_slots:  # Lapped: the oldest frames are gone
+            self._cursor = write - self.ring.n_slots
+        seq = self._cursor
+        self._cursor += 1
+        return self.ring.read(seq)
@@ -0,0 +1,242 @@
+# SPDX-FileCopyrightText: 2023 Edgar Nandayapa (Helmholtz-Zentrum Berlin) & Ashis Ravindran (DKFZ, Heidelberg)
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Condition-triggered recording: while armed, the last frames are kept in a preallocated ring and checked
+against a trigger. Once it fires, the frames of the ring are handed over first, so the saved measurement
+includes the moments before the event
+"""
+
+import os
+import socket
+import time
+import numpy as np
+from spectra_compiler.generator import SpectraBlock, RAW_DTYPE
+
+TRIGGERS = ("above", "below", "rate", "file", "udp")
+
+
+class LevelTrigger:
+    """
+    Fires when the mean calculated intensity in a wavelength range crosses a level. The intensity has to be on
+    the other side of the level first, so a condition already met when arming does not fire
+    """
+
+    def __init__(self, xdata, roi, level, is_falling=False):
+        """
+        @param roi: (low, high) wavelength range in nm
+        @param level: intensity in the units of the calculated spectra
+        @param is_falling: fire when the intensity drops below the level instead (e.g. lamp off)
+        """
+        start, stop = np.searchsorted(xdata, roi[0], side="left"), np.searchsorted(xdata, roi[1], side="right")
+        if stop <= start:
+            raise ValueError("The trigger range {:g}-{:g} nm is outside the spectrum".format(*roi))
+        self.pixels = slice(start, stop)
+        self.level = level
+        self.is_falling = is_falling
+        self._was_met = True  # Condition met by the previous frame
+
+    def levels(self, spectra) -> np.ndarray:
+        return np.asarray(spectra[:, self.pixels], dtype=float).mean(axis=1)
+
+    def check(self, timestamps, spectra) -> int:
+        """
+        @param timestamps: acquisition times of the frames
+        @param spectra: (n, array_size) calculated spectra
+        @return: index of the first frame meeting the condition after one that did not, -1 if none does
+        """
+        levels = self.levels(spectra)
+        met = levels <= self.level if self.is_falling else levels >= self.level
+        if not len(met):
+            return -1
+        hits = met & ~np.r_[self._was_met, met[:-1]]
+        self._was_met = bool(met[-1])
+        return int(np.argmax(hits)) if hits.any() else -1
+
+
+class RateTrigger(LevelTrigger):
+    """
+    Fires when the mean calculated intensity in a wavelength range changes faster than a rate (either direction)
+    """
+
+    def __init__(self, xdata, roi, rate):
+        """
+        @param rate: change of intensity per second
+        """
+        super(RateTrigger, self).__init__(xdata, roi, rate)
+        self._last = None  # (timestamp, level) of the previous frame
+
+    def check(self, timestamps, spectra) -> int:
+        levels = self.levels(spectra)
+        times = np.asarray(timestamps, dtype=float)
+        if self._last is not None:
+            times, levels = np.r_[self._last[0], times], np.r_[self._last[1], levels]
+        self._last = (times[-1], levels[-1])
+        if len(times) < 2:
+            return -1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates = np.abs(np.diff(levels) / np.diff(times))
+        hits = rates >= self.level
+        if not hits.any():
+            return -1
+        return int(np.argmax(hits)) + len(timestamps) - len(rates)  # Frame at the end of the fast interval
+
+
+class ExternalTrigger:
+    """
+    Fires on a signal from another program or device: a file being created (it is removed), or any datagram
+    received on a UDP port. Checked at most once per poll interval; the newest frame is taken as the trigger
+    """
+
+    def __init__(self, path=None, port=None, poll_interval=0.01):
+        """
+        @param path: file whose creation triggers the recording
+        @param port: UDP port to listen on (all interfaces)
+        """
+        self.path = path
+        self.port = port
+        self.poll_interval = poll_interval
+        self._socket = None  # Opened on the first check, so the trigger can be sent to another process
+        self._next_poll = 0.0
+
+    def is_fired(self) -> bool:
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            return True
+        if self.port is not None:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._socket.bind(("", self.port))
+                self._socket.setblocking(False)
+            try:
+                self._socket.recv(1024)
+                return True
+            except BlockingIOError:
+                pass
+        return False
+
+    def check(self, timestamps, spectra) -> int:
+        now = time.perf_counter()
+        if now < self._next_poll:
+            return -1
+        self._next_poll = now + self.poll_interval
+        return len(timestamps) - 1 if self.is_fired() else -1
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_socket"] = None
+        return state
+
+
+def make_trigger(kind, xdata, roi=None, value=None):
+    """
+    @param kind: one of TRIGGERS: intensity in roi above or below a level, changing faster than a rate,
+                 trigger file created, or UDP datagram received
+    @param roi: (low, high) wavelength range in nm, for "above", "below" and "rate"
+    @param value: level, rate per second, trigger file or UDP port, depending on kind
+    @return: trigger object
+    @raise ValueError: for an unknown kind or invalid settings
+    """
+    if kind in ("above", "below"):
+        if roi is None:
+            raise ValueError("A wavelength range is needed")
+        return LevelTrigger(xdata, roi, float(value), is_falling=kind == "below")
+    if kind == "rate":
+        if roi is None:
+            raise ValueError("A wavelength range is needed")
+        return RateTrigger(xdata, roi, abs(float(value)))
+    if kind == "file":
+        if not value:
+            raise ValueError("A trigger file is needed")
+        return ExternalTrigger(path=str(value))
+    if kind == "udp":
+        port = int(value)
+        try:  # Checked now, so a port in use is reported when starting rather than in the gathering thread
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as test_socket:
+                test_socket.bind(("", port))
+        except (OSError, OverflowError) as error:
+            raise ValueError("UDP port {} cannot be used: {}".format(port, error))
+        return ExternalTrigger(port=port)
+    raise ValueError("Unknown trigger: {}".format(kind))
+
+
+class PreTriggerBuffer:
+    """
+    The last `frames` raw frames, in a ring allocated once: arming costs one copy per frame whatever the waiting time
+    """
+
+    def __init__(self, frames, array_size, raw_dtype=RAW_DTYPE):
+        self.frames = frames
+        self.data = np.empty((frames, array_size), dtype=raw_dtype)
+        self.timestamps = np.empty(frames)
+        self.setting_ids = np.empty(frames, dtype=int)
+        self.n_pushed = 0
+
+    def push_block(self, block: SpectraBlock):
+        if not self.frames:
+            return
+        if len(block) > self.frames:
+            self.n_pushed += len(block) - self.frames
+            block = block.select(slice(len(block) - self.frames, None))
+        rows = (self.n_pushed + np.arange(len(block))) % self.frames
+        self.data[rows] = block.data
+        self.timestamps[rows] = block.timestamps
+        self.setting_ids[rows] = block.setting_ids
+        self.n_pushed += len(block)
+
+    def block(self) -> SpectraBlock:
+        """
+        @return: frames kept, oldest first
+        """
+        n_frames = min(self.n_pushed, self.frames)
+        rows = (self.n_pushed - n_frames + np.arange(n_frames)) % max(self.frames, 1)
+        return SpectraBlock(self.timestamps[rows], self.data[rows], self.setting_ids[rows])
+
+
+class TriggerArm:
+    """
+    Holds a measurement back until its trigger fires, keeping the frames received meanwhile in a PreTriggerBuffer
+    """
+
+    def __init__(self, trigger, pre_frames, array_size, raw_dtype=RAW_DTYPE):
+        """
+        @param trigger: LevelTrigger, RateTrigger or ExternalTrigger
+        @param pre_frames: frames before the trigger kept in the measurement
+        """
+        self.trigger = trigger
+        self.buffer = PreTriggerBuffer(pre_frames, array_size, raw_dtype)
+        self.is_triggered = False
+        self.trigger_time = None  # Acquisition time of the frame that met the condition
+
+    def feed(self, block: SpectraBlock, spectra):
+        """
+        @param block: readings received while armed
+        @param spectra: their calculated spectra, checked by the trigger
+        @return: None while waiting, else the pre-trigger frames followed by the frames of the block from the
+                 trigger on
+        """
+        hit = self.trigger.check(block.timestamps, np.atleast_2d(spectra))
+        if hit < 0:
+            self.buffer.push_block(block)
+            return None
+        self.buffer.push_block(block.select(slice(0, hit)))
+        self.is_triggered = True
+        self.trigger_time = float(block.timestamps[hit])
+        if hasattr(self.trigger, "close"):
+            self.trigger.close()
+        before, after = self.buffer.block(), block.select(slice(hit, None))
+        return SpectraBlock(np.r_[before.timestamps, after.timestamps], np.concatenate([before.data, after.data]),
+                            np.r_[before.setting_ids, after.setting_ids])
+
+    @property
+    def pre_trigger_frames(self) -> int:
+        return min(self.buffer.n_pushed, self.buffer.frames)
@@ -66,3 +66,222 @@ def spectra_math(ydata: np.ndarray, is_dark_data, is_bright_data, dark_mean, bri
     else:
         return ydata
     return yarray
+
+
+class SpectraCorrector:
+    """
+    Same math as spectra_math, with everything that only depends on the dark/bright references computed once.
+    Corrections are written in place into caller-provided buffers, for single spectra or (n, array_size) blocks.
+    Build a new corrector whenever the references change
+    """
+
+    def __init__(self, is_dark_data, is_bright_data, dark_mean, bright_mean):
+        """
+        @param is_dark_data: boolean for dark data
+        @param is_bright_data: boolean for bright data
+        @param dark_mean: list of dark data
+        @param bright_mean: list of bright data
+        """
+        self.is_dark_data = bool(is_dark_data)
+        self.is_bright_data = bool(is_bright_data)
+        self.dark = np.asarray(dark_mean, dtype=np.float64) if self.is_dark_data else None
+        self.denominator = None
+        self.invalid = None
+        if self.is_bright_data:
+            bright = np.asarray(bright_mean, dtype=np.float64)
+            self.denominator = bright - self.dark if self.is_dark_data else bright
+            self.invalid = ~np.isfinite(self.denominator) | (self.denominator == 0)
+            if not self.invalid.any():
+                self.invalid = None
+
+    @property
+    def is_identity(self) -> bool:
+        return not (self.is_dark_data or self.is_bright_data)
+
+    def apply(self, ydata: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Subtracts dark, divides by bright, or calculates absorbance -log((y - dark) / (bright - dark)).
+        Pixels where the references give no valid denominator are set to NaN
+        @param ydata: raw spectrum, or (n, array_size) block of spectra
+        @param out: float buffer with the shape of ydata to write into (allocated if None)
+        @return: calculated spectra (out)
+        """
+        if self.is_identity:
+            if out is None:
+                return ydata
+            np.copyto(out, ydata, casting='unsafe')
+            return out
+        if out is None:
+            out = np.empty(np.shape(ydata))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.is_dark_data:
+                np.subtract(ydata, self.dark, out=out, casting='unsafe')
+                if self.is_bright_data:
+                    np.divide(out, self.denominator, out=out, casting='unsafe')
+                    np.log(out, out=out)
+                    np.negative(out, out=out)
+            else:
+                np.divide(ydata, self.denominator, out=out, casting='unsafe')
+        if self.invalid is not None:
+            out[..., self.invalid] = np.nan
+        return out
+
+
+class ReferenceAccumulator:
+    """
+    Streaming per-pixel mean and variance (Welford) of dark or bright spectra, in O(array_size) memory
+    whatever the number of averaged frames. Values hit by cosmic rays can be rejected before they are accumulated:
+        "sigma":  further than n_sigma standard deviations from the running mean. The first min_frames frames,
+                  before the running statistics can be trusted, are screened against their median instead
+        "median": further than n_sigma robust deviations (MAD) from the median of the last median_frames frames
+    """
+    REJECTIONS = ("none", "sigma", "median")
+    MIN_SCALE = 1.0  # Smallest deviation (in counts) used for rejection, so flat pixels do not reject everything
+    MIN_ROBUST_FRAMES = 3  # Fewest frames a median can reject a spike from
+
+    def __init__(self, array_size, rejection="none", n_sigma=5.0, min_frames=10, median_frames=5,
+                 expected_frames=None):
+        """
+        @param array_size: number of values per spectrum
+        @param rejection: one of REJECTIONS
+        @param n_sigma: rejection threshold
+        @param min_frames: frames screened against their median before sigma rejection starts
+        @param median_frames: frames the median is taken over
+        @param expected_frames: frames that will be averaged, if known. min_frames is then limited to them, so a
+                                short average is screened against its median as a whole
+        """
+        if rejection not in self.REJECTIONS:
+            raise ValueError("Unknown spike rejection: " + str(rejection))
+        if expected_frames:
+            min_frames = min(min_frames, max(expected_frames, self.MIN_ROBUST_FRAMES))
+        self.rejection = rejection
+        self.n_sigma = n_sigma
+        self.min_frames = min_frames
+        self.n_frames = 0
+        self.count = np.zeros(array_size, dtype=np.int64)  # Accepted values per pixel
+        self.rejected = np.zeros(array_size, dtype=np.int64)
+        self._mean = np.zeros(array_size)
+        self._m2 = np.zeros(array_size)
+        self._recent = None  # Frames screened against their median
+        if rejection != "none":
+            self._recent = np.empty((median_frames if rejection == "median" else min_frames, array_size))
+
+    def add(self, ydata):
+        """
+        Accumulates one spectrum
+        @param ydata: raw spectrum
+        """
+        ydata = np.array(ydata, dtype=np.float64)
+        self.n_frames += 1
+        if self.rejection == "median" or (self.rejection == "sigma" and self.n_frames <= self.min_frames):
+            n_recent = len(self._recent)
+            self._recent[(self.n_frames - 1) % n_recent] = ydata
+            if self.n_frames < n_recent:
+                return  # Held until the median window is full
+            self._screen(self._recent, self._recent if self.n_frames == n_recent else ydata[np.newaxis])
+        elif self.rejection == "sigma":
+            scale = np.maximum(self.noise, self.MIN_SCALE)
+            self._accumulate(ydata, np.abs(ydata - self._mean) <= self.n_sigma * scale)
+        else:
+            self._accumulate(ydata)
+
+    def _screen(self, window, rows):
+        """
+        Accumulates rows, rejecting values further than n_sigma robust deviations from the median of window
+        """
+        median = np.median(window, axis=0)
+        scale = np.maximum(1.4826 * np.median(np.abs(window - median), axis=0), self.MIN_SCALE)
+        for row in rows:
+            self._accumulate(row, np.abs(row - median) <= self.n_sigma * scale)
+
+    def add_block(self, block):
+        """
+        Same as add for (n, array_size) spectra
+        """
+        for ydata in block:
+            self.add(ydata)
+
+    def _accumulate(self, ydata, accepted=None):
+        if accepted is None:
+            self.count += 1
+            delta = ydata - self._mean
+            self._mean += delta / self.count
+        else:
+            self.rejected += ~accepted
+            self.count += accepted
+            delta = np.where(accepted, ydata - self._mean, 0.0)
+            self._mean += delta / np.maximum(self.count, 1)
+        self._m2 += delta * (ydata - self._mean)
+
+    def finish(self):
+        """
+        Accumulates frames still held for screening, if fewer than fill the window were added.
+        They are screened against their own median when there are enough of them
+        """
+        if self._recent is not None and 0 < self.n_frames < len(self._recent):
+            held = self._recent[:self.n_frames]
+            if self.n_frames >= self.MIN_ROBUST_FRAMES:
+                self._screen(held, held)
+            else:
+                for row in held:
+                    self._accumulate(row)
+
+    @property
+    def mean(self) -> np.ndarray:
+        """
+        Per-pixel mean (NaN where every value was rejected)
+        """
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def noise(self) -> np.ndarray:
+        """
+        Per-pixel standard deviation (NaN with fewer than two values)
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self._m2 / (self.count - 1)), np.nan)
+
+
+def decimation_edges(n_samples: int, n_pixels: int):
+    """
+    Splits n_samples into one bin per pixel, for minmax_decimate or max_decimate
+    @param n_samples: number of values along the decimated axis
+    @param n_pixels: rendered width (or height) in pixels
+    @return: start index of each bin, or None if there are no more than two samples per pixel
+    """
+    if n_pixels <= 0 or n_samples <= 2 * n_pixels:
+        return None
+    return np.unique(np.linspace(0, n_samples, n_pixels + 1).astype(int)[:-1])
+
+
+def minmax_decimate(data: np.ndarray, edges, axis=-1) -> np.ndarray:
+    """
+    Reduces data along an axis to the minimum and maximum of each bin, so peaks survive at pixel resolution.
+    NaN values are ignored unless a whole bin is NaN
+    @param data: 1D spectrum or 2D matrix
+    @param edges: bin start indices from decimation_edges (None returns data unchanged)
+    @param axis: axis to decimate
+    @return: array with two values (min, max) per bin along axis
+    """
+    if edges is None:
+        return data
+    axis = axis % np.ndim(data)
+    low = np.fmin.reduceat(data, edges, axis=axis)
+    high = np.fmax.reduceat(data, edges, axis=axis)
+    shape = list(low.shape)
+    shape[axis] *= 2
+    return np.stack((low, high), axis=axis + 1).reshape(shape)
+
+
+def max_decimate(data: np.ndarray, edges, axis=-1) -> np.ndarray:
+    """
+    Reduces data along an axis to the maximum of each bin, one value per pixel.
+    For images, where interleaving minima and maxima as in minmax_decimate would draw stripes
+    @param data: 1D spectrum or 2D matrix
+    @param edges: bin start indices from decimation_edges (None returns data unchanged)
+    @param axis: axis to decimate
+    @return: array with one value per bin along axis
+    """
+    if edges is None:
+        return data
+    return np.fmax.reduceat(data, edges, axis=axis % np.ndim(data))
@@ -3,73 +3,170 @@
 # SPDX-License-Identifier: MIT
 
 from spectra_compiler import utils
+import time
 import numpy as np
 from PyQt5.QtCore import QTimer
 from multiprocessing import Pipe
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, QThread
-from spectra_compiler.generator import SpectraReading
+from spectra_compiler.generator import SpectraReading, SpectraBlock, SpectroAck, RAW_DTYPE, MEAS_DTYPE
+from spectra_compiler.collector import SpectraCollector
+from spectra_compiler.transport import SpectraReceiver
+from spectra_compiler import export, journal, instrumentation, processing
+from spectra_compiler.analysis import PeakTracker
 
 
 class Emitter(QThread):
     ui_data_available = pyqtSignal(object)  # Signal indicating new UI data is available.
+    ui_block_available = pyqtSignal(object)  # Same, with several readings stacked in a SpectraBlock (batching mode)
+    command_acknowledged = pyqtSignal(object)  # SpectroAck from the spectrometer process
+    processing_message = pyqtSignal(object)  # Progress and results from the processing process, if used
 
-    def __init__(self, from_process: Pipe):
+    def __init__(self, from_process: Pipe, ring=None, max_batch=1, max_latency_ms=20, monitor=None):
+        """
+        @param ring: shared memory ring, when the Pipe only carries wake-ups instead of readings
+        @param max_batch: maximum readings per SpectraBlock. With 1, every reading is emitted on its own
+        @param max_latency_ms: maximum time to wait for more readings before emitting a block
+        @param monitor: optional LatencyMonitor stamping the receive and emit stages
+        """
         super().__init__()
-        self.data_from_process = from_process
+        self.receiver = SpectraReceiver(from_process, ring)
+        self.ring = ring
+        self.max_batch = max_batch
+        self.max_latency_ms = max_latency_ms
+        self.monitor = monitor
+        if monitor is not None and ring is not None:
+            monitor.dropped_source = lambda: ring.overruns
+
+    @property
+    def is_batching(self) -> bool:
+        return self.max_batch > 1
+
+    def connect_consumer(self, reading_slot, block_slot):
+        """
+        Connects a consumer to the signal in use: reading_slot receives SpectraReading, block_slot SpectraBlock
+        """
+        if self.is_batching:
+            self.ui_block_available.connect(block_slot)
+        else:
+            self.ui_data_available.connect(reading_slot)
+
+    def disconnect_consumer(self, reading_slot, block_slot):
+        if self.is_batching:
+            self.ui_block_available.disconnect(block_slot)
+        else:
+            self.ui_data_available.disconnect(reading_slot)
+
+    def receive(self, timeout=None):
+        """
+        Waits for the next reading from the spectrometer process. Command acknowledgements are emitted on the way
+        @param timeout: seconds to wait, None waits forever
+        @return: SpectraReading (DisplayFrame from the processing process), or None if nothing (readable) arrived
+                 in time
+        """
+        ydata = self.receiver.receive(timeout)
+        if isinstance(ydata, SpectroAck):
+            self.command_acknowledged.emit(ydata)
+            return None
+        if isinstance(ydata, processing.MESSAGES):
+            self.processing_message.emit(ydata)
+            return None
+        if self.monitor is not None and ydata is not None:
+            self.monitor.stamp(ydata.stamps, instrumentation.RECEIVE)
+        return ydata
 
     def run(self):
         """
         Emits collected List from spectrometer (ydata)
+        With a shared memory ring, readings are read from the ring (see SpectraReceiver)
+        When batching, all readings already waiting (up to max_batch, for at most max_latency_ms)
+        are stacked and emitted as one block
         """
         while True:
             try:
-                ydata = self.data_from_process.recv()
+                ydata = self.receive()
+                if ydata is None:
+                    continue
+                if not self.is_batching:
+                    if self.monitor is not None:
+                        self.monitor.stamp(ydata.stamps, instrumentation.EMIT)
+                    self.ui_data_available.emit(ydata)
+                    continue
+                readings = [ydata]
+                deadline = time.perf_counter() + self.max_latency_ms / 1000
+                while len(readings) < self.max_batch:
+                    ydata = self.receive(max(deadline - time.perf_counter(), 0))
+                    if ydata is None:
+                        if time.perf_counter() >= deadline:
+                            break
+                        continue
+                    readings.append(ydata)
+                block = SpectraBlock.from_readings(readings)
+                if self.monitor is not None:
+                    self.monitor.stamp_block(block.stamps, instrumentation.EMIT)
+                self.ui_block_available.emit(block)
             except EOFError:
                 break
-            else:
-                self.ui_data_available.emit(ydata)
 
 
 class PlotWorker(QObject):
+    MIN_REFRESH_MS = 20  # Fastest plot refresh (50 fps)
+    view_changed = pyqtSignal(object)  # (start, stop, n_pixels) of the decimation, for the processing process
 
-    def __init__(self, canvas, xdata, is_dark_data, is_bright_data, dark_mean, bright_mean, is_spectrometer=False):
+    def __init__(self, canvas, xdata, is_dark_data, is_bright_data, dark_mean, bright_mean, is_spectrometer=False,
+                 refresh_interval_ms=500, monitor=None):
         super(PlotWorker, self).__init__()
+        self.monitor = monitor  # Optional LatencyMonitor stamping the render stage
+        self._render_stamps = None  # Stamps of the frame in render_buffer, until it is drawn
         self.canvas = canvas
         self.xdata = xdata
         self.is_dark_data = is_dark_data
         self.is_bright_data = is_bright_data
         self.dark_mean = dark_mean
         self.bright_mean = bright_mean
+        self.corrector = utils.SpectraCorrector(is_dark_data, is_bright_data, dark_mean, bright_mean)
+        self._yarray = np.empty(len(xdata))  # Reused buffer for the calculated spectrum
         self.is_spectrometer = is_spectrometer
         self.render_buffer = None
+        self._display = None  # Last DisplayFrame, when spectra come already decimated from the processing process
         self.is_show_raw = False
         self.is_fix_y = False
         self._plot_ref = None
         self._plot_re1 = None
         self._plot_re2 = None
+        self._background = None  # Cached pixels of everything but the live spectrum, for blitting
+        self._view = slice(None)  # Part of the spectrum inside the x-axis limits
+        self._edges = None  # Decimation bins of that part
+        self._x_display = self.xdata
+        self._last_ydata = np.ones(len(self.xdata))
+        self.canvas.mpl_connect('draw_event', self.on_draw)
         self.timer = QTimer()
-        self.timer.start(500)
+        self.set_refresh_interval(refresh_interval_ms)
         self.timer.timeout.connect(self.toggle)
         self.reset_axes()
-        self.is_measure_frequency = True
-        self.n_measure_cycles = 5
-        self.init_frequency_measure()
 
-    def init_frequency_measure(self):
+    def set_refresh_interval(self, interval_ms):
+        """
+        Sets how often the plot is refreshed. Pass the integration time to follow the acquisition rate
+        @param interval_ms: refresh period, limited to MIN_REFRESH_MS
+        """
+        self.timer.start(int(max(interval_ms, self.MIN_REFRESH_MS)))
+
+    def on_draw(self, event):
         """
-        Clears timestamps List and sets frequency to 0
+        After a full redraw (axes change, resize, zoom), caches the static background and draws the spectrum on it
+        @param event: matplotlib draw event
         """
-        self.timestamps = []
-        self.current_mean_frequency_ms: float = 0
+        self.update_decimation()  # The axes width may have changed
+        self._background = self.canvas.copy_from_bbox(self.canvas.axes.bbox)
+        if self._plot_ref is not None:
+            self.canvas.axes.draw_artist(self._plot_ref)
 
-    def measure_freq_list(self, timestamps: list):
+    def invalidate_background(self):
         """
-        Populates List containing timestamps
-        @param timestamps:
+        Forces a full redraw, after which the background is cached again
         """
-        init_time = timestamps[0]
-        _timestamps = [(timestamp - init_time) for timestamp in timestamps]
-        self.current_mean_frequency_ms = 1000 * sum(_timestamps) / (2 * self.n_measure_cycles)
+        self._background = None
+        self.canvas.draw_idle()
 
     def reset_axes(self):
         """
@@ -85,41 +182,117 @@ class PlotWorker(QObject):
         self.is_show_raw = False
         self._plot_re1 = None
         self._plot_re2 = None
-        self._plot_ref, = self.canvas.axes.plot(self.xdata, np.ones(len(self.xdata)), 'r')
+        self._plot_ref, = self.canvas.axes.plot(self.xdata, np.ones(len(self.xdata)), 'r', animated=True)
         if not self.is_spectrometer:
             self._plot_ref.set_label("Spectrometer not found: Demo Data")
             self.canvas.axes.legend()
+        self.canvas.axes.callbacks.connect('xlim_changed', self.update_decimation)
+        self.update_decimation()
+        self.invalidate_background()
+
+    def update_decimation(self, axes=None):
+        """
+        Selects the wavelengths inside the x-axis limits and splits them into one min/max bin per pixel.
+        Called again whenever the limits change (e.g. zooming with the toolbar)
+        @param axes: axes whose limits changed
+        """
+        x_min, x_max = self.canvas.axes.get_xlim()
+        start = max(int(np.searchsorted(self.xdata, min(x_min, x_max))) - 1, 0)
+        stop = min(int(np.searchsorted(self.xdata, max(x_min, x_max))) + 1, len(self.xdata))
+        self._view = slice(start, stop)
+        self._edges = utils.decimation_edges(stop - start, int(self.canvas.axes.bbox.width))
+        self._x_display = utils.minmax_decimate(self.xdata[self._view], self._edges)
+        self.view_changed.emit((start, stop, int(self.canvas.axes.bbox.width)))
+        if self._plot_ref is not None and self._display is None:
+            self.set_plot_data(self._last_ydata)
+
+    def set_plot_data(self, ydata):
+        """
+        Updates the live curve with the visible part of the spectrum, decimated to the axes width
+        @param ydata: full spectrum
+        """
+        self._last_ydata = ydata
+        self._plot_ref.set_data(self._x_display, utils.minmax_decimate(ydata[self._view], self._edges))
+
+    def show_spectrum(self):
+        """
+        Updates the live curve with the newest spectrum, raw or calculated
+        """
+        if self._display is not None:
+            self._plot_ref.set_data(self._display.x, self._display.raw if self.is_show_raw else
+                                    self._display.processed)
+        elif self.is_show_raw:
+            self.set_plot_data(self.render_buffer)
+        else:
+            self.set_plot_data(self.corrector.apply(self.render_buffer, out=self._yarray))
 
     @pyqtSlot(object)
     def plot_spectra(self, spect: SpectraReading):
         """
         Fixes timestamps
-        @param spect:
+        @param spect: SpectraReading, or DisplayFrame (already corrected and decimated)
         """
+        self._render_stamps = spect.stamps
+        if isinstance(spect, processing.DisplayFrame):
+            self._display = spect
+            self.render_buffer = spect.raw  # Same extremes as the full spectrum, for set_axis_range
+            return
         self.render_buffer = spect.data
-        if self.is_measure_frequency:
-            self.timestamps.append(spect.timestamp)
-            if len(self.timestamps) > self.n_measure_cycles:
-                self.timestamps.pop(0)
-                self.measure_freq_list(self.timestamps)
+
+    @pyqtSlot(object)
+    def plot_block(self, block: SpectraBlock):
+        """
+        Same as plot_spectra for a batch of readings: only the newest one is displayed
+        @param block:
+        """
+        self.render_buffer = block.data[-1]
+        self._render_stamps = None if block.stamps is None else block.stamps[-1]
 
     def toggle(self):
         """
         Fix displayed curves in plot regarding what has been selected
+        Only the spectrum is redrawn (blitted) on top of the cached background,
+        unless curves or the legend changed and the whole figure needs drawing
         """
+        if self.render_buffer is None:
+            return
         if self.is_show_raw:
+            is_changed = False
             if self.is_dark_data and self._plot_re1 is None:
                 self._plot_re1 = self.canvas.axes.plot(self.xdata, self.dark_mean, 'b', label="Dark")
+                is_changed = True
             if self.is_bright_data and self._plot_re2 is None:
                 self._plot_re2 = self.canvas.axes.plot(self.xdata, self.bright_mean, 'y', label="Bright")
-            self._plot_ref.set_ydata(self.render_buffer)  # TODO: check its yarray or render_buffer?
-            self._plot_ref.set_label("Spectra")
-            self.canvas.axes.legend()
+                is_changed = True
+            self.show_spectrum()
+            if self._plot_ref.get_label() != "Spectra":
+                self._plot_ref.set_label("Spectra")
+                is_changed = True
+            if is_changed:
+                self.canvas.axes.legend()
+                self._background = None
         else:
-            yarray = utils.spectra_math(self.render_buffer, self.is_dark_data, self.is_bright_data, self.dark_mean,
-                                        self.bright_mean)
-            self._plot_ref.set_ydata(yarray)
-        self.canvas.draw_idle()
+            self.show_spectrum()
+
+        if self._background is None:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self._background)
+            self.canvas.axes.draw_artist(self._plot_ref)
+            self.canvas.blit(self.canvas.axes.bbox)
+        if self.monitor is not None and self._render_stamps is not None:
+            self.monitor.stamp(self._render_stamps, instrumentation.RENDER)
+            self._render_stamps = None
+
+    def set_references(self, is_dark_data, is_bright_data, dark_mean, bright_mean):
+        """
+        Updates dark/bright references and rebuilds the correction terms
+        """
+        self.is_dark_data = is_dark_data
+        self.is_bright_data = is_bright_data
+        self.dark_mean = dark_mean
+        self.bright_mean = bright_mean
+        self.corrector = utils.SpectraCorrector(is_dark_data, is_bright_data, dark_mean, bright_mean)
 
     def set_axis_range(self):
         """
@@ -152,28 +325,167 @@ class PlotWorker(QObject):
                 self.canvas.axes.set_ylim([min(fix_arr) * 0.9, max(fix_arr) * 1.1])
             else:
                 self.canvas.axes.set_ylim([0, 68000])
+        self.invalidate_background()
+
+
+class WaterfallWorker(QObject):
+    """
+    Live time vs wavelength view of the running measurement.
+    Rows are written into a preallocated buffer of twice the window height: each frame goes to row i and i + window,
+    so the last `window_frames` rows are always a contiguous, ordered view and nothing is shifted or re-rendered
+    per frame. The image is refreshed by a timer
+    """
+
+    def __init__(self, canvas, xdata, window_frames=300, refresh_interval_ms=200):
+        super(WaterfallWorker, self).__init__()
+        self.canvas = canvas
+        self.xdata = xdata
+        self.window_frames = window_frames
+        self._image = None
+        self._is_dirty = False
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.render)
+        self.timer.start(refresh_interval_ms)
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the buffer and sizes its columns to the current canvas width
+        """
+        self._edges = utils.decimation_edges(len(self.xdata), int(self.canvas.axes.bbox.width))
+        n_cols = len(utils.max_decimate(self.xdata, self._edges))
+        self._buffer = np.full((2 * self.window_frames, n_cols), np.nan, dtype=np.float32)
+        self._row_min = np.full(2 * self.window_frames, np.nan)
+        self._row_max = np.full(2 * self.window_frames, np.nan)
+        self.n_frames = 0
+        self.canvas.axes.cla()
+        self.canvas.axes.set_xlabel('Wavelength (nm)')
+        self.canvas.axes.set_ylabel('Frames ago')
+        self._image = self.canvas.axes.imshow(self._window(), aspect='auto', interpolation='nearest',
+                                              extent=[self.xdata[0], self.xdata[-1], self.window_frames, 0])
+        self._is_dirty = True
+
+    def _window(self) -> np.ndarray:
+        start = self.n_frames % self.window_frames
+        return self._buffer[start:start + self.window_frames][::-1]  # Newest frame on top
+
+    @pyqtSlot(object)
+    def add_frame(self, yarray):
+        """
+        Writes one frame into the buffer, constant cost regardless of the measurement length
+        @param yarray: calculated spectrum, or (n, array_size) block of them
+        """
+        for row in np.atleast_2d(utils.max_decimate(yarray, self._edges)):
+            index = self.n_frames % self.window_frames
+            for position in (index, index + self.window_frames):
+                self._buffer[position] = row
+                self._row_min[position] = np.nanmin(row)
+                self._row_max[position] = np.nanmax(row)
+            self.n_frames += 1
+        self._is_dirty = True
+
+    def render(self):
+        """
+        Shows the current window, if new frames arrived
+        """
+        if not self._is_dirty or not self.canvas.isVisible():
+            return
+        self._is_dirty = False
+        start = self.n_frames % self.window_frames
+        low = np.nanmin(self._row_min[start:start + self.window_frames], initial=np.inf)
+        high = np.nanmax(self._row_max[start:start + self.window_frames], initial=-np.inf)
+        self._image.set_data(self._window())
+        if np.isfinite(low) and np.isfinite(high) and high > low:
+            self._image.set_clim(low, high)
+        self.canvas.draw_idle()
+
+
+class PeakPlotWorker(QObject):
+    """
+    Live time series of the peaks tracked in the running measurement: position, FWHM and area of every region,
+    one subplot each. Values arrive as blocks through add_peaks and are drawn by a timer
+    """
+
+    def __init__(self, canvas, refresh_interval_ms=500):
+        super(PeakPlotWorker, self).__init__()
+        self.canvas = canvas
+        self.tracker = None
+        self._lines = []
+        self._is_dirty = False
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.render)
+        self.timer.start(refresh_interval_ms)
+
+    def reset(self, xdata, rois):
+        """
+        Clears the plots for a new measurement
+        @param rois: list of (low, high) wavelength ranges in nm
+        """
+        self.tracker = PeakTracker(xdata, rois)
+        figure = self.canvas.figure
+        figure.clf()
+        axes = figure.subplots(1, len(PeakTracker.QUANTITIES), squeeze=False)[0]
+        self._axes = axes
+        self._lines = []
+        for ax, label in zip(axes, ("Position (nm)", "FWHM (nm)", "Area (a.u.)")):
+            ax.set_xlabel('Time (s)')
+            ax.set_ylabel(label)
+            ax.grid(True, linestyle='--')
+            self._lines.append([ax.plot([], [], label="{:g}-{:g}".format(*roi))[0] for roi in rois])
+        axes[0].legend(fontsize="small")
+        self._is_dirty = True
+
+    @pyqtSlot(object, object)
+    def add_peaks(self, timestamps, values):
+        """
+        @param timestamps: acquisition times of the frames
+        @param values: (n, n_rois, 3) values of these frames, see PeakTracker.analyse
+        """
+        if self.tracker is None:
+            return
+        self.tracker.extend(timestamps, values)
+        self._is_dirty = True
+
+    def render(self):
+        """
+        Updates the curves, if new frames arrived
+        """
+        if not self._is_dirty or not self.canvas.isVisible():
+            return
+        self._is_dirty = False
+        times, values = self.tracker.series()
+        for quantity, lines in enumerate(self._lines):
+            for roi, line in enumerate(lines):
+                line.set_data(times, values[:, roi, quantity])
+        for ax in self._axes:
+            ax.relim()
+            ax.autoscale_view()
+        self.canvas.draw_idle()
 
 
 class SpectraGatherer(QObject):
     finished = pyqtSignal()
     progress = pyqtSignal(int)
     result = pyqtSignal(object, object, object)
+    frame_gathered = pyqtSignal(object)  # Calculated spectrum of every stored frame, for live views
+    peaks_gathered = pyqtSignal(object, object)  # Timestamps and values of the stored frames, when tracking peaks
 
-    def __init__(self, total_frames, array_size, skip, is_dark_data, is_bright_data, dark_mean, bright_mean):
+    def __init__(self, total_frames, array_size, skip, is_dark_data, is_bright_data, dark_mean, bright_mean,
+                 stream_prefix=None, journal=None, raw_dtype=RAW_DTYPE, meas_dtype=MEAS_DTYPE, setting_id=None,
+                 monitor=None, timing=None, tracker=None, arm=None):
+        """
+        Collects the spectra of a measurement in its own thread, see SpectraCollector for the parameters
+        """
         super(SpectraGatherer, self).__init__()
+        self.collector = SpectraCollector(total_frames, array_size, skip, is_dark_data, is_bright_data, dark_mean,
+                                          bright_mean, stream_prefix=stream_prefix, journal=journal,
+                                          raw_dtype=raw_dtype, meas_dtype=meas_dtype, setting_id=setting_id,
+                                          monitor=monitor, timing=timing, tracker=tracker,
+                                          arm=arm)
+        self.tracker = tracker
+        self._peaks_sent = 0  # Tracked frames already emitted through peaks_gathered
         self.total_frames = total_frames
-        self.array_size = array_size
-        self.skip = skip + 1
-        self.is_dark_data = is_dark_data
-        self.is_bright_data = is_bright_data
-        self.dark_mean = dark_mean
-        self.bright_mean = bright_mean
-        self.spectra_meas_array = np.ones((self.total_frames, self.array_size))
-        self.spectra_raw_array = np.ones((self.total_frames, self.array_size))
-        self.time_meas_array = np.ones(self.total_frames)
-        self.spectra_counter = 0
-        self.array_count = 0
-        self.init_spectra_measurement()
+        self.is_finished = False
 
     @pyqtSlot(object)
     def measure(self, reading: SpectraReading):
@@ -181,49 +493,75 @@ class SpectraGatherer(QObject):
         Collect measured spectra and do necessary math to it
         @param reading:
         """
-        spect = reading.data
-        yarray = utils.spectra_math(spect, self.is_dark_data, self.is_bright_data, self.dark_mean, self.bright_mean)
-        self.gathering_spectra_counts(spect, yarray, reading.timestamp)
+        if self.is_finished:
+            return
+        counter = self.collector.spectra_counter
+        yarray = self.collector.add(reading)
+        if yarray is not None and self.receivers(self.frame_gathered):
+            self.frame_gathered.emit(np.array(yarray))  # yarray is a reused buffer
+        self.after_frames(counter)
 
-    def init_spectra_measurement(self):
+    @pyqtSlot(object)
+    def measure_block(self, block: SpectraBlock):
         """
-        Resets lists and counters to begin new measurement
+        Same as measure for a batch of readings, with the math done on the whole block at once
+        @param block:
         """
-        self.spectra_meas_array[:] = np.nan
-        self.spectra_raw_array[:] = np.nan
-        self.time_meas_array[:] = np.nan
-        self.spectra_counter = 0
-        self.array_count = 0
+        if self.is_finished:
+            return
+        counter = self.collector.spectra_counter
+        yarray = self.collector.add_block(block)
+        if len(yarray) and self.receivers(self.frame_gathered):
+            self.frame_gathered.emit(np.array(yarray))
+        self.after_frames(counter)
 
-    def gathering_spectra_counts(self, ydata, yarray, timestamp):
+    def after_frames(self, previous_counter):
         """
-        Collect lists of spectra into a predefined matrix
-        @param ydata: list of measured spectra
-        @param yarray: list of calculated data from spectra
-        @param timestamp: float of elapsed time
+        Reports progress, and ends the measurement once all frames were received
+        @param previous_counter: frames received before the last reading
         """
-        if self.spectra_counter < self.total_frames:
-            if self.spectra_counter == 0 or (self.spectra_counter % self.skip) == 0:
-                self.spectra_raw_array[self.array_count] = ydata
-                self.spectra_meas_array[self.array_count] = yarray
-                self.time_meas_array[self.array_count] = timestamp
-                self.array_count += 1
-            self.spectra_counter += 1
-            self.progress.emit(self.spectra_counter)
-        else:
-            self.time_meas_array = self.time_meas_array - self.time_meas_array[0]
-            self.result.emit(self.spectra_raw_array, self.spectra_meas_array, self.time_meas_array)
-            self.finished.emit()
+        if self.collector.spectra_counter != previous_counter:
+            self.progress.emit(self.collector.spectra_counter)
+        if self.tracker is not None and self.tracker.n_frames != self._peaks_sent:
+            self.peaks_gathered.emit(*self.tracker.since(self._peaks_sent))
+            self._peaks_sent = self.tracker.n_frames
+        if self.collector.is_complete:
+            self.finish_measurement()
+
+    def finish_measurement(self):
+        """
+        Hands the gathered spectra over and ends the measurement
+        """
+        self.is_finished = True
+        spectra_raw_array, spectra_meas_array, time_meas_array = self.collected_arrays()
+        time_meas_array = time_meas_array - time_meas_array[0]
+        self.result.emit(spectra_raw_array, spectra_meas_array, time_meas_array)
+        self.finished.emit()
+
+    def collected_arrays(self):
+        """
+        Spectra gathered so far, see SpectraCollector.collected_arrays
+        """
+        return self.collector.collected_arrays()
 
 
 class DarkBrightGatherer(QObject):
-    result = pyqtSignal(object)
+    result = pyqtSignal(object, object)  # Mean spectrum, per-pixel noise (standard deviation)
 
-    def __init__(self, average_cycles, array_size):
+    def __init__(self, average_cycles, array_size, rejection="none", setting_id=None, monitor=None):
+        """
+        @param average_cycles: number of spectra to average
+        @param rejection: cosmic ray rejection, one of utils.ReferenceAccumulator.REJECTIONS
+        @param setting_id: if given, readings acquired under another integration time command are ignored
+        @param monitor: optional LatencyMonitor stamping the gather stage and, once averaged, the correct stage
+        """
         super(DarkBrightGatherer, self).__init__()
+        self.setting_id = setting_id
+        self.monitor = monitor
         self.counter = 0
         self.average_cycles = average_cycles
-        self.measured_array = np.ones((self.average_cycles, array_size))
+        self.accumulator = utils.ReferenceAccumulator(array_size, rejection, expected_frames=average_cycles)
+        self.is_finished = False
 
     @pyqtSlot(object)
     def gathering_counts(self, reading: SpectraReading):
@@ -231,9 +569,150 @@ class DarkBrightGatherer(QObject):
         Collects data specifically for dark and bright conditions
         @param reading: list of spectra data
         """
+        if self.is_finished or (self.setting_id is not None and reading.setting_id != self.setting_id):
+            return
         if self.counter < self.average_cycles:
-            self.measured_array[self.counter] = reading.data
+            if self.monitor is not None:
+                self.monitor.stamp(reading.stamps, instrumentation.GATHER)
+            self.accumulator.add(reading.data)
+            if self.monitor is not None:
+                self.monitor.stamp(reading.stamps, instrumentation.CORRECT)
             self.counter += 1
         else:
-            _mean = np.mean(self.measured_array, axis=0)
-            self.result.emit(_mean)
+            self.emit_mean()
+
+    @pyqtSlot(object)
+    def gathering_block(self, block: SpectraBlock):
+        """
+        Same as gathering_counts for a batch of readings
+        @param block: stacked spectra data
+        """
+        if self.is_finished:
+            return
+        if self.setting_id is not None:
+            block = block.select(block.setting_ids == self.setting_id)
+        n_frames = min(len(block), self.average_cycles - self.counter)
+        block = block.select(slice(0, n_frames))
+        if self.monitor is not None:
+            self.monitor.stamp_block(block.stamps, instrumentation.GATHER)
+        self.accumulator.add_block(block.data)
+        if self.monitor is not None:
+            self.monitor.stamp_block(block.stamps, instrumentation.CORRECT)
+        self.counter += n_frames
+        if self.counter == self.average_cycles:
+            self.emit_mean()
+
+    def emit_mean(self):
+        self.is_finished = True
+        self.accumulator.finish()
+        self.result.emit(self.accumulator.mean, self.accumulator.noise)
+
+    @property
+    def rejected(self) -> int:
+        """
+        Spike values replaced while averaging
+        """
+        return int(self.accumulator.rejected.sum())
+
+
+class RemoteGatherer(QObject):
+    """
+    Stand-in for SpectraGatherer when the processing process gathers the measurement: same signals,
+    driven by its messages (connect Emitter.processing_message to handle_message)
+    """
+    finished = pyqtSignal()
+    progress = pyqtSignal(int)
+    result = pyqtSignal(object, object, object)
+    frame_gathered = pyqtSignal(object)
+    peaks_gathered = pyqtSignal(object, object)
+
+    def __init__(self, processing_queue, plan: processing.MeasurementPlan, timing=None, tracker=None):
+        """
+        @param processing_queue: Queue of the processing process
+        @param plan: measurement to gather
+        @param timing: optional FrameTiming, updated with the timing of the measurement once it is complete
+        @param tracker: optional PeakTracker for plan.rois, filled with the values computed by the processing process
+        """
+        super(RemoteGatherer, self).__init__()
+        self.processing_queue = processing_queue
+        self.timing = timing
+        self.tracker = tracker
+        self.journal_path = plan.journal_path
+        self.is_finished = False
+        processing_queue.put(processing.ProcessingCommand(processing.ProcessingCommand.MEASURE, plan))
+
+    def stop(self):
+        """
+        Ends the measurement early, the frames gathered so far arrive through result as usual
+        """
+        self.processing_queue.put(processing.ProcessingCommand(processing.ProcessingCommand.STOP))
+
+    @pyqtSlot(object)
+    def handle_message(self, message):
+        if self.is_finished:
+            return
+        if isinstance(message, processing.MeasurementUpdate):
+            self.progress.emit(message.counter)
+            if message.frames is not None:
+                self.frame_gathered.emit(message.frames)
+            if message.peaks is not None and len(message.peaks[0]):
+                if self.tracker is not None:
+                    self.tracker.extend(*message.peaks)
+                self.peaks_gathered.emit(*message.peaks)
+        elif isinstance(message, processing.MeasurementDone):
+            self.is_finished = True
+            if self.timing is not None:
+                self.timing.update_from(message.timing)
+            arrays = processing.open_streamed_arrays(message.stream_prefix)
+            if len(arrays[2]):
+                arrays = (arrays[0], arrays[1], arrays[2] - arrays[2][0])
+            self.result.emit(*arrays)
+            self.finished.emit()
+
+
+class RemoteReferenceGatherer(QObject):
+    """
+    Stand-in for DarkBrightGatherer when the processing process averages the reference
+    """
+    result = pyqtSignal(object, object)
+
+    def __init__(self, processing_queue, average_cycles, rejection="none", setting_id=None):
+        super(RemoteReferenceGatherer, self).__init__()
+        self.rejected = 0
+        self.is_finished = False
+        processing_queue.put(processing.ProcessingCommand(processing.ProcessingCommand.AVERAGE,
+                                                          processing.ReferencePlan(average_cycles, rejection,
+                                                                                   setting_id)))
+
+    @pyqtSlot(object)
+    def handle_message(self, message):
+        if self.is_finished or not isinstance(message, processing.ReferenceDone):
+            return
+        self.is_finished = True
+        self.rejected = message.rejected
+        self.result.emit(message.mean, message.noise)
+
+
+class ExportWorker(QObject):
+    progress = pyqtSignal(str)
+    finished = pyqtSignal(str)
+
+    @pyqtSlot(object)
+    def export(self, job: export.ExportJob):
+        """
+        Writes a finished measurement to disk. Jobs are queued in this worker's thread and written one after another
+        @param job: measurement to save
+        """
+        try:
+            self.progress.emit("Saving " + job.filename)
+            export.save(job, lambda fraction: self.progress.emit(
+                "Saving {} ({:.0%})".format(job.filename, fraction)))
+            if job.is_heatplot:
+                self.progress.emit("Creating heatplot of " + job.sample)
+                export.save_heatplot(job)
+        except Exception as error:
+            self.finished.emit("Saving " + job.sample + " failed: " + str(error))
+        else:
+            if job.journal_path is not None:
+                journal.discard(job.journal_path)
+            self.finished.emit("Data saved successfully")